@@ -18,6 +18,10 @@ from pycocotools.coco import COCO
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
 class Waterbird(Dataset):
+    # Names of the (y, place) groups, y = 1 for the waterbirds and place = 1 for the water backgrounds.
+    GROUP_NAMES = {(0, 0): 'landbird_land', (0, 1): 'landbird_water', (1, 0): 'waterbird_land', (1, 1): 'waterbird_water'}
+    GROUP_FIELDS = ('y', 'place')
+
     def __init__(self, root, split, image_size=224, mask_size = 224):
         assert split in ['train', 'val']
 
@@ -96,6 +100,13 @@ class Waterbird(Dataset):
     def __len__(self):
         return len(self.imglist)
 
+    def get_image_id(self, idx):
+        return self.imglist[idx]
+
+    def get_group(self, idx):
+        # (bird type, background place), the Waterbird groups.
+        return (self.ylist[idx], self.placelist[idx])
+
 class PascalVOC(Dataset):
     def __init__(self, root, split, image_size=224, mask_size = 224):
         assert split in ['trainaug', 'val']
@@ -166,6 +177,9 @@ class PascalVOC(Dataset):
     def __len__(self):
         return len(self.imglist)
 
+    def get_image_id(self, idx):
+        return self.imglist[idx]
+
     def read_imglist(self, imglist_fp):
         ll = []
         with open(imglist_fp, 'r') as fd:
@@ -296,6 +310,9 @@ class COCO2017(Dataset):
     def __len__(self):
         return len(self.ids)
 
+    def get_image_id(self, idx):
+        return str(self.ids[idx])
+
 
 class MOVi(Dataset):
     def __init__(self, root, split, image_size, mask_size, num_segs=25, frames_per_clip=24, img_glob='*_image.png', predefined_json_paths = None):
@@ -352,6 +369,9 @@ class MOVi(Dataset):
     def __len__(self):
         return len(self.rgb)
 
+    def get_image_id(self, idx):
+        return os.path.relpath(self.rgb[idx], self.root)
+
     def __getitem__(self, idx):
         
         img_loc = self.rgb[idx]
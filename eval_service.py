@@ -0,0 +1,205 @@
+''' Scores the epochs of a training run (written with --eval_snapshots) in a separate process, concurrently with the training. '''
+
+import os
+import glob
+import math
+import time
+import argparse
+
+import torch
+from torch.utils.data import DataLoader, Subset
+from torch.utils.tensorboard import SummaryWriter
+
+from spot import SPOT
+from eval_spot import build_dataset, build_encoder
+from evaluation import evaluate, visualize_batch, stratified_subset, dataset_groups, group_names, METRIC_NAMES
+from utils_spot import bool_flag, PRECISIONS, load_pretrained_encoder, save_checkpoint, EarlyStopping, log_val_metrics, read_val_metrics
+from utils_spot import set_rng_state
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT evaluation service', add_help=False)
+
+    parser.add_argument('--log_dir', type=str, required=True, help='run directory of the training (the one of its checkpoint.pt.tar), the metrics are written to its TensorBoard logs and val_metrics.jsonl')
+    parser.add_argument('--device', type=str, default='cpu', help='cuda or cpu')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads of the evaluation, by default all the cpu cores')
+    parser.add_argument('--num_workers', type=int, default=2)
+    parser.add_argument('--metric_workers', type=int, default=1, help='threads computing the metrics during the next forward passes (0 computes them after each batch)')
+    parser.add_argument('--precision', type=str, default=None, choices=PRECISIONS, help='by default the one of the training (fp16 needs cuda)')
+    parser.add_argument('--data_path', type=str, default=None, help='by default the one of the training')
+    parser.add_argument('--poll_interval', type=float, default=30.)
+    parser.add_argument('--keep_snapshots', type=bool_flag, default=False, help='keep the snapshots once scored (they are deleted by default)')
+    parser.add_argument('--exit_when_done', type=bool_flag, default=True, help='exit after scoring the last epoch of the training (--epochs or --stop_at_epoch)')
+
+    return parser
+
+
+def snapshot_epoch(path):
+    return int(os.path.splitext(os.path.basename(path))[0].split('_')[1])
+
+
+def build_model(train_args, second_encoder):
+    # The encoders are built once from their pretrained weights, only the trained weights come with the snapshots.
+    encoder, encoder_second = build_encoder(argparse.Namespace(**dict(vars(train_args), use_second_encoder=second_encoder)))
+    if train_args.which_encoder == 'mae_vitb16':
+        for e in (encoder, encoder_second):
+            if e is not None:
+                load_pretrained_encoder(e, train_args.pretrained_encoder_weights, prefix=None)
+    return SPOT(encoder, train_args, encoder_second)
+
+
+def run_last_epoch(train_args):
+    return train_args.epochs if train_args.stop_at_epoch is None else min(train_args.stop_at_epoch, train_args.epochs)
+
+
+def checkpoint_last_epoch(log_dir):
+    # The last epoch of the training from the arguments of its checkpoint, None before the first checkpoint.
+    checkpoint_path = os.path.join(log_dir, 'checkpoint.pt.tar')
+    if not os.path.exists(checkpoint_path):
+        return None
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    return run_last_epoch(argparse.Namespace(**checkpoint['args'])) if 'args' in checkpoint else None
+
+
+def load_snapshot(model, snapshot):
+    missing, unexpected = model.load_state_dict(snapshot['model'], strict=False)
+    assert not unexpected and all(k.startswith(('encoder.', 'second_encoder.')) for k in missing), (missing, unexpected)
+
+
+class Evaluator(object):
+    """
+    Validation of the training loop for the snapshots of one run: the same data, settings and TensorBoard tags,
+    written at the epoch of the snapshot. best_model.pt is chosen as in the training: by early_stop_metric with
+    --early_stopping, else by the mse, ARI and mBO_c of the previous best epoch.
+    """
+    def __init__(self, args, snapshot, scored):
+        self.args = args
+        self.train_args = train_args = argparse.Namespace(**snapshot['args'])
+        if args.data_path is not None:
+            train_args.data_path = args.data_path
+        self.precision = args.precision or train_args.precision
+        self.device = torch.device(args.device)
+        self.model = build_model(train_args, snapshot['second_encoder']).to(self.device)
+
+        loader_kwargs = {'shuffle': False, 'drop_last': False, 'batch_size': train_args.eval_batch_size,
+                         'num_workers': args.num_workers, 'pin_memory': True}
+        val_dataset = build_dataset(train_args)
+        self.val_loader = DataLoader(val_dataset, **loader_kwargs)
+        self.val_groups = group_names(val_dataset) if hasattr(val_dataset, 'get_group') else None
+        if train_args.fast_val_size > 0:
+            fast_val_dataset = Subset(val_dataset, stratified_subset(dataset_groups(val_dataset), train_args.fast_val_size, seed=train_args.seed))
+            self.fast_val_loader = DataLoader(fast_val_dataset, **loader_kwargs)
+            self.fast_val_kwargs = {'bootstrap': train_args.fast_val_bootstrap, 'ari_pixels': train_args.fast_val_ari_pixels or None,
+                                    'groups': [self.val_groups[i] for i in fast_val_dataset.indices] if self.val_groups is not None else None}
+        else:
+            self.fast_val_loader = self.val_loader
+            self.fast_val_kwargs = {'groups': self.val_groups}
+
+        self.writer = SummaryWriter(args.log_dir, filename_suffix='.eval_service')
+        self.visualize_per_epoch = max(1, int(train_args.epochs * train_args.eval_viz_percent))
+        self.early_stopping = EarlyStopping(train_args.early_stop_metric, train_args.patience, train_args.min_delta)
+        self.best = {'mse': math.inf, 'ari': 0, 'mbo_c': 0}
+        for epoch in sorted(scored):
+            self.update_best(scored[epoch])
+
+    @property
+    def last_epoch(self):
+        return run_last_epoch(self.train_args)
+
+    def update_best(self, val_results):
+        # The best epoch criterion of the training loop.
+        improved = self.early_stopping.update(val_results)
+        if self.train_args.early_stopping:
+            is_best = improved
+        else:
+            is_best = (val_results['mse'] < self.best['mse']) or (self.best['ari'] > val_results['ari']) or (self.best['mbo_c'] > val_results['mbo_c'])
+        if is_best:
+            self.best = {name: val_results[name] for name in self.best}
+        return is_best
+
+    def score(self, snapshot):
+        epoch = snapshot['epoch']
+        load_snapshot(self.model, snapshot)
+        # The random state of the training loop at this epoch, so that the slot initializations are those of the
+        # in-loop validation (the snapshots written without it use a fixed seed).
+        if 'rng_state' in snapshot:
+            set_rng_state(snapshot['rng_state'])
+        else:
+            torch.manual_seed(self.train_args.seed)
+        with torch.no_grad():
+            val_results, val_last = evaluate(self.model, self.fast_val_loader, self.train_args.val_mask_size, self.precision,
+                                             metric_workers=self.args.metric_workers, **self.fast_val_kwargs)
+
+        writer = self.writer
+        writer.add_scalar('VAL/mse', val_results['mse'], epoch)
+        writer.add_scalar('VAL/ari (slots)', val_results['ari_slot'], epoch)
+        writer.add_scalar('VAL/ari (decoder)', val_results['ari'], epoch)
+        writer.add_scalar('VAL/mbo_c', val_results['mbo_c'], epoch)
+        writer.add_scalar('VAL/mbo_i', val_results['mbo_i'], epoch)
+        writer.add_scalar('VAL/miou', val_results['miou'], epoch)
+        writer.add_scalar('VAL/mbo_c (slots)', val_results['mbo_c_slot'], epoch)
+        writer.add_scalar('VAL/mbo_i (slots)', val_results['mbo_i_slot'], epoch)
+        writer.add_scalar('VAL/miou (slots)', val_results['miou_slot'], epoch)
+        for name, value in val_results.items():
+            if '/' in name:
+                writer.add_scalar('VAL_GROUPS/{}'.format(name), value, epoch)
+        log_val_metrics(self.args.log_dir, epoch, val_results)
+        print('====> Epoch: {:3} \t {}'.format(epoch, ' \t '.join('{} = {:F}'.format(name, val_results[name]) for name in ['mse'] + METRIC_NAMES)))
+
+        is_best = self.update_best(val_results)
+        if is_best:
+            save_checkpoint(self.model.state_dict(), os.path.join(self.args.log_dir, 'best_model.pt'))
+
+        if self.train_args.fast_val_size > 0 and (is_best or epoch == self.last_epoch):
+            # Continues the random state of the fast validation, as in the training loop.
+            with torch.no_grad():
+                full_results, _ = evaluate(self.model, self.val_loader, self.train_args.val_mask_size, self.precision,
+                                           metric_workers=self.args.metric_workers, groups=self.val_groups)
+            for name, value in full_results.items():
+                writer.add_scalar('VAL_FULL/{}'.format(name), value, epoch)
+            log_val_metrics(self.args.log_dir, epoch, full_results, name='val_metrics_full.jsonl')
+
+        if (epoch - 1) % self.visualize_per_epoch == 0 or epoch == self.train_args.epochs:
+            grid = visualize_batch(val_last, self.train_args.num_slots, self.train_args.val_mask_size, scale_factor=0.15)
+            writer.add_image('VAL_recon/epoch={:03}'.format(epoch), grid)
+        writer.flush()
+        return val_results
+
+
+def serve(args):
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    snapshot_dir = os.path.join(args.log_dir, 'eval_snapshots')
+    scored = read_val_metrics(args.log_dir) # a restarted service continues after the epochs already scored
+    evaluator = None
+    last_epoch = None
+    print('====> Watching {}'.format(snapshot_dir))
+    while True:
+        for path in sorted(glob.glob(os.path.join(snapshot_dir, 'epoch_*.pt')), key=snapshot_epoch):
+            epoch = snapshot_epoch(path)
+            if epoch not in scored or evaluator is None:
+                snapshot = torch.load(path, map_location='cpu')
+                if evaluator is None:
+                    evaluator = Evaluator(args, snapshot, scored)
+                if epoch not in scored:
+                    scored[epoch] = evaluator.score(snapshot)
+            if not args.keep_snapshots:
+                os.remove(path)
+
+        # Also without any new snapshot, e.g. restarted once all of them were scored.
+        if evaluator is not None:
+            last_epoch = evaluator.last_epoch
+        elif last_epoch is None:
+            last_epoch = checkpoint_last_epoch(args.log_dir)
+        if args.exit_when_done and last_epoch is not None and scored and max(scored) >= last_epoch:
+            break
+        time.sleep(args.poll_interval)
+
+    if evaluator is not None:
+        evaluator.writer.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT evaluation service', parents=[get_args_parser()])
+    args = parser.parse_args()
+    serve(args)
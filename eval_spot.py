@@ -1,224 +1,466 @@
+import os
+import sys
 import copy
-import os.path
+import math
+import random
+import hashlib
+import inspect
 import argparse
+import traceback
 import pandas as pd
 from tqdm import tqdm
 import torch
-import torch.nn.functional as F
+import torch.multiprocessing as mp
 from torch.utils.data import DataLoader
-import torchvision.utils as vutils
 from torchvision.utils import save_image
 from spot import SPOT
 from datasets import PascalVOC, COCO2017, MOVi, Waterbird
-from ocl_metrics import UnsupervisedMaskIoUMetric, ARIMetric
-from utils_spot import inv_normalize, visualize, bool_flag
+from ocl_metrics import aggregate_per_sample
+from evaluation import evaluate_batch, MetricPipeline, visualize_batch, check_precision, group_names, group_results, METRIC_NAMES
+from utils_spot import bool_flag, PRECISIONS, get_autocast
+from results_store import ResultsStore, file_sha1
 import models_vit
 
-parser = argparse.ArgumentParser()
-
-parser.add_argument('--num_workers', type=int, default=4)
-parser.add_argument('--seed', type=int, default=0)
-parser.add_argument('--image_size', type=int, default=224)
-parser.add_argument('--val_image_size', type=int, default=224)
-parser.add_argument('--val_mask_size', type=int, default=320)
-parser.add_argument('--eval_batch_size', type=int, default=32)
-parser.add_argument('--viz_resolution_factor', type=float, default=0.5)
-
-parser.add_argument('--checkpoint_path', default='checkpoint.pt.tar')
-parser.add_argument('--log_path', default='results')
-parser.add_argument('--dataset', default='coco', help='coco or voc')
-parser.add_argument('--data_path',  type=str, help='dataset path')
-
-parser.add_argument('--num_dec_blocks', type=int, default=4)
-parser.add_argument('--d_model', type=int, default=768)
-parser.add_argument('--num_heads', type=int, default=6)
-parser.add_argument('--dropout', type=float, default=0.0)
-
-parser.add_argument('--num_iterations', type=int, default=3)
-parser.add_argument('--num_slots', type=int, default=7)
-parser.add_argument('--slot_size', type=int, default=256)
-parser.add_argument('--mlp_hidden_size', type=int, default=1024)
-parser.add_argument('--img_channels', type=int, default=3)
-parser.add_argument('--pos_channels', type=int, default=4)
-parser.add_argument('--num_cross_heads', type=int, default=None)
-
-parser.add_argument('--dec_type',  type=str, default='transformer', help='type of decoder transformer or mlp')
-parser.add_argument('--cappa', type=float, default=-1)
-parser.add_argument('--mlp_dec_hidden',  type=int, default=2048, help='Dimension of decoder mlp hidden layers')
-parser.add_argument('--use_slot_proj',  type=bool_flag, default=True, help='Use an extra projection before MLP decoder')
-
-parser.add_argument('--which_encoder',  type=str, default='dino_vitb16', help='dino_vitb16, dino_vits8, dinov2_vitb14_reg, dinov2_vits14_reg, dinov2_vitb14, dinov2_vits14, mae_vitb16')
-parser.add_argument('--finetune_blocks_after',  type=int, default=100, help='just use a large number')
-parser.add_argument('--encoder_final_norm',  type=bool_flag, default=False)
-
-parser.add_argument('--truncate',  type=str, default='bi-level', help='bi-level or fixed-point or none')
-parser.add_argument('--init_method', default='embedding', help='embedding or shared_gaussian')
-
-parser.add_argument('--use_second_encoder',  type= bool_flag, default = True, help='different encoder for input and target of decoder')
-
-parser.add_argument('--train_permutations',  type=str, default='random', help='it is just for the initialization')
-parser.add_argument('--eval_permutations',  type=str, default='standard', help='standard, random, or all')
-
-args = parser.parse_args()
-
-torch.manual_seed(args.seed)
-
-arg_str_list = ['{}={}'.format(k, v) for k, v in vars(args).items()]
-arg_str = '__'.join(arg_str_list)
-log_dir = os.path.join(args.log_path, os.path.basename(os.path.dirname(args.checkpoint_path)))
-os.makedirs(log_dir, exist_ok=True)
-
-if args.dataset == 'voc':
-    val_dataset = PascalVOC(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
-elif args.dataset == 'waterbird':
-    val_dataset = Waterbird(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
-elif args.dataset == 'coco':
-    val_dataset = COCO2017(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
-elif args.dataset == 'movi':
-    val_dataset = MOVi(root=os.path.join(args.data_path, 'validation'), split='validation', image_size=args.val_image_size, mask_size = args.val_mask_size)
-
-args.max_tokens = int((args.val_image_size/16)**2)
-
-val_sampler = None
-
-loader_kwargs = {
-    'num_workers': args.num_workers,
-    'pin_memory': True,
-}
-
-val_loader = DataLoader(val_dataset, sampler=val_sampler, shuffle=False, drop_last = False, batch_size=args.eval_batch_size, **loader_kwargs)
-
-val_epoch_size = len(val_loader)
-
-if args.which_encoder == 'dino_vitb16':
-    args.max_tokens = int((args.val_image_size/16)**2)
-    encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vitb16')
-elif args.which_encoder == 'dino_vits8':
-    args.max_tokens = int((args.val_image_size/8)**2)
-    encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vits8')
-elif args.which_encoder == 'dino_vitb8':
-    args.max_tokens = int((args.val_image_size/8)**2)
-    encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vitb8')
-elif args.which_encoder == 'dinov2_vitb14':
-    args.max_tokens = int((args.val_image_size/14)**2)
-    encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14')
-elif args.which_encoder == 'dinov2_vits14':
-    args.max_tokens = int((args.val_image_size/14)**2)
-    encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14')
-elif args.which_encoder == 'dinov2_vitb14_reg':
-    args.max_tokens = int((args.val_image_size/14)**2)
-    encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14_reg')
-elif args.which_encoder == 'dinov2_vits14_reg':
-    args.max_tokens = int((args.val_image_size/14)**2)
-    encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14_reg')
-elif args.which_encoder == 'mae_vitb16':
-    args.max_tokens = int((args.val_image_size/16)**2)
-    encoder = models_vit.__dict__["vit_base_patch16"](num_classes=0, global_pool=False, drop_path_rate=0)
- 
-else:
-    raise
-        
-encoder = encoder.eval()
-
-if args.use_second_encoder:
-    encoder_second = copy.deepcopy(encoder).eval()
-else:
-    encoder_second = None
-
-if args.num_cross_heads is None:
-    args.num_cross_heads = args.num_heads
-
-model = SPOT(encoder, args, encoder_second)
-
-checkpoint = torch.load(args.checkpoint_path, map_location='cpu')
-checkpoint['model'] = {k.replace("tf_dec.", "dec."): v for k, v in checkpoint['model'].items()} # compatibility with older runs
-model.load_state_dict(checkpoint['model'], strict = True)
-
-model = model.cuda()
-
-MBO_c_metric = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True).cuda()
-MBO_i_metric = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True).cuda()
-miou_metric = UnsupervisedMaskIoUMetric(matching="hungarian", ignore_background = True, ignore_overlaps = True).cuda()
-ari_metric = ARIMetric(foreground = True, ignore_overlaps = True).cuda()
-
-MBO_c_slot_metric = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True).cuda()
-MBO_i_slot_metric = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True).cuda()
-miou_slot_metric = UnsupervisedMaskIoUMetric(matching="hungarian", ignore_background = True, ignore_overlaps = True).cuda()
-ari_slot_metric = ARIMetric(foreground = True, ignore_overlaps = True).cuda()
-
-with torch.no_grad():
-    model.eval()
-
-    val_mse = 0.
-    counter = 0
-
-    for batch, (image, true_mask_i, true_mask_c, mask_ignore) in enumerate(tqdm(val_loader)):
-        image = image.cuda()
-        true_mask_i = true_mask_i.cuda()
-        true_mask_c = true_mask_c.cuda()
-        mask_ignore = mask_ignore.cuda() 
-        
-        batch_size = image.shape[0]
-        counter += batch_size
-
-        mse, default_slots_attns, dec_slots_attns, _, _, _ = model(image)
-
-        # DINOSAUR uses as attention masks the attenton maps of the decoder
-        # over the slots, which bilinearly resizes to match the image resolution
-        # dec_slots_attns shape: [B, num_slots, H_enc, W_enc]
-        default_attns = F.interpolate(default_slots_attns, size=args.val_mask_size, mode='bilinear')
-        dec_attns = F.interpolate(dec_slots_attns, size=args.val_mask_size, mode='bilinear')
-        # dec_attns shape [B, num_slots, H, W]
-        default_attns = default_attns.unsqueeze(2)
-        dec_attns = dec_attns.unsqueeze(2) # shape [B, num_slots, 1, H, W]
-
-        pred_default_mask = default_attns.argmax(1).squeeze(1)
-        pred_dec_mask = dec_attns.argmax(1).squeeze(1)
-
-        val_mse += mse.item()
-             
-        # Compute ARI, MBO_i and MBO_c, miou scores for both slot attention and decoder
-        true_mask_i_reshaped = torch.nn.functional.one_hot(true_mask_i).to(torch.float32).permute(0,3,1,2).cuda()
-        true_mask_c_reshaped = torch.nn.functional.one_hot(true_mask_c).to(torch.float32).permute(0,3,1,2).cuda()
-        pred_dec_mask_reshaped = torch.nn.functional.one_hot(pred_dec_mask).to(torch.float32).permute(0,3,1,2).cuda()
-        pred_default_mask_reshaped = torch.nn.functional.one_hot(pred_default_mask).to(torch.float32).permute(0,3,1,2).cuda()
-        
-        MBO_i_metric.update(pred_dec_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-        MBO_c_metric.update(pred_dec_mask_reshaped, true_mask_c_reshaped, mask_ignore)
-        miou_metric.update(pred_dec_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-        ari_metric.update(pred_dec_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-    
-        MBO_i_slot_metric.update(pred_default_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-        MBO_c_slot_metric.update(pred_default_mask_reshaped, true_mask_c_reshaped, mask_ignore)
-        miou_slot_metric.update(pred_default_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-        ari_slot_metric.update(pred_default_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-
-    val_mse /= (val_epoch_size)
-    ari = 100 * ari_metric.compute()
-    ari_slot = 100 * ari_slot_metric.compute()
-    mbo_c = 100 * MBO_c_metric.compute()
-    mbo_i = 100 * MBO_i_metric.compute()
-    miou = 100 * miou_metric.compute()
-    mbo_c_slot = 100 * MBO_c_slot_metric.compute()
-    mbo_i_slot = 100 * MBO_i_slot_metric.compute()
-    miou_slot = 100 * miou_slot_metric.compute()
-    val_loss = val_mse
-
-    df_results = pd.DataFrame([[mbo_i.item(), mbo_c.item(), ari.item(),  val_mse, mbo_i_slot.item(), mbo_c_slot.item(), ari_slot.item(), miou.item(), miou_slot.item()]], 
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT evaluation', add_help=False)
+
+
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--metric_workers', type=int, default=1, help='threads computing the validation metrics during the next forward passes (0 computes them after each batch)')
+    parser.add_argument('--device', type=str, default='cuda', help='cuda or cpu')
+    parser.add_argument('--num_shards', type=int, default=1, help='split the evaluation over this many processes, which share the model weights')
+    parser.add_argument('--results_db', type=str, default=None, help='SQLite file of per-image results, the images already scored with the same checkpoint and settings are not evaluated again')
+    parser.add_argument('--threads_per_shard', type=int, default=None, help='intra-op threads of each process, by default the cpu cores divided by num_shards')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--image_size', type=int, default=224)
+    parser.add_argument('--val_image_size', type=int, default=224)
+    parser.add_argument('--val_mask_size', type=int, default=320)
+    parser.add_argument('--eval_batch_size', type=int, default=32)
+    parser.add_argument('--viz_resolution_factor', type=float, default=0.5)
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS, help='autocast the forward passes to bf16 or fp16')
+    parser.add_argument('--amp_check_batches', type=int, default=4, help='with bf16/fp16, first compare the metrics to fp32 on this many batches (0 disables it)')
+    parser.add_argument('--amp_check_tol', type=float, default=1.0, help='maximum allowed difference of the metrics to fp32, in %% points')
+
+    parser.add_argument('--checkpoint_path', default='checkpoint.pt.tar')
+    parser.add_argument('--checkpoint_paths', type=str, nargs='+', default=None, help='evaluate several checkpoints in one pass over the data, sharing the encoder forward of those with the same encoder weights (the number of slots is read from each checkpoint)')
+    parser.add_argument('--log_path', default='results')
+    parser.add_argument('--dataset', default='coco', help='coco or voc')
+    parser.add_argument('--data_path',  type=str, help='dataset path')
+
+    parser.add_argument('--num_dec_blocks', type=int, default=4)
+    parser.add_argument('--d_model', type=int, default=768)
+    parser.add_argument('--num_heads', type=int, default=6)
+    parser.add_argument('--dropout', type=float, default=0.0)
+
+    parser.add_argument('--num_iterations', type=int, default=3)
+    parser.add_argument('--num_slots', type=int, default=7)
+    parser.add_argument('--slot_size', type=int, default=256)
+    parser.add_argument('--mlp_hidden_size', type=int, default=1024)
+    parser.add_argument('--img_channels', type=int, default=3)
+    parser.add_argument('--pos_channels', type=int, default=4)
+    parser.add_argument('--num_cross_heads', type=int, default=None)
+
+    parser.add_argument('--dec_type',  type=str, default='transformer', help='type of decoder transformer or mlp')
+    parser.add_argument('--cappa', type=float, default=-1)
+    parser.add_argument('--mlp_dec_hidden',  type=int, default=2048, help='Dimension of decoder mlp hidden layers')
+    parser.add_argument('--use_slot_proj',  type=bool_flag, default=True, help='Use an extra projection before MLP decoder')
+
+    parser.add_argument('--which_encoder',  type=str, default='dino_vitb16', help='dino_vitb16, dino_vits8, dinov2_vitb14_reg, dinov2_vits14_reg, dinov2_vitb14, dinov2_vits14, mae_vitb16')
+    parser.add_argument('--finetune_blocks_after',  type=int, default=100, help='just use a large number')
+    parser.add_argument('--encoder_final_norm',  type=bool_flag, default=False)
+
+    parser.add_argument('--truncate',  type=str, default='bi-level', help='bi-level or fixed-point or none')
+    parser.add_argument('--init_method', default='embedding', help='embedding or shared_gaussian')
+
+    parser.add_argument('--use_second_encoder',  type= bool_flag, default = True, help='different encoder for input and target of decoder')
+
+    parser.add_argument('--train_permutations',  type=str, default='random', help='it is just for the initialization')
+    parser.add_argument('--eval_permutations',  type=str, default='standard', help='standard, random, or all')
+
+    return parser
+
+
+def build_dataset(args):
+    if args.dataset == 'voc':
+        val_dataset = PascalVOC(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
+    elif args.dataset == 'waterbird':
+        val_dataset = Waterbird(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
+    elif args.dataset == 'coco':
+        val_dataset = COCO2017(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
+    elif args.dataset == 'movi':
+        val_dataset = MOVi(root=os.path.join(args.data_path, 'validation'), split='validation', image_size=args.val_image_size, mask_size = args.val_mask_size)
+    return val_dataset
+
+
+def build_encoder(args):
+    if args.which_encoder == 'dino_vitb16':
+        encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vitb16')
+    elif args.which_encoder == 'dino_vits8':
+        encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vits8')
+    elif args.which_encoder == 'dino_vitb8':
+        encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vitb8')
+    elif args.which_encoder == 'dinov2_vitb14':
+        encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14')
+    elif args.which_encoder == 'dinov2_vits14':
+        encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14')
+    elif args.which_encoder == 'dinov2_vitb14_reg':
+        encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14_reg')
+    elif args.which_encoder == 'dinov2_vits14_reg':
+        encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14_reg')
+    elif args.which_encoder == 'mae_vitb16':
+        encoder = models_vit.__dict__["vit_base_patch16"](num_classes=0, global_pool=False, drop_path_rate=0)
+
+    else:
+        raise
+
+    encoder = encoder.eval()
+
+    if args.use_second_encoder:
+        encoder_second = copy.deepcopy(encoder).eval()
+    else:
+        encoder_second = None
+
+    return encoder, encoder_second
+
+
+def load_checkpoint(checkpoint_path):
+    # The state dict and the training arguments (None for the older checkpoints) of a checkpoint.
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    state_dict = {k.replace("tf_dec.", "dec."): v for k, v in checkpoint['model'].items()} # compatibility with older runs
+    return state_dict, checkpoint.get('args')
+
+
+def load_state_dict(checkpoint_path):
+    return load_checkpoint(checkpoint_path)[0]
+
+
+def checkpoint_num_slots(checkpoint_path, state_dict, train_args):
+    # From the training arguments stored in the checkpoint, or for the older checkpoints from the learned
+    # initialization of the slots (init_method embedding), the shared_gaussian initialization does not record it.
+    if train_args is not None:
+        return train_args['num_slots']
+    if 'slot_attn.slots_init.weight' in state_dict:
+        return state_dict['slot_attn.slots_init.weight'].shape[0]
+    raise ValueError('the number of slots of {} cannot be determined (it has no training arguments nor learned slot initialization), '
+                     'evaluate it on its own with --checkpoint_path and --num_slots'.format(checkpoint_path))
+
+
+def build_model(args, encoders=None, state_dict=None):
+    if encoders is None:
+        encoders = build_encoder(args)
+    encoder, encoder_second = encoders
+
+    if args.num_cross_heads is None:
+        args.num_cross_heads = args.num_heads
+
+    model = SPOT(encoder, args, encoder_second)
+
+    if state_dict is None:
+        state_dict = load_state_dict(args.checkpoint_path)
+    model.load_state_dict(state_dict, strict = True)
+
+    return model
+
+
+def encoder_key(state_dict):
+    # Hash of the encoder weights of a checkpoint, the checkpoints with the same key share their encoders.
+    sha1 = hashlib.sha1()
+    for name in sorted(state_dict):
+        if name.startswith(('encoder.', 'second_encoder.')):
+            sha1.update(name.encode())
+            sha1.update(state_dict[name].detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def build_heads(args):
+    """
+    Builds the model of every args.checkpoint_paths. Those with the same encoder weights (e.g. a frozen DINO)
+    use the same encoder instances, only their slot attention and decoder heads differ.
+    return: (models, groups, heads_args) with groups the lists of the indices of the models sharing their
+            encoders, and heads_args the args of every model.
+    """
+    base_encoders = build_encoder(args)
+    encoders = {}
+    models, heads_args = [], []
+    for checkpoint_path in args.checkpoint_paths:
+        state_dict, train_args = load_checkpoint(checkpoint_path)
+        head_args = copy.copy(args)
+        head_args.checkpoint_path = checkpoint_path
+        head_args.num_slots = checkpoint_num_slots(checkpoint_path, state_dict, train_args)
+
+        key = encoder_key(state_dict)
+        if key not in encoders:
+            # The first encoder weights use the encoders built above, only the other ones are copies.
+            encoders[key] = (base_encoders if not encoders else copy.deepcopy(base_encoders), [])
+        head_encoders, group = encoders[key]
+        group.append(len(models))
+        models.append(build_model(head_args, head_encoders, state_dict))
+        heads_args.append(head_args)
+
+    return models, [group for _, group in encoders.values()], heads_args
+
+
+# The arguments that do not change the per-image results of a checkpoint. All the other ones (the model and
+# the evaluation arguments) are its settings in the results store, so that a new argument is never left out.
+NON_EVAL_SETTINGS = {'num_workers', 'metric_workers', 'device', 'num_shards', 'results_db', 'threads_per_shard', 'viz_resolution_factor',
+                     'amp_check_batches', 'amp_check_tol', 'checkpoint_path', 'checkpoint_paths', 'log_path', 'data_path'}
+
+
+def eval_settings(args):
+    return {name: value for name, value in vars(args).items() if name not in NON_EVAL_SETTINGS}
+
+
+def batch_indices(batch_id, batch_size, dataset_size):
+    return list(range(batch_id * batch_size, min((batch_id + 1) * batch_size, dataset_size)))
+
+
+@torch.no_grad()
+def evaluate_shard(model, dataset, args, batch_ids, progress=True):
+    """
+    Evaluates the given batches of the dataset, keeping the metrics of every image.
+    The batches are the ones of a single process run, and the random state (slot initialization, random
+    permutations) is reset for each of them, so that every image gets the same values however the batches
+    are sharded or skipped.
+    return: dict with the dataset indices of the images, their per-sample METRIC_NAMES values, the batch ids
+            and their mse, and the tensors of the last batch of the shard for the visualization.
+    """
+    return evaluate_heads([model], [[0]], dataset, args, [batch_ids], progress)[0]
+
+
+@torch.no_grad()
+def evaluate_heads(models, groups, dataset, args, batch_ids_per_model, progress=True):
+    """
+    Evaluates several models in one pass over the dataset, each one on its batch_ids_per_model. The encoder
+    tokens are computed once per batch for each group of models sharing their encoders. Every model gets the
+    batches and the random state of a single model run.
+    return: list with the evaluate_shard result of every model.
+    """
+    batch_ids = sorted(set().union(*batch_ids_per_model))
+    batches = [batch_indices(b, args.eval_batch_size, len(dataset)) for b in batch_ids]
+    loader = DataLoader(dataset, batch_sampler=batches, num_workers=args.num_workers, pin_memory=True)
+
+    for model in models:
+        model.eval()
+    device = next(models[0].parameters()).device
+    pipelines = [MetricPipeline(device, args.metric_workers) for _ in models]
+    todo = [set(model_batch_ids) for model_batch_ids in batch_ids_per_model]
+
+    mses = [[] for _ in models]
+    lasts = [None for _ in models]
+    for batch_id, batch in zip(batch_ids, tqdm(loader, disable=not progress)):
+        for group in groups:
+            group = [i for i in group if batch_id in todo[i]]
+            if not group:
+                continue
+            tokens = None
+            if len(group) > 1:
+                with get_autocast(args.precision, device.type):
+                    tokens = models[group[0]].encode(batch[0].to(device))
+            for i in group:
+                torch.manual_seed(args.seed + batch_id)
+                random.seed(args.seed + batch_id)
+                mse, lasts[i] = evaluate_batch(models[i], batch, args.val_mask_size, args.precision, tokens)
+                pipelines[i].put(batch_id, lasts[i])
+                mses[i].append(mse.float().cpu())
+
+    results = []
+    for i, model_batch_ids in enumerate(batch_ids_per_model):
+        model_batch_ids = sorted(model_batch_ids)
+        indices = [j for b in model_batch_ids for j in batch_indices(b, args.eval_batch_size, len(dataset))]
+        results.append({
+            'indices': torch.tensor(indices, dtype=torch.long),
+            'per_sample': pipelines[i].close(),
+            'batch_ids': torch.tensor(model_batch_ids, dtype=torch.long),
+            'mse': torch.stack(mses[i]) if mses[i] else torch.zeros(0),
+            'last': {k: v.cpu() for k, v in lasts[i].items()} if lasts[i] is not None else None,
+        })
+    return results
+
+
+def merge_shards(shard_results):
+    """
+    Puts the per-sample values back in the dataset order and aggregates them, which does not depend on the sharding.
+    return: (results, indices, per_sample, last) with results the metrics (in %) and the mse, indices the
+            evaluated images and per_sample their values in the dataset order, and last the tensors of the last batch.
+    """
+    indices = torch.cat([r['indices'] for r in shard_results])
+    order = torch.argsort(indices)
+    per_sample = {name: torch.cat([r['per_sample'][name] for r in shard_results])[order] for name in METRIC_NAMES}
+
+    batch_ids = torch.cat([r['batch_ids'] for r in shard_results])
+    mses = torch.cat([r['mse'] for r in shard_results])[torch.argsort(batch_ids)]
+
+    results = {'mse': mses.double().sum().item() / len(mses) if len(mses) else math.nan}
+    for name in METRIC_NAMES:
+        results[name] = 100 * aggregate_per_sample(per_sample[name]).item()
+
+    # The last batch of the dataset is the last one of the shard that evaluated it.
+    last_shard = max(range(len(shard_results)), key=lambda s: max(shard_results[s]['batch_ids'].tolist(), default=-1))
+    last = shard_results[last_shard]['last']
+    return results, indices[order], per_sample, last
+
+
+def add_module_paths(model):
+    # The classes loaded through torch.hub (e.g. the DINO encoder) are only importable while loading. The
+    # spawned processes need their directory on sys.path (which spawn passes on) to unpickle the model.
+    for module in model.modules():
+        path = inspect.getfile(type(module))
+        for _ in type(module).__module__.split('.'):
+            path = os.path.dirname(path)
+        if path not in sys.path:
+            sys.path.append(path)
+
+
+def shard_worker(shard, model, args, batch_ids, queue, done):
+    torch.set_num_threads(args.threads_per_shard)
+    try:
+        dataset = build_dataset(args)
+        queue.put((shard, evaluate_shard(model, dataset, args, batch_ids, progress=shard == 0)))
+    except Exception:
+        queue.put((shard, traceback.format_exc()))
+    # Keep the process (which owns the shared memory of its results) alive until they are received.
+    done.wait()
+
+
+def evaluate_sharded(model, args, batch_ids):
+    """
+    Evaluates batch_ids in args.num_shards processes, each one taking every num_shards-th batch. They use the
+    weights of `model` through shared memory instead of loading their own copy.
+    """
+    if args.threads_per_shard is None:
+        args.threads_per_shard = max(1, (os.cpu_count() or 1) // args.num_shards)
+    model.share_memory()
+    add_module_paths(model)
+
+    ctx = mp.get_context('spawn')
+    queue = ctx.SimpleQueue()
+    done = ctx.Event()
+    processes = [ctx.Process(target=shard_worker, args=(shard, model, args, batch_ids[shard::args.num_shards], queue, done)) for shard in range(args.num_shards)]
+    for process in processes:
+        process.start()
+
+    shard_results = [None] * args.num_shards
+    for _ in range(args.num_shards):
+        shard, result = queue.get()
+        if isinstance(result, str):
+            done.set()
+            raise RuntimeError('Evaluation of shard {} failed:\n{}'.format(shard, result))
+        shard_results[shard] = result
+
+    done.set()
+    for process in processes:
+        process.join()
+    return shard_results
+
+
+def main(args):
+    torch.manual_seed(args.seed)
+
+    val_dataset = build_dataset(args)
+    if args.checkpoint_paths is not None:
+        assert args.num_shards == 1, 'several checkpoints are evaluated in a single process'
+        models, groups, heads_args = build_heads(args)
+    else:
+        models, groups, heads_args = [build_model(args)], [[0]], [args]
+    models = [model.to(args.device) for model in models]
+
+    if args.threads_per_shard is not None:
+        torch.set_num_threads(args.threads_per_shard)
+
+    if args.precision != 'fp32' and args.amp_check_batches > 0:
+        val_loader = DataLoader(val_dataset, shuffle=False, drop_last = False, batch_size=args.eval_batch_size, num_workers=args.num_workers, pin_memory=True)
+        for model in models:
+            check_precision(model, val_loader, args.val_mask_size, args.precision, args.amp_check_batches, args.amp_check_tol,
+                            seed=args.seed, metric_workers=args.metric_workers)
+
+    batch_ids = list(range(math.ceil(len(val_dataset) / args.eval_batch_size)))
+    batch_ids_per_model = [batch_ids for _ in models]
+
+    if args.results_db is not None:
+        store = ResultsStore(args.results_db)
+        checkpoint_hashes = [file_sha1(head_args.checkpoint_path) for head_args in heads_args]
+        dataset_key = '{}/{}'.format(args.dataset, val_dataset.split)
+        # Per checkpoint, the heads of build_heads can differ in their number of slots.
+        settings = [eval_settings(head_args) for head_args in heads_args]
+        image_ids = [val_dataset.get_image_id(i) for i in range(len(val_dataset))]
+        for i, checkpoint_hash in enumerate(checkpoint_hashes):
+            # Only whole batches are skipped, the others are evaluated with the same random state as in a full run.
+            scored = store.scored_ids(checkpoint_hash, dataset_key, settings[i])
+            batch_ids_per_model[i] = [b for b in batch_ids
+                                      if not all(image_ids[j] in scored for j in batch_indices(b, args.eval_batch_size, len(val_dataset)))]
+            print('{}: {} of {} images already in {}'.format(heads_args[i].checkpoint_path, sum(image_id in scored for image_id in image_ids),
+                                                             len(image_ids), args.results_db))
+
+    if args.num_shards > 1:
+        shard_results = [evaluate_sharded(models[0], args, batch_ids_per_model[0])]
+    else:
+        shard_results = [[result] for result in evaluate_heads(models, groups, val_dataset, args, batch_ids_per_model)]
+
+    # Group-wise metrics and worst group on the datasets with groups of images (the (y, place) groups of Waterbird).
+    image_groups = group_names(val_dataset) if hasattr(val_dataset, 'get_group') else None
+    if image_groups is not None:
+        all_groups = sorted(set(image_groups))
+    group_tables = []
+
+    rows = []
+    for i, head_args in enumerate(heads_args):
+        val_results, indices, per_sample, val_last = merge_shards(shard_results[i])
+
+        if args.results_db is not None:
+            store.add(checkpoint_hashes[i], dataset_key, settings[i], [image_ids[j] for j in indices.tolist()], per_sample)
+            # The mse is the one of the evaluated batches (nan if all of them were skipped).
+            metric_results, _ = store.aggregate(checkpoint_hashes[i], dataset_key, settings[i], image_ids)
+            val_results.update(metric_results)
+
+        if image_groups is not None:
+            if args.results_db is not None:
+                group_of = dict(zip(image_ids, image_groups))
+                stored_ids, group_per_sample = store.get(checkpoint_hashes[i], dataset_key, settings[i], image_ids)
+                sample_groups = [group_of[image_id] for image_id in stored_ids]
+            else:
+                group_per_sample, sample_groups = per_sample, [image_groups[j] for j in indices.tolist()]
+            by_group = group_results(group_per_sample, sample_groups, all_groups, 'cpu')
+            group_tables.append(pd.DataFrame([[by_group['{}/{}'.format(name, group)] for name in METRIC_NAMES] for group in all_groups + ['worst_group']],
+                                             index=all_groups + ['worst_group'], columns=METRIC_NAMES))
+
+        val_mse = val_results['mse']
+        ari = val_results['ari']
+        ari_slot = val_results['ari_slot']
+        mbo_c = val_results['mbo_c']
+        mbo_i = val_results['mbo_i']
+        miou = val_results['miou']
+        mbo_c_slot = val_results['mbo_c_slot']
+        mbo_i_slot = val_results['mbo_i_slot']
+        miou_slot = val_results['miou_slot']
+        rows.append([mbo_i, mbo_c, ari,  val_mse, mbo_i_slot, mbo_c_slot, ari_slot, miou, miou_slot])
+
+        # For plotting
+        if val_last is not None:
+            log_dir = os.path.join(args.log_path, os.path.basename(os.path.dirname(head_args.checkpoint_path)))
+            os.makedirs(log_dir, exist_ok=True)
+            if args.checkpoint_paths is None:
+                output_path = os.path.join(log_dir, 'output.png')
+            else:
+                output_path = os.path.join(log_dir, 'output_{}.png'.format(os.path.basename(head_args.checkpoint_path).split('.')[0]))
+            grid = visualize_batch(val_last, head_args.num_slots, args.val_mask_size, scale_factor=args.viz_resolution_factor)
+            save_image(grid, output_path)
+
+            print(output_path)
+
+    if args.results_db is not None:
+        store.close()
+
+    df_results = pd.DataFrame(rows, index=[head_args.checkpoint_path for head_args in heads_args],
                  columns=['mBO_i', 'mBO_c', 'FG-ARI',  'MSE', 'mBO_i_slots', 'mBO_c_slots', 'FG-ARI_slots', 'miou', 'miou_slots'])
-    
-    print(args.checkpoint_path)
+
     print(df_results)
-    
-    # For plotting
-    image = inv_normalize(image)
-    image = F.interpolate(image, size=args.val_mask_size, mode='bilinear')
-    rgb_default_attns = image.unsqueeze(1) * default_attns + 1. - default_attns
-    rgb_dec_attns = image.unsqueeze(1) * dec_attns + 1. - dec_attns
-    
-    vis_recon = visualize(image, true_mask_c, pred_dec_mask, rgb_dec_attns, pred_default_mask, rgb_default_attns, N=32)
-    grid = vutils.make_grid(vis_recon, nrow=2*args.num_slots + 4, pad_value=0.2)[:, 2:-2, 2:-2]
-    grid = F.interpolate(grid.unsqueeze(1), scale_factor=args.viz_resolution_factor, mode='bilinear').squeeze() # Lower resolution
-    save_image(grid, os.path.join(log_dir,'output.png'))
-
-    print(os.path.join(log_dir,'output.png'))
+
+    for head_args, df_groups in zip(heads_args, group_tables):
+        print('Groups of {}:'.format(head_args.checkpoint_path))
+        print(df_groups)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT evaluation', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
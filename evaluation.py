@@ -0,0 +1,381 @@
+''' Validation loop shared by the training and evaluation scripts. '''
+
+import math
+import queue
+import random
+import threading
+from tqdm import tqdm
+
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+import torchvision.utils as vutils
+
+from ocl_metrics import UnsupervisedMaskIoUMetric, ARIMetric
+from utils_spot import inv_normalize, visualize, get_autocast, get_rng_state, set_rng_state, is_dist_avail_and_initialized, is_main_process
+
+# Metrics of the decoder attention masks, the `_slot` ones use the slot attention masks.
+METRIC_NAMES = ['mbo_i', 'mbo_c', 'miou', 'ari', 'mbo_i_slot', 'mbo_c_slot', 'miou_slot', 'ari_slot']
+
+
+def build_metrics(device='cuda', keep_per_sample=False, ari_pixels=None):
+    device = torch.device(device)
+    metrics = {}
+    for suffix in ['', '_slot']:
+        metrics['mbo_i' + suffix] = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True, keep_per_sample = keep_per_sample)
+        metrics['mbo_c' + suffix] = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True, keep_per_sample = keep_per_sample)
+        metrics['miou' + suffix] = UnsupervisedMaskIoUMetric(matching="hungarian", ignore_background = True, ignore_overlaps = True, keep_per_sample = keep_per_sample)
+        metrics['ari' + suffix] = ARIMetric(foreground = True, ignore_overlaps = True, keep_per_sample = keep_per_sample, num_pixels = ari_pixels)
+    return {name: metric.to(device) for name, metric in metrics.items()}
+
+
+def masks_from_attns(slots_attns, mask_size):
+    # DINOSAUR uses as attention masks the attenton maps of the decoder
+    # over the slots, which bilinearly resizes to match the image resolution
+    # slots_attns shape: [B, num_slots, H_enc, W_enc], also float under autocast
+    attns = F.interpolate(slots_attns.float(), size=mask_size, mode='bilinear')
+    attns = attns.unsqueeze(2) # shape [B, num_slots, 1, H, W]
+    return attns, attns.argmax(1).squeeze(1)
+
+
+def update_metrics(metrics, pred_dec_mask, pred_default_mask, true_mask_i, true_mask_c, mask_ignore):
+    # Compute ARI, MBO_i and MBO_c, miou scores for both slot attention and decoder
+    true_mask_i_reshaped = torch.nn.functional.one_hot(true_mask_i).to(torch.float32).permute(0,3,1,2)
+    true_mask_c_reshaped = torch.nn.functional.one_hot(true_mask_c).to(torch.float32).permute(0,3,1,2)
+
+    for suffix, pred_mask in [('', pred_dec_mask), ('_slot', pred_default_mask)]:
+        pred_mask_reshaped = torch.nn.functional.one_hot(pred_mask).to(torch.float32).permute(0,3,1,2)
+        metrics['mbo_i' + suffix].update(pred_mask_reshaped, true_mask_i_reshaped, mask_ignore)
+        metrics['mbo_c' + suffix].update(pred_mask_reshaped, true_mask_c_reshaped, mask_ignore)
+        metrics['miou' + suffix].update(pred_mask_reshaped, true_mask_i_reshaped, mask_ignore)
+        metrics['ari' + suffix].update(pred_mask_reshaped, true_mask_i_reshaped, mask_ignore)
+
+
+class MetricPipeline:
+    """
+    Scores the predicted label maps of the validation batches in num_workers threads, while the model runs
+    the forward pass of the next batches (the torch ops release the GIL, and the matching is on the host).
+    At most max_pending batches wait in the queue, put() blocks beyond that. Every worker has its own metrics
+    and the per-sample values are put back in the order of the batch ids, so the aggregation does not depend
+    on which worker scored which batch. With num_workers=0, put() scores the batch itself.
+    ari_pixels: compute the ARI on this many fixed random pixels of each image (fast approximation).
+    """
+
+    def __init__(self, device='cuda', num_workers=1, max_pending=None, ari_pixels=None):
+        self.device = device
+        self.ari_pixels = ari_pixels
+        self.per_batch = {}
+        self.error = None
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_pending or 2 * max(num_workers, 1))
+        self.metrics = build_metrics(device, keep_per_sample=True, ari_pixels=ari_pixels)
+        self.workers = [threading.Thread(target=self._work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def put(self, batch_id, last):
+        # Compact label maps, the one-hot masks are only built by the workers.
+        masks = (
+            last['pred_dec_mask'].to(torch.uint8),
+            last['pred_default_mask'].to(torch.uint8),
+            last['true_mask_i'],
+            last['true_mask_c'],
+            last['mask_ignore'],
+        )
+        if not self.workers:
+            self._score(self.metrics, batch_id, masks)
+            return
+        self._raise_error()
+        self.queue.put((batch_id, masks))
+
+    def _score(self, metrics, batch_id, masks):
+        pred_dec_mask, pred_default_mask, true_mask_i, true_mask_c, mask_ignore = masks
+        update_metrics(metrics, pred_dec_mask.long(), pred_default_mask.long(), true_mask_i, true_mask_c, mask_ignore)
+        values = {name: metrics[name].compute_per_sample().cpu() for name in METRIC_NAMES}
+        for metric in metrics.values():
+            metric.reset()
+        with self.lock:
+            self.per_batch[batch_id] = values
+
+    def _work(self):
+        metrics = build_metrics(self.device, keep_per_sample=True, ari_pixels=self.ari_pixels)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # After an error, keep draining the queue so that put() does not block forever.
+            if self.error is None:
+                try:
+                    self._score(metrics, *item)
+                except BaseException as error:
+                    self.error = error
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('Metric computation failed') from self.error
+
+    def close(self):
+        """
+        Waits for the pending batches.
+        return: dict with the per-sample values of METRIC_NAMES, in the order of the batch ids (NaN for unscored samples).
+        """
+        for _ in self.workers:
+            self.queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self._raise_error()
+
+        batch_ids = sorted(self.per_batch)
+        return {name: torch.cat([self.per_batch[b][name] for b in batch_ids]) if batch_ids else torch.zeros(0, dtype=torch.float64)
+                for name in METRIC_NAMES}
+
+
+def reduce_per_sample(per_sample, device):
+    # Mean of the per-sample values over all the processes, skipping the unscored samples.
+    stats = []
+    for name in METRIC_NAMES:
+        values = per_sample[name].to(torch.float64)
+        scored = ~torch.isnan(values)
+        stats.append([values[scored].sum(), scored.sum()])
+    stats = torch.tensor(stats, dtype=torch.float64, device=device)
+    if is_dist_avail_and_initialized():
+        dist.all_reduce(stats)
+    return {name: (stats[i, 0] / stats[i, 1]).item() if stats[i, 1] > 0 else 0. for i, name in enumerate(METRIC_NAMES)}
+
+
+def gather_per_sample(per_sample):
+    # Per-sample values of all the processes.
+    if not is_dist_avail_and_initialized():
+        return per_sample
+    gathered = [None for _ in range(dist.get_world_size())]
+    dist.all_gather_object(gathered, per_sample)
+    return {name: torch.cat([values[name] for values in gathered]) for name in METRIC_NAMES}
+
+
+def bootstrap_ci(values, num_resamples=1000, alpha=0.05, seed=0):
+    # Percentile bootstrap confidence interval of the mean of the per-sample values, skipping the unscored samples.
+    values = values.to(torch.float64)
+    values = values[~torch.isnan(values)]
+    if len(values) == 0:
+        return math.nan, math.nan
+    generator = torch.Generator().manual_seed(seed)
+    means = values[torch.randint(len(values), (num_resamples, len(values)), generator=generator)].mean(1)
+    low, high = torch.quantile(means, torch.tensor([alpha / 2, 1 - alpha / 2], dtype=torch.float64)).tolist()
+    return low, high
+
+
+def dataset_groups(dataset):
+    # Groups of the images for the stratified subsets, e.g. (y, place) for Waterbird, a single one by default.
+    if hasattr(dataset, 'get_group'):
+        return [dataset.get_group(idx) for idx in range(len(dataset))]
+    return [0 for _ in range(len(dataset))]
+
+
+def group_names(dataset):
+    # Name of the group of every image (see dataset_groups), e.g. waterbird_land, for the group-wise metrics.
+    names = getattr(dataset, 'GROUP_NAMES', {})
+    return [names.get(group, str(group)) for group in dataset_groups(dataset)]
+
+
+def group_results(per_sample, sample_groups, all_groups, device):
+    """
+    Metrics (in %) of every group of images as <metric>/<group>, and the one of the worst group as
+    <metric>/worst_group (the lowest over the groups with scored images), NaN for the groups without any.
+    sample_groups: group of each sample of per_sample.
+    all_groups: all the groups of the dataset, the same in every process.
+    """
+    stats = torch.zeros(len(all_groups), len(METRIC_NAMES), 2, dtype=torch.float64)
+    for g, group in enumerate(all_groups):
+        in_group = torch.tensor([sample_group == group for sample_group in sample_groups], dtype=torch.bool)
+        for m, name in enumerate(METRIC_NAMES):
+            values = per_sample[name].to(torch.float64)[in_group]
+            scored = ~torch.isnan(values)
+            stats[g, m, 0] = values[scored].sum()
+            stats[g, m, 1] = scored.sum()
+    stats = stats.to(device)
+    if is_dist_avail_and_initialized():
+        dist.all_reduce(stats)
+    means = (100 * stats[..., 0] / stats[..., 1]).cpu()
+
+    results = {}
+    for m, name in enumerate(METRIC_NAMES):
+        for g, group in enumerate(all_groups):
+            results['{}/{}'.format(name, group)] = means[g, m].item()
+        scored_means = means[stats[:, m, 1].cpu() > 0, m]
+        results['{}/worst_group'.format(name)] = scored_means.min().item() if len(scored_means) else math.nan
+    return results
+
+
+def stratified_subset(groups, num_samples, seed=0):
+    """
+    Indices of a fixed random subset of about num_samples images, in which every group is represented in
+    proportion to its size (and at least once), so that small groups are not missed by the fast validation.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    members = {}
+    for idx, group in enumerate(groups):
+        members.setdefault(group, []).append(idx)
+    fraction = min(1., num_samples / len(groups))
+    indices = []
+    for group in sorted(members):
+        num_group_samples = max(1, round(fraction * len(members[group])))
+        indices += [members[group][i] for i in torch.randperm(len(members[group]), generator=generator)[:num_group_samples].tolist()]
+    return sorted(indices)
+
+
+@torch.no_grad()
+def evaluate_batch(model, batch, mask_size, precision='fp32', tokens=None):
+    """
+    Forward pass of one validation batch (image, true_mask_i, true_mask_c, mask_ignore), see MetricPipeline.put for the metrics.
+    tokens: the model.encode() output for the images, when it is shared with other models.
+    return: (mse, last) with last the predicted and true masks, and the tensors for visualize_batch.
+    """
+    device = next(model.parameters()).device
+    image, true_mask_i, true_mask_c, mask_ignore = [x.to(device) for x in batch]
+
+    with get_autocast(precision, device.type):
+        if tokens is None:
+            mse, default_slots_attns, dec_slots_attns = model(image, outputs=('slots_attns', 'dec_slots_attns'))
+        else:
+            mse, default_slots_attns, dec_slots_attns = model.forward_from_tokens(*tokens, outputs=('slots_attns', 'dec_slots_attns'))
+
+    default_attns, pred_default_mask = masks_from_attns(default_slots_attns, mask_size)
+    dec_attns, pred_dec_mask = masks_from_attns(dec_slots_attns, mask_size)
+
+    last = {
+        'image': image,
+        'true_mask_i': true_mask_i,
+        'true_mask_c': true_mask_c,
+        'mask_ignore': mask_ignore,
+        'default_attns': default_attns,
+        'dec_attns': dec_attns,
+        'pred_default_mask': pred_default_mask,
+        'pred_dec_mask': pred_dec_mask,
+    }
+    return mse.detach(), last
+
+
+@torch.no_grad()
+def evaluate(model, val_loader, mask_size, precision='fp32', max_batches=None, should_stop=None, progress=True, metric_workers=1,
+             bootstrap=0, ari_pixels=None, groups=None):
+    """
+    Computes the validation MSE and the metrics (in %) of `model` over val_loader, or its first max_batches.
+    The metrics of a batch are computed by metric_workers threads during the forward pass of the next ones.
+    With several processes, each one evaluates its shard of the dataset and the results are combined.
+    bootstrap: number of resamples of the images for the 95% confidence intervals of the metrics, added to
+               the results as <metric>_ci_low and <metric>_ci_high (0 disables them).
+    ari_pixels: compute the ARI on this many fixed random pixels of each image (fast approximation).
+    groups: group of every image of val_loader.dataset (see group_names), adds the group_results() of the
+            metrics to the results.
+    return: (results, last) with results a dict with 'mse' and METRIC_NAMES, and last the tensors of the
+            last batch for visualize_batch. Both are None if should_stop() became true in any process.
+    """
+    return evaluate_models([model], val_loader, mask_size, precision, max_batches, should_stop, progress, metric_workers,
+                           bootstrap, ari_pixels, groups)[0]
+
+
+@torch.no_grad()
+def evaluate_models(models, val_loader, mask_size, precision='fp32', max_batches=None, should_stop=None, progress=True, metric_workers=1,
+                    bootstrap=0, ari_pixels=None, groups=None):
+    """
+    evaluate() of several models with the same encoders (e.g. heads with different numbers of slots on a
+    frozen encoder), whose encoder tokens are computed once per batch.
+    return: list with the (results, last) of every model.
+    """
+    for model in models:
+        model.eval()
+    device = next(models[0].parameters()).device
+    pipelines = [MetricPipeline(device, metric_workers, ari_pixels=ari_pixels) for _ in models]
+
+    val_mse = [0. for _ in models]
+    lasts = [None for _ in models]
+    num_batches = 0
+    stopped = False
+
+    for batch_id, batch in enumerate(tqdm(val_loader, disable=not (progress and is_main_process()))):
+        if max_batches is not None and batch_id >= max_batches:
+            break
+        if should_stop is not None and should_stop():
+            stopped = True
+            break
+
+        tokens = None
+        if len(models) > 1:
+            with get_autocast(precision, device.type):
+                tokens = models[0].encode(batch[0].to(device))
+        for i, model in enumerate(models):
+            mse, lasts[i] = evaluate_batch(model, batch, mask_size, precision, tokens)
+            pipelines[i].put(batch_id, lasts[i])
+            val_mse[i] += mse
+        num_batches += 1
+
+    per_sample = [pipeline.close() for pipeline in pipelines]
+
+    # The processes may have a different number of batches, they only synchronize here.
+    stats = torch.tensor([float(mse) for mse in val_mse] + [num_batches, int(stopped)], dtype=torch.float64, device=device)
+    if is_dist_avail_and_initialized():
+        dist.all_reduce(stats)
+    if stats[-1] > 0:
+        return [(None, None) for _ in models]
+
+    if groups is not None:
+        # The images of this process, in the order of the sampler (the loader does not shuffle).
+        sample_groups = [groups[idx] for idx in val_loader.sampler]
+        all_groups = sorted(set(groups))
+
+    outputs = []
+    for i in range(len(models)):
+        results = {'mse': stats[i].item() / stats[-2].item()}
+        for name, value in reduce_per_sample(per_sample[i], device).items():
+            results[name] = 100 * value
+        if bootstrap > 0:
+            all_per_sample = gather_per_sample(per_sample[i])
+            for name in METRIC_NAMES:
+                low, high = bootstrap_ci(all_per_sample[name], bootstrap)
+                results[name + '_ci_low'], results[name + '_ci_high'] = 100 * low, 100 * high
+        if groups is not None:
+            num_samples = len(per_sample[i][METRIC_NAMES[0]])
+            results.update(group_results(per_sample[i], sample_groups[:num_samples], all_groups, device))
+        outputs.append((results, lasts[i]))
+    return outputs
+
+
+def visualize_batch(last, num_slots, mask_size, scale_factor):
+    image = inv_normalize(last['image'])
+    image = F.interpolate(image, size=mask_size, mode='bilinear')
+    default_attns, dec_attns = last['default_attns'], last['dec_attns']
+    rgb_default_attns = image.unsqueeze(1) * default_attns + 1. - default_attns
+    rgb_dec_attns = image.unsqueeze(1) * dec_attns + 1. - dec_attns
+
+    vis_recon = visualize(image, last['true_mask_c'], last['pred_dec_mask'], rgb_dec_attns, last['pred_default_mask'], rgb_default_attns, N=32)
+    grid = vutils.make_grid(vis_recon, nrow=2*num_slots + 4, pad_value=0.2)[:, 2:-2, 2:-2]
+    grid = F.interpolate(grid.unsqueeze(1), scale_factor=scale_factor, mode='bilinear').squeeze() # Lower resolution
+    return grid
+
+
+def check_precision(model, val_loader, mask_size, precision, num_batches, tolerance, seed=0, metric_workers=1):
+    """
+    Regression check of a reduced precision against fp32 on the first num_batches of val_loader (a fixed
+    subset, the validation loader is not shuffled). Both runs use the same random state, so that random
+    slot initializations and permutations match. Raises an error if a metric moves by more than tolerance
+    (in % points).
+    """
+    rng_state = get_rng_state()
+    all_results = {}
+    for current_precision in ['fp32', precision]:
+        torch.manual_seed(seed)
+        random.seed(seed)
+        all_results[current_precision], _ = evaluate(model, val_loader, mask_size, current_precision,
+                                                     max_batches=num_batches, progress=False, metric_workers=metric_workers)
+    set_rng_state(rng_state)
+
+    reference, results = all_results['fp32'], all_results[precision]
+    print('====> {} vs fp32 on {} validation batches:'.format(precision, num_batches))
+    print('\t'.join('{} = {:F} ({:+F})'.format(name, results[name], results[name] - reference[name])
+                    for name in ['mse'] + METRIC_NAMES))
+
+    failed = [name for name in METRIC_NAMES if abs(results[name] - reference[name]) > tolerance]
+    if failed:
+        raise RuntimeError('{} changes {} by more than {} points compared to fp32'.format(
+            precision, ', '.join(failed), tolerance))
+    return results, reference
@@ -0,0 +1,126 @@
+''' Exports a SPOT checkpoint to a standalone inference graph, loaded with spot_inference.py. '''
+
+import copy
+import json
+import time
+import argparse
+
+from PIL import Image
+import torch
+import torch.nn as nn
+import torchvision.transforms.functional as TF
+
+from eval_spot import get_args_parser as get_eval_args_parser, build_dataset, build_model
+from spot_inference import SpotInference
+from utils_spot import bool_flag
+
+IMAGE_MEAN = (0.485, 0.456, 0.406)
+IMAGE_STD = (0.229, 0.224, 0.225)
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT export', add_help=False, parents=[get_eval_args_parser()])
+
+    parser.add_argument('--output', type=str, required=True, help='exported file (.pt for torchscript, .pt2 for export)')
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'export'], help='traced and frozen TorchScript, or torch.export')
+    parser.add_argument('--decoder', type=bool_flag, default=True, help='also run the decoder for its masks (false exports the encoder and the slot attention only)')
+    parser.add_argument('--export_batch_size', type=int, default=2, help='batch size of the example input (torchscript: the batch size stays free; export: the batch dimension is dynamic)')
+    parser.add_argument('--check', type=bool_flag, default=True, help='compare the outputs and the latency of the exported graph to the model')
+    parser.add_argument('--check_image', type=str, default=None, help='also compare the preprocessing of spot_inference.py on this image file to the validation transform of --dataset')
+
+    return parser
+
+
+class SPOTInference(nn.Module):
+    """
+    The inference of SPOT with its choices fixed when it is built: eval mode, the standard or all the patch
+    orders of the decoder ('random' is not deterministic), and with or without the decoder. The forward only
+    takes and returns tensors, so that it can be traced or exported:
+    image (B, 3, H, W) -> slots (B, num_slots, slot_size), slots_attns (B, num_slots, H_enc, W_enc) and,
+    with the decoder, dec_slots_attns (B, num_slots, H_enc, W_enc).
+    """
+    def __init__(self, model, decoder=True):
+        super().__init__()
+        assert model.eval_permutations in ('standard', 'all'), 'random eval_permutations cannot be exported'
+        self.model = copy.deepcopy(model).eval()
+        self.decoder = decoder
+
+    def forward(self, image):
+        model = self.model
+        emb_input = model.forward_encoder(image, model.encoder)
+        slots, slots_attns, _, _ = model.slot_attn(emb_input, return_attn=True)
+        B, N, num_slots = slots_attns.shape
+        H_enc = W_enc = int(N ** 0.5)
+        slots_attns = slots_attns.transpose(-1, -2).reshape(B, num_slots, H_enc, W_enc)
+        if not self.decoder:
+            return slots, slots_attns
+
+        emb_target = model.forward_encoder(image, model.second_encoder) if model.second_encoder is not None else emb_input
+        _, dec_slots_attns = model.forward_decoder(slots, emb_target, return_attns=True)
+        dec_slots_attns = dec_slots_attns.transpose(-1, -2).reshape(B, num_slots, H_enc, W_enc)
+        return slots, slots_attns, dec_slots_attns
+
+
+def export_metadata(args, wrapper):
+    # Stored in the artifact, everything spot_inference.py needs besides the graph.
+    return {
+        'format': args.format,
+        'image_size': args.val_image_size,
+        'mask_size': args.val_mask_size,
+        'num_slots': wrapper.model.num_slots,
+        'image_mean': IMAGE_MEAN,
+        'image_std': IMAGE_STD,
+        'outputs': ['slots', 'slots_attns', 'dec_slots_attns'] if wrapper.decoder else ['slots', 'slots_attns'],
+        'checkpoint': args.checkpoint_path,
+    }
+
+
+@torch.no_grad()
+def export(args):
+    model = build_model(args).to(args.device)
+    wrapper = SPOTInference(model, args.decoder).to(args.device)
+    example = torch.randn(args.export_batch_size, 3, args.val_image_size, args.val_image_size, device=args.device)
+    metadata = json.dumps(export_metadata(args, wrapper))
+
+    if args.format == 'torchscript':
+        traced = torch.jit.trace(wrapper, example, check_trace=False)
+        # Folds the weights and the fixed choices into the graph.
+        exported = torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+        torch.jit.save(exported, args.output, _extra_files={'spot_meta.json': metadata})
+    else:
+        batch = torch.export.Dim('batch', min=1)
+        exported = torch.export.export(wrapper, (example,), dynamic_shapes={'image': {0: batch}})
+        torch.export.save(exported, args.output, extra_files={'spot_meta.json': metadata})
+        exported = exported.module()
+    print('====> Exported {} to {}'.format(args.checkpoint_path, args.output))
+
+    if args.check:
+        image = torch.randn(args.export_batch_size + 1, 3, args.val_image_size, args.val_image_size, device=args.device)
+        # The same slot initialization in both (the shared_gaussian initialization is random).
+        torch.manual_seed(args.seed)
+        expected = wrapper(image)
+        torch.manual_seed(args.seed)
+        outputs = exported(image)
+        for name, e, o in zip(export_metadata(args, wrapper)['outputs'], expected, outputs):
+            print('{}: max abs difference to the model {:.2e}'.format(name, (e - o).abs().max().item()))
+
+        for name, module in [('model', wrapper), ('exported', exported)]:
+            module(image)
+            start = time.perf_counter()
+            for _ in range(5):
+                module(image)
+            print('{}: {:.1f} ms per batch of {}'.format(name, 1000 * (time.perf_counter() - start) / 5, len(image)))
+
+    if args.check_image is not None:
+        pil_image = Image.open(args.check_image).convert('RGB')
+        expected = build_dataset(args).val_transform_image(pil_image)
+        preprocessed = SpotInference(args.output, args.device).preprocess(TF.to_tensor(pil_image)[None])[0].cpu()
+        difference = (expected - preprocessed).abs()
+        print('preprocessing of {} ({}x{}): max abs difference to the validation transform {:.2e}, mean {:.2e}'.format(
+            args.check_image, pil_image.width, pil_image.height, difference.max().item(), difference.mean().item()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT export', parents=[get_args_parser()])
+    args = parser.parse_args()
+    export(args)
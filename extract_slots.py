@@ -0,0 +1,173 @@
+''' Extracts the slots of a checkpoint over a dataset split into a chunked, memory-mapped store. '''
+
+import os
+import json
+import random
+import argparse
+
+import numpy as np
+from tqdm import tqdm
+import torch
+from torch.utils.data import DataLoader, Subset
+
+from datasets import PascalVOC, COCO2017, MOVi, Waterbird
+from eval_spot import get_args_parser as get_eval_args_parser, build_dataset, build_model
+from utils_spot import get_autocast
+
+COLUMNS = ('slots', 'assignments', 'ids', 'groups')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT slot extraction', add_help=False, parents=[get_eval_args_parser()])
+
+    parser.add_argument('--split', type=str, default='val', help='val or train (the training images are extracted without augmentations)')
+    parser.add_argument('--out_dir', type=str, required=True, help='directory of the store, an interrupted extraction into it is continued')
+    parser.add_argument('--chunk_size', type=int, default=4096, help='images per chunk, a multiple of eval_batch_size (the memory use is bounded by one chunk)')
+    parser.add_argument('--dtype', type=str, default='float16', choices=['float16', 'float32'], help='dtype of the stored slots')
+
+    return parser
+
+
+def build_split(args):
+    if args.split == 'val':
+        return build_dataset(args)
+    if args.dataset == 'voc':
+        dataset = PascalVOC(root=args.data_path, split='trainaug', image_size=args.val_image_size, mask_size=args.val_mask_size)
+    elif args.dataset == 'coco':
+        dataset = COCO2017(root=args.data_path, split='train', image_size=args.val_image_size, mask_size=args.val_mask_size)
+    elif args.dataset == 'movi':
+        dataset = MOVi(root=os.path.join(args.data_path, 'train'), split='train', image_size=args.val_image_size, mask_size=args.val_mask_size, frames_per_clip=9)
+    elif args.dataset == 'waterbird':
+        dataset = Waterbird(root=args.data_path, split='train', image_size=args.val_image_size, mask_size=args.val_mask_size)
+    # The deterministic transform of the validation images instead of the random crops and flips.
+    if hasattr(dataset, 'val_transform_image'):
+        dataset.train_transform = dataset.val_transform_image
+    return dataset
+
+
+def save_array(path, array):
+    # Written to a temporary file first, so that an interrupted extraction never leaves a truncated chunk.
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, array)
+    os.replace(path + '.tmp', path)
+
+
+def save_manifest(out_dir, manifest):
+    path = os.path.join(out_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def chunk_path(out_dir, column, chunk):
+    return os.path.join(out_dir, '{}_{:05d}.npy'.format(column, chunk))
+
+
+class SlotStore(object):
+    """
+    Reader of the extract_slots.py output. Every chunk holds, for chunk_size images:
+    slots (images, num_slots, slot_size), assignments (images, num_tokens) the slot of every encoder token,
+    ids (images,) the dataset image ids and groups (images, len(group_fields)), e.g. y and place on Waterbird.
+    The chunks are memory-mapped, only what is read is loaded.
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'manifest.json')) as f:
+            self.manifest = json.load(f)
+        self.chunks = [{column: np.load(chunk_path(path, column, chunk), mmap_mode='r') for column in COLUMNS}
+                       for chunk in range(len(self.manifest['chunks']))]
+
+    def __len__(self):
+        return sum(self.manifest['chunks'])
+
+    @property
+    def complete(self):
+        return self.manifest['complete']
+
+    def iter_chunks(self, columns=COLUMNS):
+        for chunk in self.chunks:
+            yield {column: chunk[column] for column in columns}
+
+    def load(self, column):
+        # The whole column in memory, e.g. the ids and groups for the analyses.
+        if not self.chunks:
+            return np.zeros(0)
+        return np.concatenate([np.asarray(chunk[column]) for chunk in self.chunks])
+
+    def group_field(self, name):
+        # One group field of every image, e.g. group_field('y') on Waterbird.
+        return self.load('groups')[:, self.manifest['group_fields'].index(name)]
+
+
+@torch.no_grad()
+def extract(args):
+    assert args.chunk_size % args.eval_batch_size == 0, 'chunk_size must be a multiple of eval_batch_size'
+    os.makedirs(args.out_dir, exist_ok=True)
+    dataset = build_split(args)
+    model = build_model(args).to(args.device).eval()
+    device = torch.device(args.device)
+
+    manifest_path = os.path.join(args.out_dir, 'manifest.json')
+    settings = {
+        'checkpoint': os.path.abspath(args.checkpoint_path),
+        'dataset': args.dataset,
+        'split': args.split,
+        'num_images': len(dataset),
+        'chunk_size': args.chunk_size,
+        'eval_batch_size': args.eval_batch_size,
+        'dtype': args.dtype,
+        'group_fields': list(getattr(dataset, 'GROUP_FIELDS', ['group'])),
+        'seed': args.seed,
+        'init_method': args.init_method,
+    }
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        manifest.setdefault('init_method', args.init_method) # stores extracted before it was recorded
+        assert all(manifest[k] == v for k, v in settings.items()), 'the store in {} was extracted with other settings'.format(args.out_dir)
+    else:
+        manifest = dict(settings, chunks=[], complete=False)
+
+    # Resumable cursor: the images of the complete chunks are not extracted again.
+    cursor = sum(manifest['chunks'])
+    print('====> {} of {} images already extracted to {}'.format(cursor, len(dataset), args.out_dir))
+    loader = DataLoader(Subset(dataset, range(cursor, len(dataset))), shuffle=False, drop_last=False,
+                        batch_size=args.eval_batch_size, num_workers=args.num_workers, pin_memory=True)
+
+    buffer = {column: [] for column in COLUMNS}
+    index = cursor
+    for batch in tqdm(loader):
+        image = batch[0] if isinstance(batch, (list, tuple)) else batch
+        # Seeded by the position of the batch, so that a resumed extraction gives the same slots.
+        batch_id = index // args.eval_batch_size
+        torch.manual_seed(args.seed + batch_id)
+        random.seed(args.seed + batch_id)
+        with get_autocast(args.precision, device.type):
+            _, slots, slots_attns = model.get_embeddings_n_slots(image.to(device))
+
+        buffer['slots'].append(slots.float().cpu().numpy().astype(args.dtype))
+        buffer['assignments'].append(slots_attns.argmax(-1).to(torch.uint8).cpu().numpy())
+        indices = range(index, index + image.shape[0])
+        buffer['ids'] += [str(dataset.get_image_id(i)) for i in indices]
+        buffer['groups'] += [np.atleast_1d(dataset.get_group(i) if hasattr(dataset, 'get_group') else 0) for i in indices]
+        index += image.shape[0]
+
+        if len(buffer['ids']) == args.chunk_size or index == len(dataset):
+            chunk = len(manifest['chunks'])
+            save_array(chunk_path(args.out_dir, 'slots', chunk), np.concatenate(buffer['slots']))
+            save_array(chunk_path(args.out_dir, 'assignments', chunk), np.concatenate(buffer['assignments']))
+            save_array(chunk_path(args.out_dir, 'ids', chunk), np.array(buffer['ids']))
+            save_array(chunk_path(args.out_dir, 'groups', chunk), np.stack(buffer['groups']).astype(np.int64))
+            manifest['chunks'].append(len(buffer['ids']))
+            save_manifest(args.out_dir, manifest)
+            buffer = {column: [] for column in COLUMNS}
+
+    manifest['complete'] = True
+    save_manifest(args.out_dir, manifest)
+    print('====> {} images extracted to {}'.format(len(dataset), args.out_dir))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT slot extraction', parents=[get_args_parser()])
+    args = parser.parse_args()
+    extract(args)
@@ -2,6 +2,7 @@
 
 import torch
 from torch import nn
+from utils_spot import resize_pos_embed
 
 class MlpDecoder(nn.Module):
     """Decoder that takes object representations and reconstructs patches.
@@ -9,7 +10,8 @@ class MlpDecoder(nn.Module):
     Args:
         object_dim: Dimension of objects representations.
         output_dim: Dimension of each patch.
-        num_patches: Number of patches P to reconstruct.
+        num_patches: Number of patches P to reconstruct at the training resolution. Other numbers of
+            patches can be requested in forward, the position embeddings are then interpolated.
         hidden_features: Dimension of hidden layers.
     """
 
@@ -21,15 +23,18 @@ class MlpDecoder(nn.Module):
         self.pos_embed = nn.Parameter(torch.randn(1, num_patches, object_dim) * 0.02)
         self.decoder = build_mlp(object_dim, output_dim + 1, hidden_features)
 
-    def forward(self, encoder_output):
+    def forward(self, encoder_output, num_patches=None):
+
+        if num_patches is None:
+            num_patches = self.num_patches
 
         initial_shape = encoder_output.shape[:-1]
         encoder_output = encoder_output.flatten(0, -2)
 
-        encoder_output = encoder_output.unsqueeze(1).expand(-1, self.num_patches, -1)
+        encoder_output = encoder_output.unsqueeze(1).expand(-1, num_patches, -1)
 
         # Simple learned additive embedding as in ViT
-        object_features = encoder_output + self.pos_embed
+        object_features = encoder_output + resize_pos_embed(self.pos_embed, num_patches)
 
         output = self.decoder(object_features)
         output = output.unflatten(0, initial_shape)
@@ -15,6 +15,8 @@ import torch.nn as nn
 
 import timm.models.vision_transformer
 
+from utils_spot import resize_pos_embed
+
 
 class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
     """ Vision Transformer with support for global average pooling
@@ -29,14 +31,22 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
             self.fc_norm = norm_layer(embed_dim)
 
             del self.norm  # remove the original norm
+
+        # Accept other image sizes than the pretraining one, the position embeddings are interpolated.
+        if hasattr(self.patch_embed, 'strict_img_size'):
+            self.patch_embed.strict_img_size = False
     
     def prepare_tokens(self, x):
         B = x.shape[0]
         x = self.patch_embed(x)
 
+        pos_embed = self.pos_embed
+        if x.shape[1] + 1 != pos_embed.shape[1]:
+            pos_embed = torch.cat((pos_embed[:, :1], resize_pos_embed(pos_embed[:, 1:], x.shape[1])), dim=1)
+
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
-        x = x + self.pos_embed
+        x = x + pos_embed
         x = self.pos_drop(x)
         return x
 
@@ -7,6 +7,7 @@ https://github.com/amazon-science/object-centric-learning-framework/tree/main/oc
 import math
 import torch
 import torchmetrics
+from torchmetrics.utilities import dim_zero_cat
 from torch import nn
 import scipy.optimize
 import torch.nn.functional as F
@@ -141,23 +142,45 @@ def resize_patches_to_image(
 
     return image.view(*patches.shape[:-1], image.shape[-2], image.shape[-1])
 
+def aggregate_per_sample(values: torch.Tensor) -> torch.Tensor:
+    """Mean of per-sample values (float64, on the cpu so that the result does not depend on how
+    the samples were split in batches or processes), skipping the NaN of unscored samples."""
+    values = values.detach().to("cpu", torch.float64)
+    values = values[~torch.isnan(values)]
+    if len(values) == 0:
+        return torch.zeros((), dtype=torch.float64)
+    return values.sum() / len(values)
+
+
 class ARIMetric(torchmetrics.Metric):
-    """Computes ARI metric."""
+    """Computes ARI metric.
+
+    Args:
+        keep_per_sample: If true, also keep the value of every sample (see `compute_per_sample`).
+        num_pixels: If set, compute the ARI on a fixed random subset of this many pixels (an
+            approximation for fast validation).
+    """
 
     def __init__(
         self,
         foreground: bool = True,
         convert_target_one_hot: bool = False,
         ignore_overlaps: bool = False,
+        keep_per_sample: bool = False,
+        num_pixels: Optional[int] = None,
     ):
         super().__init__()
         self.foreground = foreground
         self.convert_target_one_hot = convert_target_one_hot
         self.ignore_overlaps = ignore_overlaps
+        self.keep_per_sample = keep_per_sample
+        self.num_pixels = num_pixels
         self.add_state(
             "values", default=torch.tensor(0.0, dtype=torch.float64), dist_reduce_fx="sum"
         )
         self.add_state("total", default=torch.tensor(0), dist_reduce_fx="sum")
+        if keep_per_sample:
+            self.add_state("per_sample", default=[], dist_reduce_fx="cat")
 
     def update(
         self, prediction: torch.Tensor, target: torch.Tensor, ignore: Optional[torch.Tensor] = None
@@ -199,6 +222,13 @@ class ARIMetric(torchmetrics.Metric):
             target = target.clone()
             target[ignore.expand_as(target)] = 0
 
+        if self.num_pixels is not None and prediction.shape[-1] > self.num_pixels:
+            # The same pixels for every batch.
+            generator = torch.Generator().manual_seed(0)
+            pixels = torch.randperm(prediction.shape[-1], generator=generator)[: self.num_pixels]
+            prediction = prediction[..., pixels.to(prediction.device)]
+            target = target[..., pixels.to(target.device)]
+
         # Make channels / gt labels the last dimension.
         prediction = prediction.transpose(-2, -1)
         target = target.transpose(-2, -1)
@@ -220,10 +250,16 @@ class ARIMetric(torchmetrics.Metric):
 
         self.values += ari.sum()
         self.total += len(ari)
+        if self.keep_per_sample:
+            self.per_sample.append(ari.to(torch.float64))
 
     def compute(self) -> torch.Tensor:
         return self.values / self.total
 
+    def compute_per_sample(self) -> torch.Tensor:
+        """Values of the samples in the order of the updates."""
+        return dim_zero_cat(self.per_sample)
+
 
 class PatchARIMetric(ARIMetric):
     """Computes ARI metric assuming patch masks as input."""
@@ -277,6 +313,8 @@ class UnsupervisedMaskIoUMetric(torchmetrics.Metric):
             that is removed before computing IoU.
         ignore_overlaps: If true, remove points where ground truth masks has overlappign classes from
             predictions and ground truth masks.
+        keep_per_sample: If true, also keep the value of every sample (see `compute_per_sample`),
+            NaN for the samples without any target mask.
     """
 
     def __init__(
@@ -289,6 +327,7 @@ class UnsupervisedMaskIoUMetric(torchmetrics.Metric):
         discovery_threshold: float = 0.5,
         ignore_background: bool = False,
         ignore_overlaps: bool = False,
+        keep_per_sample: bool = False,
     ):
         super().__init__()
         self.use_threshold = use_threshold
@@ -307,11 +346,14 @@ class UnsupervisedMaskIoUMetric(torchmetrics.Metric):
         self.matching = matching
         self.ignore_background = ignore_background
         self.ignore_overlaps = ignore_overlaps
+        self.keep_per_sample = keep_per_sample
 
         self.add_state(
             "values", default=torch.tensor(0.0, dtype=torch.float64), dist_reduce_fx="sum"
         )
         self.add_state("total", default=torch.tensor(0), dist_reduce_fx="sum")
+        if keep_per_sample:
+            self.add_state("per_sample", default=[], dist_reduce_fx="cat")
 
     def update(
         self, prediction: torch.Tensor, target: torch.Tensor, ignore: Optional[torch.Tensor] = None
@@ -366,10 +408,12 @@ class UnsupervisedMaskIoUMetric(torchmetrics.Metric):
         # Should be either 0 (empty, padding) or 1 (single object).
         assert torch.all(targets.sum(dim=1) < 2), "Issues with target format, mask non-exclusive"
 
+        per_sample = []
         for pred, target in zip(predictions, targets):
             nonzero_classes = torch.sum(target, dim=-1) > 0
             target = target[nonzero_classes]  # Remove empty (e.g. padded) classes
             if len(target) == 0:
+                per_sample.append(math.nan)
                 continue  # Skip elements without any target mask
 
             iou_per_class = unsupervised_mask_iou(
@@ -378,13 +422,20 @@ class UnsupervisedMaskIoUMetric(torchmetrics.Metric):
 
             if self.compute_discovery_fraction:
                 discovered = iou_per_class > self.discovery_threshold
-                self.values += discovered.sum() / len(discovered)
+                value = discovered.sum() / len(discovered)
             elif self.correct_localization:
                 correctly_localized = torch.any(iou_per_class > self.discovery_threshold)
-                self.values += correctly_localized.sum()
+                value = correctly_localized.sum()
             else:
-                self.values += iou_per_class.mean()
+                value = iou_per_class.mean()
+            self.values += value
             self.total += 1
+            per_sample.append(value)
+
+        if self.keep_per_sample:
+            self.per_sample.append(
+                torch.stack([torch.as_tensor(v, dtype=torch.float64, device=self.values.device) for v in per_sample])
+            )
 
     def compute(self) -> torch.Tensor:
         if self.total == 0:
@@ -392,6 +443,10 @@ class UnsupervisedMaskIoUMetric(torchmetrics.Metric):
         else:
             return self.values / self.total
 
+    def compute_per_sample(self) -> torch.Tensor:
+        """Values of the samples in the order of the updates, NaN for the skipped ones."""
+        return dim_zero_cat(self.per_sample)
+
 
 class MaskCorLocMetric(UnsupervisedMaskIoUMetric):
     def __init__(self, **kwargs):
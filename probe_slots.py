@@ -0,0 +1,165 @@
+''' Linear probes of the group labels (y and place on Waterbird) on the slots extracted with extract_slots.py. '''
+
+import argparse
+
+import numpy as np
+import pandas as pd
+import torch
+import torch.nn.functional as F
+
+from extract_slots import SlotStore
+from utils_spot import bool_flag
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT slot probes', add_help=False)
+
+    parser.add_argument('--train_store', type=str, required=True, help='extract_slots.py output of the training images')
+    parser.add_argument('--val_store', type=str, required=True, help='extract_slots.py output of the evaluation images')
+    parser.add_argument('--labels', type=str, default='y,place', help='comma separated group fields of the stores to predict')
+    parser.add_argument('--l2', type=float, default=1e-2, help='L2 regularization of the probe weights')
+    parser.add_argument('--iters', type=int, default=25, help='maximum Newton iterations')
+    parser.add_argument('--group_balanced', type=bool_flag, default=True, help='reweight the training images so that every group weighs the same (group-robust probes)')
+    parser.add_argument('--device', type=str, default='cpu', help='cuda or cpu')
+
+    return parser
+
+
+def probe_features(slots, per_slot=True):
+    """
+    slots: (images, num_slots, slot_size).
+    return: dict of the feature variants (num_models, images, features) of the probes: the mean of the slots
+            (pooled) and, with per_slot, every slot on its own (stacked so that they are fitted together).
+    """
+    features = {'pooled': slots.mean(1, keepdim=True).transpose(0, 1)}
+    if per_slot:
+        features['slot'] = slots.transpose(0, 1)
+    return features
+
+
+def slots_match(train_manifest, val_manifest):
+    # Slot i is the same slot on every image only with the learned initialization of the slots (embedding) of
+    # one checkpoint, the shared_gaussian slots are samples of the same distribution in a random order.
+    return (train_manifest.get('init_method') == 'embedding' and val_manifest.get('init_method') == 'embedding'
+            and train_manifest['checkpoint'] == val_manifest['checkpoint'])
+
+
+def group_weights(groups):
+    # Weights of the images giving every group the same total weight, with a mean of 1.
+    _, inverse, counts = np.unique(groups, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    return len(groups) / (len(counts) * counts[inverse])
+
+
+def logistic_loss(x, y, weights, reg, w):
+    # Weighted L2-regularized negative log-likelihood of every model (x with the bias column).
+    logits = torch.einsum('mnf,mf->mn', x, w)
+    nll = F.binary_cross_entropy_with_logits(logits, y.expand_as(logits), reduction='none')
+    return (weights * nll).sum(1) + 0.5 * (reg * w * w).sum(1)
+
+
+def fit_logistic(x, y, weights, l2=1e-2, iters=25, tol=1e-8, max_halvings=30):
+    """
+    Weighted L2-regularized logistic regressions fitted with full-batch Newton steps, all the models at once.
+    Every step is halved until it decreases the loss of its model enough (backtracking line search), so that
+    the fit converges on separable or badly scaled features.
+    x: (num_models, images, features) standardized features, y: (images,) 0/1 labels, weights: (images,).
+    return: (num_models, features + 1) weights, the last one is the bias (not regularized).
+    """
+    num_models, _, num_features = x.shape
+    x = torch.cat([x, torch.ones_like(x[..., :1])], -1)
+    w = torch.zeros(num_models, num_features + 1, dtype=x.dtype, device=x.device)
+    reg = torch.full((num_features + 1,), l2, dtype=x.dtype, device=x.device)
+    reg[-1] = 0.
+    loss = logistic_loss(x, y, weights, reg, w)
+    for _ in range(iters):
+        p = torch.sigmoid(torch.einsum('mnf,mf->mn', x, w))
+        grad = torch.einsum('mnf,mn->mf', x, weights * (p - y)) + reg * w
+        hessian = (x * (weights * p * (1 - p)).unsqueeze(-1)).transpose(1, 2) @ x + torch.diag(reg + 1e-8)
+        step = torch.linalg.solve(hessian, grad.unsqueeze(-1)).squeeze(-1)
+        # Armijo condition on the decrease predicted by the gradient, checked for every model.
+        decrease = (grad * step).sum(1)
+        t = torch.ones(num_models, dtype=x.dtype, device=x.device)
+        for _ in range(max_halvings):
+            new_w = w - t.unsqueeze(1) * step
+            new_loss = logistic_loss(x, y, weights, reg, new_w)
+            rejected = new_loss > loss - 1e-4 * t * decrease
+            if not rejected.any():
+                break
+            t = torch.where(rejected, t / 2, t)
+        converged = (new_w - w).abs().max() < tol
+        w, loss = new_w, new_loss
+        if converged:
+            break
+    return w
+
+
+def predict(x, w):
+    x = torch.cat([x, torch.ones_like(x[..., :1])], -1)
+    return torch.einsum('mnf,mf->mn', x, w) > 0
+
+
+def group_accuracies(correct, groups):
+    """
+    correct: (num_models, images) bool, groups: (images, num_fields) group labels.
+    return: (accuracy, worst group accuracy, accuracy of every group) of every model in %, and the groups.
+    """
+    unique, inverse = np.unique(groups, axis=0, return_inverse=True)
+    inverse = torch.as_tensor(inverse.reshape(-1), device=correct.device)
+    per_group = torch.stack([correct[:, inverse == g].double().mean(1) for g in range(len(unique))], 1)
+    return 100 * correct.double().mean(1), 100 * per_group.min(1).values, 100 * per_group, [tuple(g) for g in unique.tolist()]
+
+
+def load_store(path, device):
+    store = SlotStore(path)
+    assert store.complete, '{} is not completely extracted'.format(path)
+    slots = torch.as_tensor(store.load('slots'), dtype=torch.float64, device=device)
+    return store, slots, store.load('groups')
+
+
+def main(args):
+    device = torch.device(args.device)
+    train_store, train_slots, train_groups = load_store(args.train_store, device)
+    val_store, val_slots, val_groups = load_store(args.val_store, device)
+    group_fields = train_store.manifest['group_fields']
+    per_slot = slots_match(train_store.manifest, val_store.manifest)
+    if not per_slot:
+        print('====> No per-slot probes: the slots of the stores only match with init_method embedding and the same checkpoint')
+
+    weights = group_weights(train_groups) if args.group_balanced else np.ones(len(train_groups))
+    weights = torch.as_tensor(weights, dtype=torch.float64, device=device)
+
+    rows, index = [], []
+    train_features, val_features = probe_features(train_slots, per_slot), probe_features(val_slots, per_slot)
+    for variant in train_features:
+        # Standardized with the statistics of the training images.
+        mean = train_features[variant].mean(1, keepdim=True)
+        std = train_features[variant].std(1, keepdim=True) + 1e-6
+        x_train = (train_features[variant] - mean) / std
+        x_val = (val_features[variant] - mean) / std
+
+        num_models = x_train.shape[0]
+        variant_rows = [{} for _ in range(num_models)]
+        for label in args.labels.split(','):
+            field = group_fields.index(label)
+            y_train = torch.as_tensor(train_groups[:, field], dtype=torch.float64, device=device)
+            y_val = torch.as_tensor(val_groups[:, field], dtype=torch.bool, device=device)
+            w = fit_logistic(x_train, y_train, weights, args.l2, args.iters)
+            accuracy, worst, per_group, names = group_accuracies(predict(x_val, w) == y_val, val_groups)
+            for m in range(num_models):
+                variant_rows[m]['{} acc'.format(label)] = accuracy[m].item()
+                variant_rows[m]['{} worst'.format(label)] = worst[m].item()
+                for g, name in enumerate(names):
+                    variant_rows[m]['{} {}'.format(label, name)] = per_group[m, g].item()
+        rows += variant_rows
+        index += [variant] if num_models == 1 else ['slot {}'.format(m) for m in range(num_models)]
+
+    df_results = pd.DataFrame(rows, index=index)
+    print('Groups: {} ({} training and {} evaluation images)'.format(tuple(group_fields), len(train_groups), len(val_groups)))
+    print(df_results.to_string(float_format='{:.2f}'.format))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT slot probes', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
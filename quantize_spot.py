@@ -0,0 +1,108 @@
+''' Int8 dynamic quantization of SPOT for CPU inference, validated against fp32 on a fixed subset. '''
+
+import copy
+import time
+import argparse
+
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+
+from eval_spot import get_args_parser as get_eval_args_parser, build_dataset, build_model
+from evaluation import evaluate, stratified_subset, dataset_groups
+
+# Linear and GRU cell layers of each part, by module name.
+QUANTIZED_PARTS = {
+    'slot_attn': lambda name: name.startswith('slot_attn.'),
+    'decoder': lambda name: name.startswith(('dec.', 'slot_proj.', 'input_proj.')),
+    'encoder_mlp': lambda name: name.startswith(('encoder.', 'second_encoder.')) and '.mlp.' in name,
+    'encoder_attn': lambda name: name.startswith(('encoder.', 'second_encoder.')) and '.attn.' in name,
+}
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT quantization', add_help=False, parents=[get_eval_args_parser()])
+    parser.set_defaults(device='cpu')
+
+    parser.add_argument('--parts', type=str, default='slot_attn,decoder,encoder_mlp', help='comma separated parts whose layers are quantized: ' + ', '.join(QUANTIZED_PARTS))
+    parser.add_argument('--num_images', type=int, default=256, help='size of the fixed validation subset (stratified by group on Waterbird)')
+    parser.add_argument('--max_drop', type=float, default=1.0, help='largest allowed drop of mBO_i, mBO_c and FG-ARI relative to fp32, in %% points')
+    parser.add_argument('--bench_iters', type=int, default=10, help='timed forward passes of one eval_batch_size batch')
+    parser.add_argument('--threads', type=int, default=None, help='intra-op threads of the benchmark, by default all the cpu cores')
+    parser.add_argument('--output', type=str, default=None, help='save the state dict of the quantized model here if it is within max_drop (load it with load_quantized)')
+
+    return parser
+
+
+def quantize_model(model, parts):
+    """
+    Copy of the model whose nn.Linear and nn.GRUCell layers of the given parts (see QUANTIZED_PARTS) have int8
+    weights, the activations are quantized on the fly (CPU only).
+    """
+    names = [name for name, module in model.named_modules()
+             if isinstance(module, (nn.Linear, nn.GRUCell)) and any(QUANTIZED_PARTS[part](name) for part in parts)]
+    qconfig = torch.ao.quantization.default_dynamic_qconfig
+    return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).eval(), {name: qconfig for name in names}, dtype=torch.qint8)
+
+
+def load_quantized(args, path, parts):
+    # The quantized model of a saved state dict: the layers are quantized first, then the weights are loaded.
+    model = quantize_model(build_model(args), parts)
+    model.load_state_dict(torch.load(path, map_location='cpu'))
+    return model
+
+
+@torch.no_grad()
+def benchmark(model, image, iters):
+    model(image, outputs=('slots_attns', 'dec_slots_attns'))
+    start = time.perf_counter()
+    for _ in range(iters):
+        model(image, outputs=('slots_attns', 'dec_slots_attns'))
+    return 1000 * (time.perf_counter() - start) / (iters * len(image))
+
+
+def main(args):
+    assert args.device == 'cpu', 'dynamic quantization runs on the cpu'
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    parts = args.parts.split(',')
+
+    val_dataset = build_dataset(args)
+    subset = Subset(val_dataset, stratified_subset(dataset_groups(val_dataset), args.num_images, seed=args.seed))
+    val_loader = DataLoader(subset, shuffle=False, drop_last=False, batch_size=args.eval_batch_size, num_workers=args.num_workers)
+    image = torch.stack([subset[i][0] for i in range(min(args.eval_batch_size, len(subset)))])
+
+    model = build_model(args).eval()
+    configs = [('fp32', model)] + [(part, quantize_model(model, [part])) for part in parts]
+    if len(parts) > 1:
+        configs.append(('+'.join(parts), quantize_model(model, parts)))
+
+    rows = []
+    for name, config_model in configs:
+        # The same slot initialization and patch orders for every configuration.
+        torch.manual_seed(args.seed)
+        results, _ = evaluate(config_model, val_loader, args.val_mask_size, metric_workers=args.metric_workers)
+        rows.append([results['mbo_i'], results['mbo_c'], results['ari'], results['ari_slot'], results['mse'],
+                     benchmark(config_model, image, args.bench_iters)])
+
+    df_results = pd.DataFrame(rows, index=[name for name, _ in configs], columns=['mBO_i', 'mBO_c', 'FG-ARI', 'FG-ARI_slots', 'MSE', 'ms/image'])
+    for column in ['mBO_i', 'mBO_c', 'FG-ARI']:
+        df_results['d_' + column] = df_results[column] - df_results.loc['fp32', column]
+    df_results['speedup'] = df_results.loc['fp32', 'ms/image'] / df_results['ms/image']
+    print('Dynamic int8 quantization on {} validation images:'.format(len(subset)))
+    print(df_results.to_string(float_format='{:.3f}'.format))
+
+    quantized_name = configs[-1][0]
+    max_drop = -df_results.loc[quantized_name, ['d_mBO_i', 'd_mBO_c', 'd_FG-ARI']].min()
+    if max_drop > args.max_drop:
+        print('====> {} drops the metrics by up to {:.2f} points (more than --max_drop {})'.format(quantized_name, max_drop, args.max_drop))
+    elif args.output is not None:
+        torch.save(configs[-1][1].state_dict(), args.output)
+        print('====> Saved the {} quantized model to {}'.format(quantized_name, args.output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT quantization', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
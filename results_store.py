@@ -0,0 +1,87 @@
+''' Per-image evaluation results, stored in SQLite. '''
+
+import json
+import math
+import sqlite3
+import hashlib
+
+import torch
+
+from ocl_metrics import aggregate_per_sample
+from evaluation import METRIC_NAMES
+
+
+def file_sha1(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def settings_key(settings):
+    # Canonical string of the evaluation settings, the same settings always give the same key.
+    return json.dumps(settings, sort_keys=True)
+
+
+class ResultsStore:
+    """
+    Metrics of every evaluated image (METRIC_NAMES, NULL for the images without any target mask), keyed by
+    the checkpoint hash, the dataset, the evaluation settings and the image id.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        columns = ', '.join('{} REAL'.format(name) for name in METRIC_NAMES)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS image_results (checkpoint TEXT, dataset TEXT, settings TEXT, image_id TEXT, {}, '
+                'PRIMARY KEY (checkpoint, dataset, settings, image_id))'.format(columns))
+
+    def scored_ids(self, checkpoint, dataset, settings):
+        rows = self.connection.execute(
+            'SELECT image_id FROM image_results WHERE checkpoint = ? AND dataset = ? AND settings = ?',
+            (checkpoint, dataset, settings_key(settings)))
+        return {image_id for image_id, in rows}
+
+    def add(self, checkpoint, dataset, settings, image_ids, per_sample):
+        """
+        Stores the per-sample values (dict of METRIC_NAMES to tensors aligned with image_ids), replacing the
+        ones of images already in the store.
+        """
+        values = torch.stack([per_sample[name].to(torch.float64) for name in METRIC_NAMES], 1).tolist()
+        rows = [(checkpoint, dataset, settings_key(settings), image_id) + tuple(None if math.isnan(v) else v for v in row)
+                for image_id, row in zip(image_ids, values)]
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO image_results VALUES ({})'.format(', '.join(['?'] * (4 + len(METRIC_NAMES)))), rows)
+
+    def get(self, checkpoint, dataset, settings, image_ids=None):
+        """
+        return: (image_ids, per_sample) for the stored images, or those of image_ids, in the order of image_ids
+                (sorted by id by default), with NaN for the images without any target mask.
+        """
+        rows = self.connection.execute(
+            'SELECT image_id, {} FROM image_results WHERE checkpoint = ? AND dataset = ? AND settings = ?'.format(
+                ', '.join(METRIC_NAMES)), (checkpoint, dataset, settings_key(settings)))
+        stored = {row[0]: row[1:] for row in rows}
+        if image_ids is None:
+            image_ids = sorted(stored)
+        else:
+            image_ids = [image_id for image_id in image_ids if image_id in stored]
+
+        values = torch.tensor([[math.nan if v is None else v for v in stored[image_id]] for image_id in image_ids],
+                              dtype=torch.float64).reshape(len(image_ids), len(METRIC_NAMES))
+        return image_ids, {name: values[:, i] for i, name in enumerate(METRIC_NAMES)}
+
+    def aggregate(self, checkpoint, dataset, settings, image_ids=None):
+        """
+        Metrics (in %) over the stored images, or the subset image_ids, as the mean of their per-image values.
+        return: (results, num_images)
+        """
+        image_ids, per_sample = self.get(checkpoint, dataset, settings, image_ids)
+        results = {name: 100 * aggregate_per_sample(per_sample[name]).item() for name in METRIC_NAMES}
+        return results, len(image_ids)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,227 @@
+''' Local inference server of SPOT, batching the concurrent requests. '''
+
+import io
+import json
+import math
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+import torch
+import torchvision.transforms as transforms
+
+from eval_spot import get_args_parser as get_eval_args_parser, build_model
+from evaluation import masks_from_attns
+from utils_spot import get_autocast
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT server', add_help=False, parents=[get_eval_args_parser()])
+
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max_batch_size', type=int, default=32)
+    parser.add_argument('--max_delay_ms', type=float, default=10., help='longest wait for a batch to fill after its first request')
+    parser.add_argument('--max_queue', type=int, default=256, help='requests waiting for the model, the next ones get a 503 (backpressure)')
+    parser.add_argument('--preprocess_threads', type=int, default=4, help='threads decoding the images and encoding the responses')
+    parser.add_argument('--max_body_bytes', type=int, default=32 * 1024 * 1024, help='larger request bodies get a 413')
+
+    return parser
+
+
+class MicroBatcher(object):
+    """
+    Queues the preprocessed images and runs them through the model in batches of at most max_batch_size, waiting
+    at most max_delay for a batch to fill after its first image. The model runs in a single worker thread, so
+    that the event loop keeps accepting requests, and submit() raises asyncio.QueueFull once max_queue images
+    are waiting.
+    All the images of a batch go through the encoder and the slot attention, the decoder (and the target
+    encoder) only run on those whose decoder masks are requested.
+    """
+    def __init__(self, model, args):
+        self.model = model
+        self.device = torch.device(args.device)
+        self.precision = args.precision
+        self.mask_size = args.val_mask_size
+        self.max_batch_size = args.max_batch_size
+        self.max_delay = args.max_delay_ms / 1000
+        self.queue = asyncio.Queue(maxsize=args.max_queue)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def submit(self, image, decoder):
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((image, decoder, future))
+        return future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(items) < self.max_batch_size:
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), max(0., deadline - loop.time())))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                outputs = await loop.run_in_executor(self.executor, self.compute, [item[0] for item in items], [item[1] for item in items])
+            except Exception as e:
+                outputs = [e for _ in items]
+            for (_, _, future), output in zip(items, outputs):
+                if future.cancelled():
+                    continue
+                if isinstance(output, Exception):
+                    future.set_exception(output)
+                else:
+                    future.set_result(output)
+
+    @torch.no_grad()
+    def compute(self, images, decoders):
+        model = self.model
+        image = torch.stack(images).to(self.device)
+        with get_autocast(self.precision, self.device.type):
+            emb, slots, slots_attns = model.get_embeddings_n_slots(image)
+            rows = [i for i, decoder in enumerate(decoders) if decoder]
+            if rows:
+                rows = torch.tensor(rows, device=self.device)
+                emb_target = model.forward_encoder(image[rows], model.second_encoder) if model.second_encoder is not None else emb[rows]
+                _, dec_slots_attns = model.forward_decoder(slots[rows], emb_target, return_attns=True)
+
+        B, N, num_slots = slots_attns.shape
+        H_enc = W_enc = int(math.sqrt(N))
+        slots_attns = slots_attns.transpose(-1, -2).reshape(B, num_slots, H_enc, W_enc)
+        _, masks = masks_from_attns(slots_attns, self.mask_size)
+        outputs = [{
+            'slots': slots[i].float().cpu().numpy(),
+            'slots_attns': slots_attns[i].float().cpu().numpy().astype(np.float16),
+            'mask': masks[i].to(torch.uint8).cpu().numpy(),
+        } for i in range(B)]
+
+        if len(rows):
+            dec_slots_attns = dec_slots_attns.transpose(-1, -2).reshape(len(rows), num_slots, H_enc, W_enc)
+            _, dec_masks = masks_from_attns(dec_slots_attns, self.mask_size)
+            for j, i in enumerate(rows.tolist()):
+                outputs[i]['dec_slots_attns'] = dec_slots_attns[j].float().cpu().numpy().astype(np.float16)
+                outputs[i]['dec_mask'] = dec_masks[j].to(torch.uint8).cpu().numpy()
+        return outputs
+
+
+def build_transform(image_size):
+    # The transform of the validation images.
+    return transforms.Compose([transforms.Resize(size=image_size, interpolation=transforms.InterpolationMode.BILINEAR),
+                               transforms.CenterCrop(size=image_size),
+                               transforms.ToTensor(),
+                               transforms.Normalize((0.485, 0.456, 0.406), (0.229, 0.224, 0.225))])
+
+
+def to_npz(output):
+    buffer = io.BytesIO()
+    np.savez(buffer, **output)
+    return buffer.getvalue()
+
+
+class RequestError(Exception):
+    # An invalid request, answered with its status (4xx), the other exceptions are server errors (500).
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Server(object):
+    """
+    Minimal HTTP server, one request per connection:
+    POST /slots with an image file returns the slots, the attention maps of the slot attention (at the token
+    resolution) and the argmax mask at val_mask_size, as an .npz file (numpy.load(io.BytesIO(body))).
+    POST /masks additionally returns dec_slots_attns and dec_mask, the masks of the decoder.
+    GET /health returns the queue length.
+    """
+    def __init__(self, batcher, args):
+        self.batcher = batcher
+        self.transform = build_transform(args.val_image_size)
+        self.pool = ThreadPoolExecutor(max_workers=args.preprocess_threads)
+        self.max_body_bytes = args.max_body_bytes
+
+    def preprocess(self, body):
+        try:
+            image = Image.open(io.BytesIO(body)).convert('RGB')
+        except (OSError, ValueError, Image.DecompressionBombError) as e:
+            raise RequestError(400, 'cannot decode the image: {!r}'.format(e))
+        return self.transform(image)
+
+    async def read_request(self, reader):
+        try:
+            method, path, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, value = line.decode('latin-1').split(':', 1)
+                headers[name.strip().lower()] = value.strip()
+            length = int(headers.get('content-length', 0))
+        except ValueError as e: # also the lines longer than the stream limit
+            raise RequestError(400, 'malformed request: {!r}'.format(e))
+        if length < 0:
+            raise RequestError(400, 'negative content-length')
+        if length > self.max_body_bytes:
+            raise RequestError(413, 'the body is larger than {} bytes'.format(self.max_body_bytes))
+        try:
+            body = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise RequestError(400, 'the body is shorter than its content-length')
+        return method, path, body
+
+    async def handle(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        content_type = 'application/json'
+        try:
+            method, path, body = await self.read_request(reader)
+
+            if method == 'GET' and path == '/health':
+                status, payload = 200, json.dumps({'queue': self.batcher.queue.qsize()}).encode()
+            elif method == 'POST' and path in ('/slots', '/masks'):
+                image = await loop.run_in_executor(self.pool, self.preprocess, body)
+                try:
+                    future = self.batcher.submit(image, decoder=path == '/masks')
+                except asyncio.QueueFull:
+                    status, payload = 503, json.dumps({'error': 'too many pending requests'}).encode()
+                else:
+                    output = await future
+                    status, payload = 200, await loop.run_in_executor(self.pool, to_npz, output)
+                    content_type = 'application/octet-stream'
+            else:
+                status, payload = 404, json.dumps({'error': 'unknown endpoint'}).encode()
+        except RequestError as e:
+            status, payload = e.status, json.dumps({'error': str(e)}).encode()
+        except Exception as e:
+            status, payload = 500, json.dumps({'error': repr(e)}).encode()
+
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}[status]
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+            status, reason, content_type, len(payload)).encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+async def serve(args):
+    model = build_model(args).to(args.device).eval()
+    batcher = MicroBatcher(model, args)
+    server = Server(batcher, args)
+    batch_loop = asyncio.ensure_future(batcher.run())
+    http_server = await asyncio.start_server(server.handle, args.host, args.port)
+    print('====> Serving {} on http://{}:{}'.format(args.checkpoint_path, args.host, args.port))
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        batch_loop.cancel()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT server', parents=[get_args_parser()])
+    args = parser.parse_args()
+    asyncio.run(serve(args))
@@ -17,6 +17,7 @@ class SlotAttention(nn.Module):
         heads,
         epsilon=1e-8, 
         drop_path=0,
+        activation_checkpointing=False,
     ):
         super().__init__()
         self.num_iter = num_iter
@@ -25,6 +26,7 @@ class SlotAttention(nn.Module):
         self.epsilon = epsilon
         self.truncate = truncate
         self.num_heads = heads
+        self.activation_checkpointing = activation_checkpointing
 
         self.norm_inputs = nn.LayerNorm(input_size)
         self.norm_slots = nn.LayerNorm(slot_size)
@@ -47,9 +49,10 @@ class SlotAttention(nn.Module):
         assert self.truncate in ['bi-level', 'fixed-point', 'none']
 
 
-    def forward(self, inputs, slots_init):
+    def forward(self, inputs, slots_init, return_attn=True):
         # `inputs` has shape [batch_size, num_inputs, input_size].
         # `slots` has shape [batch_size, num_slots, slot_size].
+        # The attention maps (`attn_vis`) of the last iteration are only computed if `return_attn`.
         slots = slots_init
         B, N_kv, D_inp = inputs.size()
         B, N_q, D_slot = slots.size()
@@ -66,35 +69,50 @@ class SlotAttention(nn.Module):
                     slots = slots.detach() + slots_init - slots_init.detach()
                 elif self.truncate == 'fixed-point':
                     slots = slots.detach()
-            slots_prev = slots
-            slots = self.norm_slots(slots)
-            
-            # Attention.
-            q = self.project_q(slots).view(B, N_q, self.num_heads, -1).transpose(1, 2)  # Shape: [batch_size, num_heads, num_slots, slot_size // num_heads].
-            attn_logits = torch.matmul(k, q.transpose(-1, -2))                          # Shape: [batch_size, num_heads, num_inputs, num_slots].
-            attn = F.softmax(
-                attn_logits.transpose(1, 2).reshape(B, N_kv, self.num_heads * N_q)
-            , dim=-1).view(B, N_kv, self.num_heads, N_q).transpose(1, 2)                # Shape: [batch_size, num_heads, num_inputs, num_slots].
-            attn_vis = attn.sum(1)                                                      # Shape: [batch_size, num_inputs, num_slots].
-            
-            # Weighted mean.
-            attn = attn + self.epsilon
-            attn = attn / torch.sum(attn, dim=-2, keepdim=True)
-            updates = torch.matmul(attn.transpose(-1, -2), v)                           # Shape: [batch_size, num_heads, num_slots, slot_size // num_heads].
-            updates = updates.transpose(1, 2).reshape(B, N_q, -1)                       # Shape: [batch_size, num_slots, slot_size].
-            
-            # Slot update.
-            slots = self.gru(updates.view(-1, self.slot_size),
-                             slots_prev.view(-1, self.slot_size))
-            slots = slots.view(-1, N_q, self.slot_size)
-            slots = slots + self.mlp(self.norm_mlp(slots))
+            slots, attn_vis, attn_logits = checkpoint_forward(
+                self.step, slots, k, v, return_attn and i == self.num_iter - 1, enabled=self.activation_checkpointing)
+        
+        return slots, attn_vis, attn_logits
+    
+    def step(self, slots, k, v, return_attn=False):
+        # One iteration, in a separate method so that it can be checkpointed.
+        # Returns the updated slots, the attention maps summed over the heads (if `return_attn`) and the logits.
+        B, N_q, _ = slots.size()
+        N_kv = k.shape[2]
+        attn_vis = None
+        
+        slots_prev = slots
+        slots = self.norm_slots(slots)
+        
+        # Attention.
+        q = self.project_q(slots).view(B, N_q, self.num_heads, -1).transpose(1, 2)  # Shape: [batch_size, num_heads, num_slots, slot_size // num_heads].
+        attn_logits = torch.matmul(k, q.transpose(-1, -2))                          # Shape: [batch_size, num_heads, num_inputs, num_slots].
+        # The softmax and the epsilon renormalization are kept in fp32 under autocast (epsilon underflows in fp16).
+        attn = F.softmax(
+            attn_logits.float().transpose(1, 2).reshape(B, N_kv, self.num_heads * N_q)
+        , dim=-1).view(B, N_kv, self.num_heads, N_q).transpose(1, 2)                # Shape: [batch_size, num_heads, num_inputs, num_slots].
+        if return_attn:
+            attn_vis = attn.sum(1)                                                  # Shape: [batch_size, num_inputs, num_slots].
+        
+        # Weighted mean.
+        attn = attn + self.epsilon
+        attn = attn / torch.sum(attn, dim=-2, keepdim=True)
+        updates = torch.matmul(attn.transpose(-1, -2).to(v.dtype), v)               # Shape: [batch_size, num_heads, num_slots, slot_size // num_heads].
+        updates = updates.transpose(1, 2).reshape(B, N_q, -1)                       # Shape: [batch_size, num_slots, slot_size].
+        
+        # Slot update.
+        slots = self.gru(updates.view(-1, self.slot_size),
+                         slots_prev.view(-1, self.slot_size))
+        slots = slots.view(-1, N_q, self.slot_size)
+        slots = slots + self.mlp(self.norm_mlp(slots))
         
         return slots, attn_vis, attn_logits
 
 class SlotAttentionEncoder(nn.Module):
     
     def __init__(self, num_iterations, num_slots,
-                 input_channels, slot_size, mlp_hidden_size, pos_channels, truncate='bi-level', init_method='embedding', num_heads = 1, drop_path = 0.0):
+                 input_channels, slot_size, mlp_hidden_size, pos_channels, truncate='bi-level', init_method='embedding', num_heads = 1, drop_path = 0.0,
+                 activation_checkpointing=False):
         super().__init__()
         
         self.num_iterations = num_iterations
@@ -126,9 +144,10 @@ class SlotAttentionEncoder(nn.Module):
         
         self.slot_attention = SlotAttention(
             num_iterations,
-            input_channels, slot_size, mlp_hidden_size, truncate, num_heads, drop_path=drop_path)
+            input_channels, slot_size, mlp_hidden_size, truncate, num_heads, drop_path=drop_path,
+            activation_checkpointing=activation_checkpointing)
     
-    def forward(self, x):
+    def forward(self, x, return_attn=True):
         # `image` has shape: [batch_size, img_channels, img_height, img_width].
         # `encoder_grid` has shape: [batch_size, pos_channels, enc_height, enc_width].
         B, *_ = x.size()
@@ -140,7 +159,7 @@ class SlotAttentionEncoder(nn.Module):
         # Slot Attention module.
         init_slots = self.slots_initialization(B, dtype, device)
 
-        slots, attn, attn_logits = self.slot_attention(x, init_slots)
+        slots, attn, attn_logits = self.slot_attention(x, init_slots, return_attn)
         # `slots` has shape: [batch_size, num_slots, slot_size].
         # `attn` has shape: [batch_size, enc_height * enc_width, num_slots].
         
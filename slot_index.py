@@ -0,0 +1,260 @@
+''' Cosine-similarity search over the slots extracted with extract_slots.py. '''
+
+import os
+import time
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from extract_slots import SlotStore
+from utils_spot import bool_flag
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT slot index', add_help=False)
+
+    parser.add_argument('--store', type=str, default=None, help='extract_slots.py output, its images that are not in the index yet are added')
+    parser.add_argument('--index', type=str, default=None, help='index file, built from --store if it does not exist')
+    parser.add_argument('--mmap_search', type=bool_flag, default=False, help='search --store exactly in its memory-mapped chunks without building an index (for stores larger than the memory)')
+    parser.add_argument('--num_lists', type=int, default=0, help='inverted lists of the approximate (IVF) search, trained when the index is built (0 only keeps the exact search)')
+    parser.add_argument('--kmeans_iters', type=int, default=20)
+    parser.add_argument('--block_size', type=int, default=65536, help='slots per matrix multiply of the exact search')
+    parser.add_argument('--query_image', type=str, default=None, help='image id of the query slot')
+    parser.add_argument('--query_slot', type=int, default=0, help='slot of query_image used as the query')
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--nprobe', type=int, default=0, help='lists searched by the IVF search (0 searches exactly)')
+    parser.add_argument('--benchmark_queries', type=int, default=0, help='compare the recall and latency of the IVF search at several nprobe to the exact search on this many random slots')
+    parser.add_argument('--seed', type=int, default=0)
+
+    return parser
+
+
+def kmeans(vectors, num_lists, iters=20, seed=0):
+    # Spherical k-means of the normalized vectors, the empty lists are restarted from random vectors.
+    generator = torch.Generator().manual_seed(seed)
+    centroids = vectors[torch.randperm(len(vectors), generator=generator)[:num_lists]].clone()
+    for _ in range(iters):
+        assignments = (vectors @ centroids.T).argmax(1)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, vectors)
+        counts = torch.bincount(assignments, minlength=len(centroids))
+        empty = counts == 0
+        sums[empty] = vectors[torch.randint(len(vectors), (int(empty.sum()),), generator=generator)]
+        centroids = F.normalize(sums, dim=1)
+    return centroids
+
+
+def merge_topk(scores, indices, new_scores, new_indices, k):
+    scores = torch.cat([scores, new_scores], 1)
+    indices = torch.cat([indices, new_indices], 1)
+    scores, order = scores.topk(min(k, scores.shape[1]), dim=1)
+    return scores, indices.gather(1, order)
+
+
+class SlotIndex(object):
+    """
+    Index of normalized slot vectors. Every entry is a slot of an image, its key is (image position, slot).
+    search_exact computes the similarities block by block, keeping only a running top-k, and search_ivf only
+    scores the entries of the nprobe inverted lists whose centroids are the most similar to the query.
+    Entries added after the lists are trained are assigned to the nearest list.
+    All the vectors are held in memory in float32 (4 * slot_size bytes per slot, 1 KB for slots of size 256, and
+    the search_ivf candidates are gathered from them), search_store searches a store larger than the memory.
+    """
+    def __init__(self, dim, block_size=65536):
+        self.dim = dim
+        self.block_size = block_size
+        self.vectors = torch.zeros(0, dim)
+        self.keys = torch.zeros(0, 2, dtype=torch.long)
+        self.image_ids = []
+        self.centroids = None
+        self.lists = []
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def add(self, slots, image_ids):
+        """
+        slots: (images, num_slots, slot_size) array, image_ids: their ids.
+        """
+        slots = torch.as_tensor(np.asarray(slots, dtype=np.float32))
+        num_images, num_slots, _ = slots.shape
+        vectors = F.normalize(slots.reshape(-1, self.dim), dim=1)
+        positions = torch.arange(len(self.image_ids), len(self.image_ids) + num_images)
+        keys = torch.stack([positions.repeat_interleave(num_slots), torch.arange(num_slots).repeat(num_images)], 1)
+        start = len(self.vectors)
+        self.vectors = torch.cat([self.vectors, vectors])
+        self.keys = torch.cat([self.keys, keys])
+        self.image_ids += list(image_ids)
+        if self.centroids is not None:
+            self._assign(vectors, start)
+
+    def train_ivf(self, num_lists, iters=20, seed=0):
+        self.centroids = kmeans(self.vectors, min(num_lists, len(self.vectors)), iters, seed)
+        self.lists = [torch.zeros(0, dtype=torch.long) for _ in self.centroids]
+        self._assign(self.vectors, 0)
+
+    def _assign(self, vectors, start):
+        assignments = torch.cat([(block @ self.centroids.T).argmax(1) for block in vectors.split(self.block_size)])
+        order = torch.argsort(assignments)
+        counts = torch.bincount(assignments, minlength=len(self.centroids)).tolist()
+        for l, members in enumerate((order + start).split(counts)):
+            if len(members):
+                self.lists[l] = torch.cat([self.lists[l], members])
+
+    def search_exact(self, queries, k):
+        """
+        queries: (num_queries, dim) vectors.
+        return: (scores, indices) of the k most similar entries of every query, by decreasing cosine similarity.
+        """
+        queries = F.normalize(torch.as_tensor(queries, dtype=torch.float32), dim=1)
+        scores = torch.zeros(len(queries), 0)
+        indices = torch.zeros(len(queries), 0, dtype=torch.long)
+        for start in range(0, len(self.vectors), self.block_size):
+            block_scores = queries @ self.vectors[start:start + self.block_size].T
+            block_scores, block_indices = block_scores.topk(min(k, block_scores.shape[1]), dim=1)
+            scores, indices = merge_topk(scores, indices, block_scores, block_indices + start, k)
+        return scores, indices
+
+    def search_ivf(self, queries, k, nprobe):
+        assert self.centroids is not None, 'the inverted lists are not trained, see --num_lists'
+        queries = F.normalize(torch.as_tensor(queries, dtype=torch.float32), dim=1)
+        probes = (queries @ self.centroids.T).topk(min(nprobe, len(self.centroids)), dim=1).indices
+        scores = torch.full((len(queries), k), -float('inf'))
+        indices = torch.full((len(queries), k), -1, dtype=torch.long)
+        for q, query in enumerate(queries):
+            candidates = torch.cat([self.lists[l] for l in probes[q].tolist()])
+            candidate_scores = self.vectors[candidates] @ query
+            top_scores, top = candidate_scores.topk(min(k, len(candidates)))
+            scores[q, :len(top)] = top_scores
+            indices[q, :len(top)] = candidates[top]
+        return scores, indices
+
+    def search(self, queries, k, nprobe=0):
+        if nprobe > 0:
+            return self.search_ivf(queries, k, nprobe)
+        return self.search_exact(queries, k)
+
+    def key(self, index):
+        # (image id, slot) of an entry.
+        position, slot = self.keys[index].tolist()
+        return self.image_ids[position], slot
+
+    def save(self, path):
+        torch.save({'dim': self.dim, 'vectors': self.vectors, 'keys': self.keys, 'image_ids': self.image_ids,
+                    'centroids': self.centroids, 'lists': self.lists}, path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path, block_size=65536):
+        state = torch.load(path, map_location='cpu')
+        index = cls(state['dim'], block_size)
+        index.vectors, index.keys, index.image_ids = state['vectors'], state['keys'], state['image_ids']
+        index.centroids, index.lists = state['centroids'], state['lists']
+        return index
+
+
+def search_store(store, queries, k, block_size=65536):
+    """
+    Exact search over the slots of a SlotStore, read block by block from its memory-mapped chunks: only one block
+    of slots is in memory at a time.
+    return: (scores, keys) with keys the (image id, slot) of the k most similar slots of every query.
+    """
+    queries = F.normalize(torch.as_tensor(queries, dtype=torch.float32), dim=1)
+    scores = torch.zeros(len(queries), 0)
+    indices = torch.zeros(len(queries), 0, dtype=torch.long)
+    image_ids, offset = [], 0
+    for chunk in store.iter_chunks(('slots', 'ids')):
+        _, num_slots, dim = chunk['slots'].shape
+        slots = chunk['slots'].reshape(-1, dim)
+        for start in range(0, len(slots), block_size):
+            block = F.normalize(torch.as_tensor(np.asarray(slots[start:start + block_size], dtype=np.float32)), dim=1)
+            block_scores, block_indices = (queries @ block.T).topk(min(k, len(block)), dim=1)
+            scores, indices = merge_topk(scores, indices, block_scores, block_indices + offset + start, k)
+        image_ids += [str(image_id) for image_id in chunk['ids']]
+        offset += len(slots)
+    return scores, [[(image_ids[i // num_slots], i % num_slots) for i in row] for row in indices.tolist()]
+
+
+def store_slot(store, image_id, slot):
+    for chunk in store.iter_chunks(('slots', 'ids')):
+        positions = [i for i, chunk_id in enumerate(chunk['ids']) if str(chunk_id) == image_id]
+        if positions:
+            return np.asarray(chunk['slots'][positions[0], slot], dtype=np.float32)
+    raise KeyError('{} is not in the store'.format(image_id))
+
+
+def benchmark(index, num_queries, k, seed=0):
+    # Recall@k and latency per query of the IVF search at several nprobe, against the exact search.
+    generator = torch.Generator().manual_seed(seed)
+    queries = index.vectors[torch.randint(len(index), (num_queries,), generator=generator)]
+
+    start = time.perf_counter()
+    _, exact = index.search_exact(queries, k)
+    exact_time = (time.perf_counter() - start) / num_queries
+    print('exact \t\t recall@{} = 1.0000 \t {:.3f} ms/query'.format(k, 1000 * exact_time))
+
+    if index.centroids is None:
+        return
+    nprobe = 1
+    while nprobe <= len(index.centroids):
+        start = time.perf_counter()
+        _, approx = index.search_ivf(queries, k, nprobe)
+        ivf_time = (time.perf_counter() - start) / num_queries
+        recall = np.mean([len(set(a.tolist()) & set(e.tolist())) / len(e) for a, e in zip(approx, exact)])
+        print('nprobe = {:4} \t recall@{} = {:.4f} \t {:.3f} ms/query'.format(nprobe, k, recall, 1000 * ivf_time))
+        nprobe *= 4
+
+
+def main(args):
+    if args.mmap_search:
+        assert args.store is not None and args.query_image is not None, '--mmap_search searches --query_image in --store'
+        store = SlotStore(args.store)
+        scores, keys = search_store(store, store_slot(store, args.query_image, args.query_slot)[None], args.k, args.block_size)
+        for score, (image_id, slot) in zip(scores[0].tolist(), keys[0]):
+            print('{:.4f} \t {} \t slot {}'.format(score, image_id, slot))
+        return
+
+    assert args.index is not None, '--index is needed without --mmap_search'
+    if os.path.isfile(args.index):
+        index = SlotIndex.load(args.index, args.block_size)
+    else:
+        index = None
+
+    if args.store is not None:
+        store = SlotStore(args.store)
+        added, position = 0, 0
+        for chunk in store.iter_chunks(('slots', 'ids')):
+            # Incremental inserts: only the images of the store that are not in the index yet.
+            indexed = len(index.image_ids) if index is not None else 0
+            new = min(len(chunk['ids']), max(0, position + len(chunk['ids']) - indexed))
+            if new > 0:
+                if index is None:
+                    index = SlotIndex(chunk['slots'].shape[-1], args.block_size)
+                index.add(chunk['slots'][-new:], [str(image_id) for image_id in chunk['ids'][-new:]])
+                added += new
+            position += len(chunk['ids'])
+        if index is not None and index.centroids is None and args.num_lists > 0:
+            index.train_ivf(args.num_lists, args.kmeans_iters, args.seed)
+        if added > 0 or not os.path.isfile(args.index):
+            index.save(args.index)
+        print('====> {} images added, {} slots in {}'.format(added, len(index), args.index))
+
+    assert index is not None, 'no index at {}, build it with --store'.format(args.index)
+
+    if args.query_image is not None:
+        entry = int(torch.nonzero((index.keys[:, 0] == index.image_ids.index(args.query_image)) & (index.keys[:, 1] == args.query_slot))[0])
+        scores, indices = index.search(index.vectors[entry:entry + 1], args.k, args.nprobe)
+        for score, i in zip(scores[0].tolist(), indices[0].tolist()):
+            if i >= 0:
+                image_id, slot = index.key(i)
+                print('{:.4f} \t {} \t slot {}'.format(score, image_id, slot))
+
+    if args.benchmark_queries > 0:
+        benchmark(index, args.benchmark_queries, args.k, args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT slot index', parents=[get_args_parser()])
+    args = parser.parse_args()
+    main(args)
@@ -15,6 +15,12 @@ class SPOT(nn.Module):
         self.encoder = encoder
         self.second_encoder = second_encoder
         self.encoder_final_norm = args.encoder_final_norm
+        self.finetune_blocks_after = args.finetune_blocks_after
+        
+        # Activation checkpointing of any of ACTIVATION_CHECKPOINTING (comma separated), trading recompute for memory.
+        checkpointing = [name for name in getattr(args, 'activation_checkpointing', '').split(',') if name]
+        assert all(name in ACTIVATION_CHECKPOINTING for name in checkpointing), checkpointing
+        self.checkpoint_encoder = 'encoder' in checkpointing
         
         for param_name, param in self.encoder.named_parameters():
             if ('blocks' in param_name):
@@ -45,51 +51,25 @@ class SPOT(nn.Module):
         self.slot_attn = SlotAttentionEncoder(
             args.num_iterations, args.num_slots,
             args.d_model, args.slot_size, args.mlp_hidden_size, args.pos_channels,
-            args.truncate, args.init_method)
+            args.truncate, args.init_method, activation_checkpointing='slot_attn' in checkpointing)
 
         self.input_proj = nn.Sequential(
             linear(args.d_model, args.d_model, bias=False),
             nn.LayerNorm(args.d_model),
         )
         
-        size = int(math.sqrt(num_tokens))
-        standard_order = torch.arange(size**2) # This is the default "left_top"
-        
         self.cappa = args.cappa
         self.train_permutations = args.train_permutations
         
         if self.train_permutations == 'standard':
-            self.permutations = [standard_order]
             self.eval_permutations = 'standard'
-        
         else:
-            standard_order_2d = standard_order.reshape(size,size)
-            
-            perm_top_left = torch.tensor([standard_order_2d[row,col] for col in range(0, size, 1) for row in range(0, size, 1)])
-            
-            perm_top_right = torch.tensor([standard_order_2d[row,col] for col in range(size-1, -1, -1) for row in range(0, size, 1)])
-            perm_right_top = torch.tensor([standard_order_2d[row,col] for row in range(0, size, 1) for col in range(size-1, -1, -1)])
-            
-            perm_bottom_right = torch.tensor([standard_order_2d[row,col] for col in range(size-1, -1, -1) for row in range(size-1, -1, -1)])
-            perm_right_bottom = torch.tensor([standard_order_2d[row,col] for row in range(size-1, -1, -1) for col in range(size-1, -1, -1)])
-            
-            perm_bottom_left = torch.tensor([standard_order_2d[row,col] for col in range(0, size, 1) for row in range(size-1, -1, -1)])
-            perm_left_bottom = torch.tensor([standard_order_2d[row,col] for row in range(size-1, -1, -1) for col in range(0, size, 1)])
-            
-            perm_spiral = spiral_pattern(standard_order_2d, how = 'top_right')
-            perm_spiral = torch.tensor((perm_spiral[::-1]).copy())
-    
-            self.permutations = [standard_order, # left_top
-                                 perm_top_left, 
-                                 perm_top_right, 
-                                 perm_right_top, 
-                                 perm_bottom_right, 
-                                 perm_right_bottom,
-                                 perm_bottom_left,
-                                 perm_left_bottom,
-                                 perm_spiral
-                                 ]
             self.eval_permutations = args.eval_permutations
+        
+        # The patch orders depend on the number of tokens. Those of other resolutions
+        # than args.image_size are built (and cached) when they are first needed.
+        self.permutations = self.build_permutations(num_tokens)
+        self.permutations_per_len = {num_tokens: self.permutations}
 
         self.perm_ind = list(range(len(self.permutations)))
 
@@ -111,7 +91,8 @@ class SPOT(nn.Module):
         
         if self.dec_type=='transformer':
             self.dec = TransformerDecoder(
-                args.num_dec_blocks, args.max_tokens, args.d_model, args.num_heads, args.dropout, args.num_cross_heads)
+                args.num_dec_blocks, args.d_model, args.num_heads, args.dropout, args.num_cross_heads,
+                activation_checkpointing='decoder' in checkpointing)
             if self.cappa > 0:
                 assert (self.train_permutations == 'standard') and (self.eval_permutations == 'standard')   
                 self.mask_token = nn.Parameter(torch.zeros(1, 1, args.d_model))
@@ -120,21 +101,46 @@ class SPOT(nn.Module):
                 torch.nn.init.normal_(self.mask_token, std=.02)
                   
         elif self.dec_type=='mlp':
-            self.dec = MlpDecoder(self.dec_input_dim, args.d_model, args.max_tokens, args.mlp_dec_hidden)
+            self.dec = MlpDecoder(self.dec_input_dim, args.d_model, num_tokens, args.mlp_dec_hidden)
 
             assert (self.train_permutations == 'standard') and (self.eval_permutations == 'standard')  
         else:
             raise
 
-        if self.dec_type=='transformer':
-            # Register hook for capturing the cross-attention (of the query patch
-            # tokens over the key/value slot tokens) from the last decoder
-            # transformer block of the decoder.
-            self.dec_slots_attns = []
-            def hook_fn_forward_attn(module, input):
-                self.dec_slots_attns.append(input[0])
-            self.remove_handle = self.dec._modules["blocks"][-1]._modules["encoder_decoder_attn"]._modules["attn_dropout"].register_forward_pre_hook(hook_fn_forward_attn)
 
+    def build_permutations(self, num_tokens):
+        size = int(math.sqrt(num_tokens))
+        standard_order = torch.arange(size**2) # This is the default "left_top"
+        
+        if self.train_permutations == 'standard':
+            return [standard_order]
+        
+        standard_order_2d = standard_order.reshape(size,size)
+        
+        perm_top_left = torch.tensor([standard_order_2d[row,col] for col in range(0, size, 1) for row in range(0, size, 1)])
+        
+        perm_top_right = torch.tensor([standard_order_2d[row,col] for col in range(size-1, -1, -1) for row in range(0, size, 1)])
+        perm_right_top = torch.tensor([standard_order_2d[row,col] for row in range(0, size, 1) for col in range(size-1, -1, -1)])
+        
+        perm_bottom_right = torch.tensor([standard_order_2d[row,col] for col in range(size-1, -1, -1) for row in range(size-1, -1, -1)])
+        perm_right_bottom = torch.tensor([standard_order_2d[row,col] for row in range(size-1, -1, -1) for col in range(size-1, -1, -1)])
+        
+        perm_bottom_left = torch.tensor([standard_order_2d[row,col] for col in range(0, size, 1) for row in range(size-1, -1, -1)])
+        perm_left_bottom = torch.tensor([standard_order_2d[row,col] for row in range(size-1, -1, -1) for col in range(0, size, 1)])
+        
+        perm_spiral = spiral_pattern(standard_order_2d, how = 'top_right')
+        perm_spiral = torch.tensor((perm_spiral[::-1]).copy())
+
+        return [standard_order, # left_top
+                perm_top_left, 
+                perm_top_right, 
+                perm_right_top, 
+                perm_bottom_right, 
+                perm_right_bottom,
+                perm_bottom_left,
+                perm_left_bottom,
+                perm_spiral
+                ]
 
     def forward_encoder(self, x, encoder):
         encoder.eval()
@@ -144,8 +150,9 @@ class SPOT(nn.Module):
         else:
             x = encoder.prepare_tokens(x)
 
-        for blk in encoder.blocks:
-            x = blk(x)
+        for i, blk in enumerate(encoder.blocks):
+            # Only the finetuned blocks store activations for the backward pass.
+            x = checkpoint_forward(blk, x, enabled=self.checkpoint_encoder and i >= self.finetune_blocks_after)
         if self.encoder_final_norm: # The DINOSAUR paper does not use the final norm layer according to the supplementary material.
             x = encoder.norm(x)
         
@@ -158,7 +165,7 @@ class SPOT(nn.Module):
 
         return x
 
-    def forward_decoder(self, slots, emb_target):
+    def forward_decoder(self, slots, emb_target, return_attns=True):
         # Prepate the input tokens for the decoder transformer:
         # (1) insert a learnable beggining-of-sequence ([BOS]) token at the beggining of each target embedding sequence.
         # (2) remove the last token of the target embedding sequence
@@ -185,11 +192,16 @@ class SPOT(nn.Module):
                 raise
         
         
+        num_tokens = emb_target.shape[1]
+        if num_tokens not in self.permutations_per_len:
+            self.permutations_per_len[num_tokens] = self.build_permutations(num_tokens)
+        permutations = self.permutations_per_len[num_tokens]
+        
         all_dec_slots_attns = []
         all_dec_output = []
         
         for perm_id in which_permutations:
-            current_perm = self.permutations[perm_id]
+            current_perm = permutations[perm_id]
 
             bos_token = self.bos_tokens[perm_id]
             bos_token = bos_token.expand(emb_target.shape[0], -1, -1)
@@ -204,8 +216,8 @@ class SPOT(nn.Module):
                 dec_input = torch.cat((bos_token, emb_target[:,current_perm,:][:, :-1, :]), dim=1)
       
             if use_pos_emb:
-                # Add position embedding if they exist.
-                dec_input = dec_input + self.pos_embed.to(emb_target.dtype)
+                # Add position embedding if they exist (interpolated if the resolution differs from training).
+                dec_input = dec_input + resize_pos_embed(self.pos_embed, num_tokens).to(emb_target.dtype)
 
             # dec_input has the same shape as emb_target, which is [B, N, D]
             dec_input = self.input_proj(dec_input)
@@ -213,33 +225,38 @@ class SPOT(nn.Module):
             # Apply the decoder
             dec_input_slots = self.slot_proj(slots) # shape: [B, num_slots, D]
             if self.dec_type=='transformer':
-                dec_output = self.dec(dec_input, dec_input_slots, causal_mask=(not parallel_dec))
+                if return_attns:
+                    # The decoder also returns the cross-attention (of the query patch tokens
+                    # over the key/value slot tokens) of its last transformer block.
+                    dec_output, dec_slots_attns = self.dec(dec_input, dec_input_slots, causal_mask=(not parallel_dec), return_attn=True)
+                else:
+                    dec_output = self.dec(dec_input, dec_input_slots, causal_mask=(not parallel_dec))
                 # decoder_output shape [B, N, D]
 
-                dec_slots_attns = self.dec_slots_attns[0]
-                self.dec_slots_attns = []
-
-                # sum over the heads and 
-                dec_slots_attns = dec_slots_attns.sum(dim=1) # [B, N, num_slots]
-                # dec_slots_attns shape [B, num_heads, N, num_slots]
-                # L1-normalize over the slots so as to sum to 1.
-                dec_slots_attns = dec_slots_attns / dec_slots_attns.sum(dim=2, keepdim=True)
-
                 inv_current_perm = torch.argsort(current_perm)
-                dec_slots_attns = dec_slots_attns[:,inv_current_perm,:]
                 dec_output = dec_output[:,inv_current_perm,:]
 
+                if return_attns:
+                    # sum over the heads and 
+                    dec_slots_attns = dec_slots_attns.sum(dim=1) # [B, N, num_slots]
+                    # dec_slots_attns shape [B, num_heads, N, num_slots]
+                    # L1-normalize over the slots so as to sum to 1.
+                    dec_slots_attns = dec_slots_attns / dec_slots_attns.sum(dim=2, keepdim=True)
+
+                    dec_slots_attns = dec_slots_attns[:,inv_current_perm,:]
+
             elif self.dec_type=='mlp':
-                dec_output, dec_slots_attns = self.dec(dec_input_slots)
+                dec_output, dec_slots_attns = self.dec(dec_input_slots, num_tokens)
                 dec_slots_attns = dec_slots_attns.transpose(1,2)
 
             else:
                 raise
             
-            all_dec_slots_attns.append(dec_slots_attns)
+            if return_attns:
+                all_dec_slots_attns.append(dec_slots_attns)
             all_dec_output.append(dec_output)
 
-        mean_dec_slots_attns = torch.stack(all_dec_slots_attns).mean(0)
+        mean_dec_slots_attns = torch.stack(all_dec_slots_attns).mean(0) if return_attns else None
         mean_dec_output = torch.stack(all_dec_output).mean(0)
 
         return mean_dec_output, mean_dec_slots_attns
@@ -247,6 +264,8 @@ class SPOT(nn.Module):
     def get_embeddings_n_slots(self, image):
         """
         image: batch_size x img_channels x H x W
+        return: (emb_target, slots, slots_attns) the encoder tokens (B, N, D), the slots (B, num_slots, slot_size)
+                and the attention of the tokens to the slots (B, N, num_slots).
         """
 
         B, _, H, W = image.size()
@@ -255,15 +274,14 @@ class SPOT(nn.Module):
         # emb_target shape: B, N, D
 
         # Apply the slot attention
-        slots, slots_attns, _ = self.slot_attn(emb_target)
+        slots, slots_attns, _, _ = self.slot_attn(emb_target)
         return emb_target, slots, slots_attns
 
-    def forward(self, image):
+    def encode(self, image):
         """
         image: batch_size x img_channels x H x W
+        return: (emb_input, emb_target) the tokens of the encoder and of the target encoder, see forward_from_tokens.
         """
-
-        B, _, H, W = image.size()
         emb_input = self.forward_encoder(image, self.encoder)
         with torch.no_grad():
             if self.second_encoder is not None:
@@ -271,22 +289,57 @@ class SPOT(nn.Module):
             else:
                 emb_target = emb_input.clone().detach()
         # emb_target shape: B, N, D
+        return emb_input, emb_target
+
+    def forward(self, image, outputs=None):
+        """
+        image: batch_size x img_channels x H x W
+        outputs: names of the outputs to return after the loss, among 'slots_attns', 'dec_slots_attns',
+                 'slots', 'dec_recon' and 'attn_logits'. The attention maps are only computed if requested,
+                 and with an empty sequence only the loss is returned (lean training mode). By default
+                 all the outputs are returned in the order above.
+        """
+        emb_input, emb_target = self.encode(image)
+        return self.forward_from_tokens(emb_input, emb_target, outputs)
+
+    def forward_from_tokens(self, emb_input, emb_target, outputs=None):
+        """
+        Slot attention and decoder on the tokens of encode(), which models with the same encoders can share.
+        """
+        if outputs is None:
+            outputs = ('slots_attns', 'dec_slots_attns', 'slots', 'dec_recon', 'attn_logits')
+        return_slots_attns = 'slots_attns' in outputs
+        return_dec_slots_attns = 'dec_slots_attns' in outputs
+
+        B = emb_target.shape[0]
 
         # Apply the slot attention
-        slots, slots_attns, init_slots, attn_logits = self.slot_attn(emb_input)
+        slots, slots_attns, init_slots, attn_logits = self.slot_attn(emb_input, return_attn=return_slots_attns)
         attn_logits = attn_logits.squeeze()
         # slots shape: [B, num_slots, Ds]
         # slots_attns shape: [B, N, num_slots]
 
         # Apply the decoder.
-        dec_recon, dec_slots_attns = self.forward_decoder(slots, emb_target)
+        dec_recon, dec_slots_attns = self.forward_decoder(slots, emb_target, return_attns=return_dec_slots_attns)
 
-        # Mean-Square-Error loss
+        # Mean-Square-Error loss (in fp32, also under autocast)
         H_enc, W_enc = int(math.sqrt(emb_target.shape[1])), int(math.sqrt(emb_target.shape[1]))
-        loss_mse = ((emb_target - dec_recon) ** 2).sum()/(B*H_enc*W_enc*self.d_model)
+        loss_mse = ((emb_target.float() - dec_recon.float()) ** 2).sum()/(B*H_enc*W_enc*self.d_model)
 
         # Reshape the slot and decoder-slot attentions.
-        slots_attns = slots_attns.transpose(-1, -2).reshape(B, self.num_slots, H_enc, W_enc)
-        dec_slots_attns = dec_slots_attns.transpose(-1, -2).reshape(B, self.num_slots, H_enc, W_enc)
-
-        return loss_mse, slots_attns, dec_slots_attns, slots, dec_recon, attn_logits
+        if return_slots_attns:
+            slots_attns = slots_attns.transpose(-1, -2).reshape(B, self.num_slots, H_enc, W_enc)
+        if return_dec_slots_attns:
+            dec_slots_attns = dec_slots_attns.transpose(-1, -2).reshape(B, self.num_slots, H_enc, W_enc)
+
+        if len(outputs) == 0:
+            return loss_mse
+
+        results = {
+            'slots_attns': slots_attns,
+            'dec_slots_attns': dec_slots_attns,
+            'slots': slots,
+            'dec_recon': dec_recon,
+            'attn_logits': attn_logits,
+        }
+        return (loss_mse,) + tuple(results[name] for name in outputs)
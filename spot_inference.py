@@ -0,0 +1,54 @@
+''' Standalone SPOT inference on a graph exported with export_spot.py, without the training code. '''
+
+import json
+
+import torch
+import torch.nn.functional as F
+
+
+class SpotInference(object):
+    """
+    Loads an export_spot.py artifact (TorchScript .pt or torch.export .pt2) and its metadata.
+    __call__ takes a batch of RGB images (B, 3, H, W) in [0, 1] and returns a dict of the exported outputs
+    ('slots', 'slots_attns' and, if exported with the decoder, 'dec_slots_attns'), with the argmax masks at
+    mask_size ('mask', 'dec_mask').
+    The preprocessing crops the pixel window of the validation transform (torchvision Resize and CenterCrop), but
+    resizes the tensor with an antialiased bilinear interpolation instead of the PIL image, so the pixel values
+    differ slightly (see --check_image of export_spot.py).
+    """
+    def __init__(self, path, device='cpu', num_threads=None):
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+        self.device = torch.device(device)
+        extra_files = {'spot_meta.json': ''}
+        if path.endswith('.pt2'):
+            self.graph = torch.export.load(path, extra_files=extra_files).module()
+        else:
+            self.graph = torch.jit.load(path, map_location=self.device, _extra_files=extra_files)
+        self.meta = json.loads(extra_files['spot_meta.json'])
+        self.image_size = self.meta['image_size']
+        self.mask_size = self.meta['mask_size']
+        self.mean = torch.tensor(self.meta['image_mean'], device=self.device).view(1, 3, 1, 1)
+        self.std = torch.tensor(self.meta['image_std'], device=self.device).view(1, 3, 1, 1)
+
+    def preprocess(self, image):
+        # Resize of the shorter side, center crop and normalization, as the validation images. The sizes and offsets
+        # are computed as in torchvision: the longer side is truncated and the crop offsets are rounded.
+        image = image.to(self.device, torch.float32)
+        H, W = image.shape[-2:]
+        size = self.image_size
+        resized = (size, int(size * W / H)) if H <= W else (int(size * H / W), size)
+        image = F.interpolate(image, size=resized, mode='bilinear', align_corners=False, antialias=True)
+        top = int(round((resized[0] - size) / 2.0))
+        left = int(round((resized[1] - size) / 2.0))
+        image = image[..., top:top + size, left:left + size]
+        return (image - self.mean) / self.std
+
+    @torch.no_grad()
+    def __call__(self, image):
+        outputs = dict(zip(self.meta['outputs'], self.graph(self.preprocess(image))))
+        for name, mask_name in [('slots_attns', 'mask'), ('dec_slots_attns', 'dec_mask')]:
+            if name in outputs:
+                attns = F.interpolate(outputs[name].float(), size=self.mask_size, mode='bilinear')
+                outputs[mask_name] = attns.argmax(1)
+        return outputs
@@ -0,0 +1,170 @@
+''' Local hyperparameter sweep of train_spot.py with successive halving. '''
+
+import os
+import sys
+import math
+import time
+import json
+import argparse
+import itertools
+import subprocess
+
+from utils_spot import find_last_checkpoint, read_val_metrics
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT sweep', add_help=False)
+
+    parser.add_argument('--sweep_dir', type=str, required=True, help='one log_path per configuration is created here, rerunning the same sweep continues it')
+    parser.add_argument('--script', type=str, default='train_spot.py', help='train_spot.py or train_spot_2.py')
+    parser.add_argument('--grid', type=str, action='append', default=[], help='name=value1,value2,... of a training argument, repeat for each swept argument')
+    parser.add_argument('--epochs', type=int, default=100, help='epochs of the full runs, which set the learning rate schedules of all the runs')
+    parser.add_argument('--min_epochs', type=int, default=10, help='epochs of the first rung')
+    parser.add_argument('--eta', type=int, default=3, help='only the best 1/eta of the runs are continued, for eta times more epochs')
+    parser.add_argument('--metric', type=str, default='mbo_i', help='validation metric of val_metrics.jsonl ranking the runs (mse, ari, mbo_i, ...)')
+    parser.add_argument('--mode', type=str, default='max', choices=['max', 'min'])
+    parser.add_argument('--gpus', type=str, default='', help='comma separated GPU ids, runs_per_gpu runs are packed on each of them (by default the runs use the cpu)')
+    parser.add_argument('--runs_per_gpu', type=int, default=1)
+    parser.add_argument('--threads_per_run', type=int, default=4, help='intra-op threads of each run, without gpus the runs are packed on the cpu cores')
+    parser.add_argument('--poll_interval', type=float, default=10.)
+
+    return parser
+
+
+def get_configs(grid):
+    names, values = [], []
+    for spec in grid:
+        name, spec_values = spec.split('=', 1)
+        names.append(name)
+        values.append(spec_values.split(','))
+    return [dict(zip(names, config_values)) for config_values in itertools.product(*values)]
+
+
+def get_rungs(min_epochs, eta, epochs):
+    # Epochs after which the runs are ranked: min_epochs, min_epochs * eta, ... and the full runs.
+    rungs = []
+    budget = min_epochs
+    while budget < epochs:
+        rungs.append(budget)
+        budget *= eta
+    return rungs + [epochs]
+
+
+def get_slots(args):
+    # Environment of each concurrent run.
+    threads = {'OMP_NUM_THREADS': str(args.threads_per_run), 'MKL_NUM_THREADS': str(args.threads_per_run)}
+    if args.gpus:
+        return [dict(threads, CUDA_VISIBLE_DEVICES=gpu) for gpu in args.gpus.split(',') for _ in range(args.runs_per_gpu)]
+    return [dict(threads, CUDA_VISIBLE_DEVICES='') for _ in range(max(1, (os.cpu_count() or 1) // args.threads_per_run))]
+
+
+class Run(object):
+    """
+    A configuration of the sweep, trained with its own log_path and continued with --auto_resume.
+    """
+    def __init__(self, config, args, train_args):
+        self.config = config
+        self.name = '__'.join('{}={}'.format(k, v) for k, v in config.items()) or 'default'
+        self.log_path = os.path.join(args.sweep_dir, self.name)
+        self.args = args
+        self.train_args = train_args
+        self.failed = False
+        self.log_file = None
+
+    def val_metrics(self):
+        checkpoint_path = find_last_checkpoint(self.log_path)
+        if checkpoint_path is None:
+            return {}
+        return read_val_metrics(os.path.dirname(checkpoint_path))
+
+    def score(self, budget):
+        # The metric of the last validation up to `budget` epochs.
+        metrics = {epoch: record for epoch, record in self.val_metrics().items() if epoch <= budget}
+        if self.failed or len(metrics) == 0:
+            return None
+        return metrics[max(metrics)][self.args.metric]
+
+    def is_done(self, budget):
+        return any(epoch >= budget for epoch in self.val_metrics())
+
+    def launch(self, budget, env):
+        os.makedirs(self.log_path, exist_ok=True)
+        command = [sys.executable, self.args.script] + self.train_args + [
+            '--epochs', str(self.args.epochs),
+            '--stop_at_epoch', str(budget),
+            '--log_path', self.log_path,
+            '--auto_resume', 'true',
+        ]
+        for name, value in self.config.items():
+            command += ['--' + name, value]
+        if env.get('CUDA_VISIBLE_DEVICES') == '':
+            command += ['--device', 'cpu']
+        # Open while the run trains, closed by reap().
+        self.log_file = open(os.path.join(self.log_path, 'sweep_run.log'), 'a')
+        print('====> Launching {} up to epoch {}'.format(self.name, budget))
+        return subprocess.Popen(command, env=dict(os.environ, **env), stdout=self.log_file, stderr=subprocess.STDOUT)
+
+    def reap(self):
+        self.log_file.close()
+        self.log_file = None
+
+
+def run_rung(runs, budget, slots, poll_interval):
+    # Trains the runs up to `budget` epochs, at most one run per slot at a time.
+    pending = [run for run in runs if not run.is_done(budget)]
+    free_slots = list(range(len(slots)))
+    running = []
+    while pending or running:
+        while pending and free_slots:
+            run = pending.pop(0)
+            slot = free_slots.pop(0)
+            running.append((run, slot, run.launch(budget, slots[slot])))
+        time.sleep(poll_interval)
+        for run, slot, process in list(running):
+            if process.poll() is not None:
+                running.remove((run, slot, process))
+                free_slots.append(slot)
+                run.reap()
+                if process.returncode != 0 or not run.is_done(budget):
+                    run.failed = True
+                    print('====> {} failed (exit code {}), see {}'.format(run.name, process.returncode,
+                                                                         os.path.join(run.log_path, 'sweep_run.log')))
+
+
+def sweep(args, train_args):
+    runs = [Run(config, args, train_args) for config in get_configs(args.grid)]
+    rungs = get_rungs(args.min_epochs, args.eta, args.epochs)
+    slots = get_slots(args)
+    os.makedirs(args.sweep_dir, exist_ok=True)
+    print('====> {} configurations, rungs at epochs {}, {} concurrent runs'.format(len(runs), rungs, len(slots)))
+
+    summary = {run.name: {'config': run.config, 'scores': {}} for run in runs}
+    for i, budget in enumerate(rungs):
+        run_rung(runs, budget, slots, args.poll_interval)
+
+        scored = []
+        for run in runs:
+            score = run.score(budget)
+            summary[run.name]['scores'][budget] = score
+            if score is not None:
+                scored.append((score, run))
+        scored.sort(key=lambda x: x[0], reverse=args.mode == 'max')
+        print('====> Rung {} ({} epochs):'.format(i + 1, budget))
+        for score, run in scored:
+            print('\t{} = {:F}\t{}'.format(args.metric, score, run.name))
+
+        if i < len(rungs) - 1:
+            runs = [run for _, run in scored[:max(1, math.ceil(len(scored) / args.eta))]]
+
+        with open(os.path.join(args.sweep_dir, 'sweep.json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+
+    if scored:
+        print('====> Best: {} with {} = {:F}'.format(scored[0][1].name, args.metric, scored[0][0]))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT sweep', parents=[get_args_parser()],
+                                     epilog='The other arguments (e.g. --dataset waterbird --data_path ...) are passed to every run.')
+    args, train_args = parser.parse_known_args()
+    sweep(args, train_args)
@@ -2,21 +2,24 @@ import math
 import copy
 import os.path
 import argparse
-from tqdm import tqdm
 from datetime import datetime
 
 import torch
 from torch.optim import Adam
 import torch.nn.functional as F
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, Subset
 from torch.nn.utils import clip_grad_norm_
 from torch.utils.tensorboard import SummaryWriter
-import torchvision.utils as vutils
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 
 from spot import SPOT
 from datasets import PascalVOC, COCO2017, MOVi, Waterbird
-from ocl_metrics import UnsupervisedMaskIoUMetric, ARIMetric
-from utils_spot import inv_normalize, cosine_scheduler, visualize, bool_flag, load_pretrained_encoder
+from evaluation import evaluate, visualize_batch, check_precision, stratified_subset, dataset_groups, group_names, METRIC_NAMES
+from utils_spot import cosine_scheduler, bool_flag, load_pretrained_encoder, get_autocast, PRECISIONS
+from utils_spot import ResumableRandomSampler, PreemptionHandler, TrainLogger, get_rng_state, set_rng_state, save_checkpoint, find_last_checkpoint, log_val_metrics
+from utils_spot import EarlyStopping, validation_epochs, save_eval_snapshot
+from utils_spot import init_distributed_mode, is_main_process, ShardSampler, NullWriter, ddp_sync_context
 import models_vit
 
 
@@ -24,18 +27,37 @@ def get_args_parser():
     parser = argparse.ArgumentParser('SPOT', add_help=False)
     
     parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--metric_workers', type=int, default=1, help='threads computing the validation metrics during the next forward passes (0 computes them after each batch)')
+    parser.add_argument('--device', type=str, default=None, help='cuda or cpu, by default cuda if available')
+    parser.add_argument('--dist_backend', type=str, default='gloo', help='backend of the process group when launched with torchrun (gloo or nccl)')
     parser.add_argument('--seed', type=int, default=0)
-    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--batch_size', type=int, default=64, help='total batch size, split over the processes')
+    parser.add_argument('--accum_steps', type=int, default=1, help='split each batch in this many micro-batches whose gradients are accumulated, the optimizer batch stays batch_size')
     parser.add_argument('--epochs', type=int, default=100)
-    parser.add_argument('--patience', type=int, default=4)
+    parser.add_argument('--patience', type=int, default=4, help='with --early_stopping, number of validations without improvement before stopping')
+    parser.add_argument('--early_stopping', type=bool_flag, default=False, help='stop when early_stop_metric has not improved for patience validations, best_model.pt then tracks the same metric')
+    parser.add_argument('--early_stop_metric', type=str, default='mse', help='mse (minimized) or ari, ari_slot, mbo_i, mbo_c, miou, ... (maximized), or e.g. mbo_i/worst_group on Waterbird')
+    parser.add_argument('--min_delta', type=float, default=0., help='minimum change of early_stop_metric counted as an improvement (in %% points for the segmentation metrics)')
+    parser.add_argument('--val_interval_max', type=int, default=1, help='validate every val_interval_max epochs at the beginning of the training, down to every epoch at the end (1 validates every epoch)')
+    parser.add_argument('--validate', type=bool_flag, default=True, help='validate in the training loop, false leaves the validation to eval_service.py (with --eval_snapshots)')
+    parser.add_argument('--eval_snapshots', type=bool_flag, default=False, help='write the weights of the validation epochs to log_dir/eval_snapshots, scored by eval_service.py concurrently with the training')
     parser.add_argument('--clip', type=float, default=0.3)
     parser.add_argument('--image_size', type=int, default=224)
     parser.add_argument('--val_image_size', type=int, default=224)
     parser.add_argument('--val_mask_size', type=int, default=320)
     parser.add_argument('--eval_batch_size', type=int, default=32)
     parser.add_argument('--eval_viz_percent', type=float, default=0.2)
+    parser.add_argument('--fast_val_size', type=int, default=0, help='validate the epochs on a fixed subset of about this many images, stratified by group ((y, place) for Waterbird), with bootstrap confidence intervals; best_model.pt and the last epoch are also evaluated on the full set (0 disables it)')
+    parser.add_argument('--fast_val_ari_pixels', type=int, default=0, help='with fast_val_size, compute the ARI on this many fixed random pixels of each image (0 uses all of them)')
+    parser.add_argument('--fast_val_bootstrap', type=int, default=1000, help='number of bootstrap resamples of the confidence intervals of the fast validation')
+    parser.add_argument('--precision', type=str, default='fp32', choices=PRECISIONS, help='autocast the forward passes to bf16 or fp16 (with loss scaling)')
+    parser.add_argument('--amp_check_batches', type=int, default=4, help='with bf16/fp16, first compare the validation metrics to fp32 on this many batches (0 disables it)')
+    parser.add_argument('--amp_check_tol', type=float, default=1.0, help='maximum allowed difference of the metrics to fp32, in %% points')
     
     parser.add_argument('--checkpoint_path', default='checkpoint.pt.tar', help='checkpoint to continue the training, loaded only if exists')
+    parser.add_argument('--stop_at_epoch', type=int, default=None, help='exit after the validation of this epoch, with the schedules of --epochs (the run can be continued later)')
+    parser.add_argument('--checkpoint_every_steps', type=int, default=0, help='also save a resumable mid-epoch checkpoint every N training steps (0 disables it)')
+    parser.add_argument('--auto_resume', type=bool_flag, default=False, help='if checkpoint_path does not exist, resume from the latest checkpoint under log_path (e.g. for requeued jobs)')
     parser.add_argument('--log_path', default='logs')
     parser.add_argument('--dataset', default='coco', help='coco or voc')
     parser.add_argument('--data_path',  type=str, help='dataset path')
@@ -66,6 +88,7 @@ def get_args_parser():
     parser.add_argument('--which_encoder',  type=str, default='dino_vitb16', help='dino_vitb16, dino_vits8, dinov2_vitb14_reg, dinov2_vits14_reg, dinov2_vitb14, dinov2_vits14, mae_vitb16')
     parser.add_argument('--finetune_blocks_after',  type=int, default=100, help='finetune the blocks from this and after (counting from 0), for vit-b values greater than 12 means keep everything frozen')
     parser.add_argument('--encoder_final_norm',  type=bool_flag, default=False)
+    parser.add_argument('--activation_checkpointing',  type=str, default='', help='comma separated parts whose activations are recomputed in the backward pass to save memory: encoder (the finetuned blocks), decoder (transformer blocks), slot_attn (iterations)')
     parser.add_argument('--pretrained_encoder_weights', type=str, default=None)
     parser.add_argument('--use_second_encoder',  type= bool_flag, default = False, help='different encoder for input and target of decoder')
     
@@ -78,13 +101,26 @@ def get_args_parser():
     return parser
 
 def train(args):
-    torch.manual_seed(args.seed)
+    init_distributed_mode(args)
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed + args.rank)
+    assert args.batch_size % (args.world_size * args.accum_steps) == 0, "batch_size must be divisible by world_size * accum_steps"
+    batch_size_per_process = args.batch_size // args.world_size
+    
+    log_dir = None
+    if args.auto_resume and not os.path.isfile(args.checkpoint_path):
+        last_checkpoint_path = find_last_checkpoint(args.log_path)
+        if last_checkpoint_path is not None:
+            args.checkpoint_path = last_checkpoint_path
+            log_dir = os.path.dirname(last_checkpoint_path) # continue writing in the same run directory
     
     arg_str_list = ['{}={}'.format(k, v) for k, v in vars(args).items()]
     arg_str = '__'.join(arg_str_list)
-    log_dir = os.path.join(args.log_path, datetime.today().isoformat())
+    if log_dir is None:
+        log_dir = os.path.join(args.log_path, datetime.today().isoformat())
     print('log_dir: ', log_dir)
-    writer = SummaryWriter(log_dir)
+    # Only the main process logs and checkpoints.
+    writer = SummaryWriter(log_dir) if is_main_process() else NullWriter()
     writer.add_text('hparams', arg_str)
     
     if args.dataset == 'voc':
@@ -100,45 +136,51 @@ def train(args):
         train_dataset = Waterbird(root=args.data_path, split='train', image_size=args.image_size, mask_size = args.image_size)
         val_dataset = Waterbird(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
     
-    train_sampler = None
-    val_sampler = None
+    train_sampler = ResumableRandomSampler(train_dataset, seed=args.seed, num_replicas=args.world_size, rank=args.rank)
+    val_sampler = ShardSampler(val_dataset, num_replicas=args.world_size, rank=args.rank)
     
     loader_kwargs = {
         'num_workers': args.num_workers,
         'pin_memory': True,
     }
     
-    train_loader = DataLoader(train_dataset, sampler=train_sampler, shuffle=True, drop_last = True, batch_size=args.batch_size, **loader_kwargs)
+    train_loader = DataLoader(train_dataset, sampler=train_sampler, shuffle=False, drop_last = True, batch_size=batch_size_per_process, **loader_kwargs)
     val_loader = DataLoader(val_dataset, sampler=val_sampler, shuffle=False, drop_last = False, batch_size=args.eval_batch_size, **loader_kwargs)
     
+    # Group-wise metrics and worst group on the datasets with groups of images (the (y, place) groups of Waterbird).
+    val_groups = group_names(val_dataset) if hasattr(val_dataset, 'get_group') else None
+    
+    if args.fast_val_size > 0:
+        # The same stratified subset of the validation images in every epoch, so that the epochs can be compared.
+        fast_val_dataset = Subset(val_dataset, stratified_subset(dataset_groups(val_dataset), args.fast_val_size, seed=args.seed))
+        fast_val_sampler = ShardSampler(fast_val_dataset, num_replicas=args.world_size, rank=args.rank)
+        fast_val_loader = DataLoader(fast_val_dataset, sampler=fast_val_sampler, shuffle=False, drop_last = False, batch_size=args.eval_batch_size, **loader_kwargs)
+        fast_val_kwargs = {'bootstrap': args.fast_val_bootstrap, 'ari_pixels': args.fast_val_ari_pixels or None,
+                           'groups': [val_groups[i] for i in fast_val_dataset.indices] if val_groups is not None else None}
+    else:
+        fast_val_loader = val_loader
+        fast_val_kwargs = {'groups': val_groups}
+    
     train_epoch_size = len(train_loader)
     val_epoch_size = len(val_loader)
     
-    log_interval = train_epoch_size // 5
+    log_interval = max(train_epoch_size // 5, 1)
     
     if args.which_encoder == 'dino_vitb16':
-        args.max_tokens = int((args.val_image_size/16)**2)
         encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vitb16')
     elif args.which_encoder == 'dino_vits8':
-        args.max_tokens = int((args.val_image_size/8)**2)
         encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vits8')
     elif args.which_encoder == 'dino_vitb8':
-        args.max_tokens = int((args.val_image_size/8)**2)
         encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vitb8')
     elif args.which_encoder == 'dinov2_vitb14':
-        args.max_tokens = int((args.val_image_size/14)**2)
         encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14')
     elif args.which_encoder == 'dinov2_vits14':
-        args.max_tokens = int((args.val_image_size/14)**2)
         encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14')
     elif args.which_encoder == 'dinov2_vitb14_reg':
-        args.max_tokens = int((args.val_image_size/14)**2)
         encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14_reg')
     elif args.which_encoder == 'dinov2_vits14_reg':
-        args.max_tokens = int((args.val_image_size/14)**2)
         encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14_reg')
     elif args.which_encoder == 'mae_vitb16':
-        args.max_tokens = int((args.val_image_size/16)**2)
         encoder = models_vit.__dict__["vit_base_patch16"](num_classes=0, global_pool=False, drop_path_rate=0)
         assert args.pretrained_encoder_weights is not None
         load_pretrained_encoder(encoder, args.pretrained_encoder_weights, prefix=None) 
@@ -160,6 +202,7 @@ def train(args):
     if os.path.isfile(args.checkpoint_path):
         checkpoint = torch.load(args.checkpoint_path, map_location='cpu')
         start_epoch = checkpoint['epoch']
+        start_batch = checkpoint.get('batch', 0)
         best_val_loss = checkpoint['best_val_loss']
         best_val_ari = checkpoint['best_val_ari']
         best_val_ari_slot = checkpoint['best_val_ari_slot']
@@ -177,6 +220,7 @@ def train(args):
         print('No checkpoint_path found')
         checkpoint = None
         start_epoch = 0
+        start_batch = 0
         best_val_loss = math.inf
         best_epoch = 0
         best_val_ari = 0
@@ -188,7 +232,7 @@ def train(args):
         best_mbo_i_slot = 0
         best_miou_slot= 0 
     
-    model = model.cuda()
+    model = model.to(device)
     
     lr_schedule = cosine_scheduler( base_value = args.lr_main,
                                     final_value = args.lr_min,
@@ -197,31 +241,85 @@ def train(args):
                                     warmup_epochs=int(args.lr_warmup_steps/(len(train_dataset)/args.batch_size)),
                                     start_warmup_value=0)
     
+    # Only the trainable parameters are optimized and clipped, the frozen encoder(s) are skipped.
+    trainable_params = [param for param in model.parameters() if param.requires_grad]
+    
     optimizer = Adam([
-        {'params': (param for name, param in model.named_parameters() if param.requires_grad), 'lr': args.lr_main},
+        {'params': trainable_params, 'lr': args.lr_main},
     ])
+    # Loss scaling is only needed for fp16, the scaler is a no-op otherwise.
+    scaler = torch.cuda.amp.GradScaler(enabled=args.precision == 'fp16')
+    
+    # The forward passes of the training go through DDP, which all-reduces the gradients. The rest
+    # (evaluation, checkpoints) uses the module itself.
+    if args.world_size > 1:
+        # Depending on the random masking, the CAPPA mask token may not be used in a step.
+        ddp_model = DistributedDataParallel(model, device_ids=[device] if device.type == 'cuda' else None,
+                                            find_unused_parameters=args.cappa > 0)
+    else:
+        ddp_model = model
+    early_stopping = EarlyStopping(args.early_stop_metric, args.patience, args.min_delta)
     if checkpoint is not None:
         optimizer.load_state_dict(checkpoint['optimizer'])
-    
-    MBO_c_metric = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True).cuda()
-    MBO_i_metric = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True).cuda()
-    miou_metric = UnsupervisedMaskIoUMetric(matching="hungarian", ignore_background = True, ignore_overlaps = True).cuda()
-    ari_metric = ARIMetric(foreground = True, ignore_overlaps = True).cuda()
-    
-    MBO_c_slot_metric = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True).cuda()
-    MBO_i_slot_metric = UnsupervisedMaskIoUMetric(matching="best_overlap", ignore_background = True, ignore_overlaps = True).cuda()
-    miou_slot_metric = UnsupervisedMaskIoUMetric(matching="hungarian", ignore_background = True, ignore_overlaps = True).cuda()
-    ari_slot_metric = ARIMetric(foreground = True, ignore_overlaps = True).cuda()
+        if 'scaler' in checkpoint:
+            scaler.load_state_dict(checkpoint['scaler'])
+        if 'lr_schedule' in checkpoint:
+            lr_schedule = checkpoint['lr_schedule']
+        if 'early_stopping' in checkpoint:
+            early_stopping.load_state_dict(checkpoint['early_stopping'])
+        if 'rng_state' in checkpoint and args.world_size == 1:
+            # The saved state is the one of the main process, the others keep their own seed.
+            set_rng_state(checkpoint['rng_state'])
+    
+    if args.precision != 'fp32' and args.amp_check_batches > 0:
+        check_precision(model, val_loader, args.val_mask_size, args.precision, args.amp_check_batches, args.amp_check_tol,
+                        seed=args.seed, metric_workers=args.metric_workers)
     
     visualize_per_epoch = int(args.epochs*args.eval_viz_percent)
     
-    for epoch in range(start_epoch, args.epochs):
+    def get_checkpoint(epoch, batch):
+        # `epoch` and `batch` count the completed epochs and the completed steps of the current one.
+        return {
+            'epoch': epoch,
+            'batch': batch,
+            'best_val_loss': best_val_loss,
+            'best_val_ari': best_val_ari,
+            'best_val_ari_slot': best_val_ari_slot,
+            'best_mbo_c':best_mbo_c,
+            'best_mbo_i':best_mbo_i,
+            'best_miou':best_miou,
+            'best_mbo_c_slot':best_mbo_c_slot,
+            'best_mbo_i_slot':best_mbo_i_slot,
+            'best_miou_slot':best_miou_slot,
+            'best_epoch': best_epoch,
+            'args': vars(args),
+            'model': model.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scaler': scaler.state_dict(),
+            'lr_schedule': lr_schedule,
+            'early_stopping': early_stopping.state_dict(),
+            'rng_state': get_rng_state(),
+        }
+    
+    checkpoint_path = os.path.join(log_dir, 'checkpoint.pt.tar')
+    preemption = PreemptionHandler()
+    train_logger = TrainLogger(writer)
+    
+    end_epoch = args.epochs if args.stop_at_epoch is None else min(args.stop_at_epoch, args.epochs)
+    if args.early_stopping and early_stopping.should_stop:
+        end_epoch = start_epoch # the run already stopped
+    # The epoch of --stop_at_epoch is always validated, the sweep reads its metrics.
+    val_epochs = validation_epochs(args.epochs, args.val_interval_max) | {end_epoch}
+    assert args.validate or not args.early_stopping, '--early_stopping needs --validate'
+    for epoch in range(start_epoch, end_epoch):
     
         model.train()
+        train_sampler.set_epoch(epoch, start_index=start_batch*batch_size_per_process)
+        train_logger.reset()
     
-        for batch, image in enumerate(train_loader):
+        for batch, image in enumerate(train_loader, start=start_batch):
             
-            image = image.cuda()
+            image = image.to(device)
 
             global_step = epoch * train_epoch_size + batch
     
@@ -229,78 +327,73 @@ def train(args):
             lr_value = optimizer.param_groups[0]['lr']
             
             optimizer.zero_grad()
-            mse, _, _, _, _, _ = model(image)
+            
+            # The batch is processed in accum_steps micro-batches, each loss is weighted by the share of
+            # the micro-batch so that the accumulated gradient is the one of the whole batch.
+            mse = 0.
+            for i, image_micro in enumerate(image.chunk(args.accum_steps)):
+                weight = image_micro.shape[0] / image.shape[0]
+                with ddp_sync_context(ddp_model, sync=i == args.accum_steps - 1):
+                    with get_autocast(args.precision, device.type):
+                        mse_micro = ddp_model(image_micro, outputs=())
+
+                    scaler.scale(weight * mse_micro).backward()
+                mse = mse + weight * mse_micro.detach()
 
-            mse.backward()
-            total_norm = clip_grad_norm_(model.parameters(), args.clip, 'inf')
-            total_norm = total_norm.item()
-            optimizer.step()
+            scaler.unscale_(optimizer)
+            total_norm = clip_grad_norm_(trainable_params, args.clip, 'inf')
+            scaler.step(optimizer)
+            scaler.update()
             
-            with torch.no_grad():
-                if batch % log_interval == 0:
-                    print('Train Epoch: {:3} [{:5}/{:5}] \t lr = {:5} \t MSE: {:F} \t TotNorm: {:F}'.format(
-                          epoch+1, batch, train_epoch_size, lr_value, mse.item(), total_norm))
-    
-                    writer.add_scalar('TRAIN/mse', mse.item(), global_step)
-                    writer.add_scalar('TRAIN/lr_main', lr_value, global_step)
-                    writer.add_scalar('TRAIN/total_norm', total_norm, global_step)
+            # Statistics stay on the device and are only synced every log_interval steps.
+            train_logger.update(mse=mse, total_norm=total_norm)
+            if (batch + 1) % log_interval == 0:
+                writer.add_scalar('TRAIN/lr_main', lr_value, global_step)
+                train_logger.flush(global_step, 'Train Epoch: {:3} [{:5}/{:5}] \t lr = {:5}'.format(
+                                   epoch+1, batch+1, train_epoch_size, lr_value))
+            
+            # With several processes, the preemption flag is only synchronized every log_interval steps.
+            stop = preemption.synchronize(device, batch, log_interval)
+            if stop or (args.checkpoint_every_steps > 0 and (global_step + 1) % args.checkpoint_every_steps == 0):
+                save_checkpoint(get_checkpoint(epoch, batch + 1), checkpoint_path)
+                if stop:
+                    print('====> Saved checkpoint at epoch {} step {}, exiting'.format(epoch + 1, batch + 1))
+                    writer.close()
+                    return
+        
+        start_batch = 0
 
-        with torch.no_grad():
-            model.eval()
+        if args.eval_snapshots and (epoch + 1) in val_epochs:
+            save_eval_snapshot(model, args, log_dir, epoch + 1)
 
-            val_mse = 0.
-            counter = 0
-    
-            for batch, (image, true_mask_i, true_mask_c, mask_ignore) in enumerate(tqdm(val_loader)):
-                image = image.cuda()
-                true_mask_i = true_mask_i.cuda()
-                true_mask_c = true_mask_c.cuda()
-                mask_ignore = mask_ignore.cuda() 
-                
-                batch_size = image.shape[0]
-                counter += batch_size
-    
-                mse, default_slots_attns, dec_slots_attns, _, _, _ = model(image)
-    
-                # DINOSAUR uses as attention masks the attenton maps of the decoder
-                # over the slots, which bilinearly resizes to match the image resolution
-                # dec_slots_attns shape: [B, num_slots, H_enc, W_enc]
-                default_attns = F.interpolate(default_slots_attns, size=args.val_mask_size, mode='bilinear')
-                dec_attns = F.interpolate(dec_slots_attns, size=args.val_mask_size, mode='bilinear')
-                # dec_attns shape [B, num_slots, H, W]
-                default_attns = default_attns.unsqueeze(2)
-                dec_attns = dec_attns.unsqueeze(2) # shape [B, num_slots, 1, H, W]
-    
-                pred_default_mask = default_attns.argmax(1).squeeze(1)
-                pred_dec_mask = dec_attns.argmax(1).squeeze(1)
-    
-                val_mse += mse.item()
+        # Once the metric stops improving, every epoch is validated until it improves again or the training stops.
+        if not args.validate or ((epoch + 1) not in val_epochs and not (args.early_stopping and early_stopping.num_bad > 0)):
+            save_checkpoint(get_checkpoint(epoch + 1, 0), checkpoint_path)
+            if preemption.synchronize(device):
+                print('====> Saved checkpoint at epoch {}, exiting'.format(epoch + 1))
+                break
+            continue
 
-                # Compute ARI, MBO_i and MBO_c, miou scores for both slot attention and decoder
-                true_mask_i_reshaped = torch.nn.functional.one_hot(true_mask_i).to(torch.float32).permute(0,3,1,2).cuda()
-                true_mask_c_reshaped = torch.nn.functional.one_hot(true_mask_c).to(torch.float32).permute(0,3,1,2).cuda()
-                pred_dec_mask_reshaped = torch.nn.functional.one_hot(pred_dec_mask).to(torch.float32).permute(0,3,1,2).cuda()
-                pred_default_mask_reshaped = torch.nn.functional.one_hot(pred_default_mask).to(torch.float32).permute(0,3,1,2).cuda()
-                
-                MBO_i_metric.update(pred_dec_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-                MBO_c_metric.update(pred_dec_mask_reshaped, true_mask_c_reshaped, mask_ignore)
-                miou_metric.update(pred_dec_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-                ari_metric.update(pred_dec_mask_reshaped, true_mask_i_reshaped, mask_ignore)
+        with torch.no_grad():
+            val_results, val_last = evaluate(model, fast_val_loader, args.val_mask_size, args.precision,
+                                             should_stop=lambda: preemption.requested, metric_workers=args.metric_workers, **fast_val_kwargs)
             
-                MBO_i_slot_metric.update(pred_default_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-                MBO_c_slot_metric.update(pred_default_mask_reshaped, true_mask_c_reshaped, mask_ignore)
-                miou_slot_metric.update(pred_default_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-                ari_slot_metric.update(pred_default_mask_reshaped, true_mask_i_reshaped, mask_ignore)
-    
-            val_mse /= (val_epoch_size)
-            ari = 100 * ari_metric.compute()
-            ari_slot = 100 * ari_slot_metric.compute()
-            mbo_c = 100 * MBO_c_metric.compute()
-            mbo_i = 100 * MBO_i_metric.compute()
-            miou = 100 * miou_metric.compute()
-            mbo_c_slot = 100 * MBO_c_slot_metric.compute()
-            mbo_i_slot = 100 * MBO_i_slot_metric.compute()
-            miou_slot = 100 * miou_slot_metric.compute()
+            if val_results is None:
+                # The training part of the epoch is done, redo only the validation when resuming.
+                save_checkpoint(get_checkpoint(epoch, train_epoch_size), checkpoint_path)
+                print('====> Saved checkpoint at epoch {} before validation, exiting'.format(epoch + 1))
+                writer.close()
+                return
+    
+            val_mse = val_results['mse']
+            ari = val_results['ari']
+            ari_slot = val_results['ari_slot']
+            mbo_c = val_results['mbo_c']
+            mbo_i = val_results['mbo_i']
+            miou = val_results['miou']
+            mbo_c_slot = val_results['mbo_c_slot']
+            mbo_i_slot = val_results['mbo_i_slot']
+            miou_slot = val_results['miou_slot']
             val_loss = val_mse
             writer.add_scalar('VAL/mse', val_mse, epoch+1)
             writer.add_scalar('VAL/ari (slots)', ari_slot, epoch+1)
@@ -311,21 +404,26 @@ def train(args):
             writer.add_scalar('VAL/mbo_c (slots)', mbo_c_slot, epoch+1)
             writer.add_scalar('VAL/mbo_i (slots)', mbo_i_slot, epoch+1)
             writer.add_scalar('VAL/miou (slots)', miou_slot, epoch+1)
+            for name, value in val_results.items():
+                if '/' in name:
+                    writer.add_scalar('VAL_GROUPS/{}'.format(name), value, epoch+1)
+            log_val_metrics(log_dir, epoch+1, val_results)
             
             print(args.log_path)
             print('====> Epoch: {:3} \t Loss = {:F} \t MSE = {:F} \t ARI = {:F} \t ARI_slots = {:F} \t mBO_c = {:F} \t mBO_i = {:F} \t miou = {:F} \t mBO_c_slots = {:F} \t mBO_i_slots = {:F} \t miou_slots = {:F}'.format(
                 epoch+1, val_loss, val_mse, ari, ari_slot, mbo_c, mbo_i, miou, mbo_c_slot, mbo_i_slot, miou_slot))
+            if args.fast_val_size > 0:
+                print('====> Fast validation on {} images, 95% CIs: {}'.format(len(fast_val_dataset), ' \t '.join(
+                    '{} = [{:F}, {:F}]'.format(name, val_results[name + '_ci_low'], val_results[name + '_ci_high']) for name in METRIC_NAMES)))
+            if val_groups is not None:
+                print('====> Worst group: {}'.format(' \t '.join('{} = {:F}'.format(name, val_results[name + '/worst_group']) for name in METRIC_NAMES)))
             
-            ari_metric.reset()
-            MBO_c_metric.reset()
-            MBO_i_metric.reset()
-            miou_metric.reset()
-            MBO_c_slot_metric.reset()
-            MBO_i_slot_metric.reset()
-            ari_slot_metric.reset()
-            miou_slot_metric.reset()
-            
-            if (val_loss < best_val_loss) or (best_val_ari > ari) or (best_mbo_c > mbo_c):
+            improved = early_stopping.update(val_results)
+            if args.early_stopping:
+                is_best = improved
+            else:
+                is_best = (val_loss < best_val_loss) or (best_val_ari > ari) or (best_mbo_c > mbo_c)
+            if is_best:
                 best_val_loss = val_loss
                 best_val_ari = ari
                 best_val_ari_slot = ari_slot
@@ -337,42 +435,38 @@ def train(args):
                 best_miou_slot = miou_slot
                 best_epoch = epoch + 1
     
-                torch.save(model.state_dict(), os.path.join(log_dir, 'best_model.pt'))
+                save_checkpoint(model.state_dict(), os.path.join(log_dir, 'best_model.pt'))
+            
+            last_epoch = epoch == end_epoch - 1 or (args.early_stopping and early_stopping.should_stop)
+            if args.fast_val_size > 0 and (is_best or last_epoch):
+                # The fast validation only compares the epochs, best_model.pt and the last epoch get the exact metrics.
+                full_results, _ = evaluate(model, val_loader, args.val_mask_size, args.precision, metric_workers=args.metric_workers, groups=val_groups)
+                for name, value in full_results.items():
+                    writer.add_scalar('VAL_FULL/{}'.format(name), value, epoch+1)
+                log_val_metrics(log_dir, epoch+1, full_results, name='val_metrics_full.jsonl')
+                print('====> Full validation: {}'.format(' \t '.join('{} = {:F}'.format(name, value) for name, value in full_results.items())))
                 
-            if epoch%visualize_per_epoch==0 or epoch==args.epochs-1:
-                image = inv_normalize(image)
-                image = F.interpolate(image, size=args.val_mask_size, mode='bilinear')
-                rgb_default_attns = image.unsqueeze(1) * default_attns + 1. - default_attns
-                rgb_dec_attns = image.unsqueeze(1) * dec_attns + 1. - dec_attns
-    
-                vis_recon = visualize(image, true_mask_c, pred_dec_mask, rgb_dec_attns, pred_default_mask, rgb_default_attns, N=32)
-                grid = vutils.make_grid(vis_recon, nrow=2*args.num_slots + 4, pad_value=0.2)[:, 2:-2, 2:-2]
-                grid = F.interpolate(grid.unsqueeze(1), scale_factor=0.15, mode='bilinear').squeeze() # Lower resolution
+            if (epoch%visualize_per_epoch==0 or epoch==args.epochs-1) and is_main_process():
+                grid = visualize_batch(val_last, args.num_slots, args.val_mask_size, scale_factor=0.15)
                 writer.add_image('VAL_recon/epoch={:03}'.format(epoch + 1), grid)
     
             writer.add_scalar('VAL/best_loss', best_val_loss, epoch+1)
     
-            checkpoint = {
-                'epoch': epoch + 1,
-                'best_val_loss': best_val_loss,
-                'best_val_ari': best_val_ari,
-                'best_val_ari_slot': best_val_ari_slot,
-                'best_mbo_c':best_mbo_c,
-                'best_mbo_i':best_mbo_i,
-                'best_miou':best_miou,
-                'best_mbo_c_slot':best_mbo_c_slot,
-                'best_mbo_i_slot':best_mbo_i_slot,
-                'best_miou_slot':best_miou_slot,
-                'best_epoch': best_epoch,
-                'model': model.state_dict(),
-                'optimizer': optimizer.state_dict()
-            }
-    
-            torch.save(checkpoint, os.path.join(log_dir, 'checkpoint.pt.tar'))
+            save_checkpoint(get_checkpoint(epoch + 1, 0), checkpoint_path)
     
             print('====> Best Loss = {:F} @ Epoch {}'.format(best_val_loss, best_epoch))
+
+            if args.early_stopping and early_stopping.should_stop:
+                print('====> No improvement of {} in the last {} validations, stopping'.format(args.early_stop_metric, args.patience))
+                break
+        
+        if preemption.synchronize(device):
+            print('====> Saved checkpoint at epoch {}, exiting'.format(epoch + 1))
+            break
     
     writer.close()
+    if args.world_size > 1:
+        dist.destroy_process_group()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser('SPOT', parents=[get_args_parser()])
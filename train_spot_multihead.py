@@ -0,0 +1,392 @@
+''' Trains SPOT models with different numbers of slots on one frozen encoder, paying the data loading and encoder cost once. '''
+
+import math
+import copy
+import os.path
+import argparse
+from datetime import datetime
+
+import torch
+from torch.optim import Adam
+from torch.utils.data import DataLoader
+from torch.nn.utils import clip_grad_norm_
+from torch.utils.tensorboard import SummaryWriter
+
+from spot import SPOT
+from datasets import PascalVOC, COCO2017, MOVi, Waterbird
+from evaluation import evaluate_models, visualize_batch, check_precision, group_names, METRIC_NAMES
+from train_spot import get_args_parser as get_train_args_parser
+from utils_spot import cosine_scheduler, load_pretrained_encoder, get_autocast
+from utils_spot import ResumableRandomSampler, PreemptionHandler, TrainLogger, get_rng_state, set_rng_state, save_checkpoint, find_last_checkpoint, log_val_metrics
+from utils_spot import EarlyStopping, validation_epochs
+from utils_spot import init_distributed_mode
+import models_vit
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('SPOT multi-head', add_help=False, parents=[get_train_args_parser()])
+    parser.add_argument('--num_slots_list', type=str, default='2,3,6', help='comma separated numbers of slots, one model is trained for each of them (--num_slots is ignored)')
+    parser.add_argument('--resume_dir', type=str, default=None, help='run directory of a multi-head training to continue, with a sn<num_slots>/checkpoint.pt.tar per model')
+    return parser
+
+
+class Head(object):
+    """
+    One SPOT model of the multi-head training (its own slot attention and decoder on the shared encoders),
+    with its optimizer, learning rate schedule, loss scaler, TensorBoard logs and checkpoints in log_dir.
+    The checkpoints have the format of train_spot.py.
+    """
+    def __init__(self, args, encoders, log_dir, device, niter_per_ep, warmup_epochs, resume_path=None):
+        self.args = args
+        self.log_dir = log_dir
+        self.checkpoint_path = os.path.join(log_dir, 'checkpoint.pt.tar')
+        self.writer = SummaryWriter(log_dir)
+        self.writer.add_text('hparams', '__'.join('{}={}'.format(k, v) for k, v in vars(args).items()))
+        self.logger = TrainLogger(self.writer)
+
+        self.model = SPOT(encoders[0], args, encoders[1])
+        assert not any(param.requires_grad for param in encoders[0].parameters()), \
+            'the heads share the encoder tokens, the encoder must be frozen (finetune_blocks_after >= number of blocks)'
+
+        self.best = {
+            'best_val_loss': math.inf,
+            'best_val_ari': 0,
+            'best_val_ari_slot': 0,
+            'best_mbo_c': 0,
+            'best_mbo_i': 0,
+            'best_miou': 0,
+            'best_mbo_c_slot': 0,
+            'best_mbo_i_slot': 0,
+            'best_miou_slot': 0,
+            'best_epoch': 0,
+        }
+        checkpoint = None
+        if resume_path is not None:
+            checkpoint = torch.load(resume_path, map_location='cpu')
+            self.best = {name: checkpoint[name] for name in self.best}
+            print(self.model.load_state_dict(checkpoint['model'], strict=True))
+
+        self.model = self.model.to(device)
+
+        self.lr_schedule = cosine_scheduler( base_value = args.lr_main,
+                                             final_value = args.lr_min,
+                                             epochs = args.epochs,
+                                             niter_per_ep = niter_per_ep,
+                                             warmup_epochs=warmup_epochs,
+                                             start_warmup_value=0)
+        self.trainable_params = [param for param in self.model.parameters() if param.requires_grad]
+        self.optimizer = Adam([
+            {'params': self.trainable_params, 'lr': args.lr_main},
+        ])
+        self.scaler = torch.cuda.amp.GradScaler(enabled=args.precision == 'fp16')
+        self.early_stopping = EarlyStopping(args.early_stop_metric, args.patience, args.min_delta)
+
+        self.start_epoch, self.start_batch = 0, 0
+        if checkpoint is not None:
+            self.start_epoch = checkpoint['epoch']
+            self.start_batch = checkpoint.get('batch', 0)
+            self.optimizer.load_state_dict(checkpoint['optimizer'])
+            self.scaler.load_state_dict(checkpoint['scaler'])
+            self.lr_schedule = checkpoint['lr_schedule']
+            if 'early_stopping' in checkpoint:
+                self.early_stopping.load_state_dict(checkpoint['early_stopping'])
+            self.rng_state = checkpoint['rng_state']
+
+    def get_checkpoint(self, epoch, batch):
+        # `epoch` and `batch` count the completed epochs and the completed steps of the current one.
+        checkpoint = {'epoch': epoch, 'batch': batch}
+        checkpoint.update(self.best)
+        checkpoint.update({
+            'args': vars(self.args),
+            'model': self.model.state_dict(),
+            'optimizer': self.optimizer.state_dict(),
+            'scaler': self.scaler.state_dict(),
+            'lr_schedule': self.lr_schedule,
+            'early_stopping': self.early_stopping.state_dict(),
+            'rng_state': get_rng_state(),
+        })
+        return checkpoint
+
+    @property
+    def stopped(self):
+        return self.args.early_stopping and self.early_stopping.should_stop
+
+    def step(self, global_step, loss):
+        # The gradients of the head were accumulated by the backward passes of the micro-batches.
+        self.optimizer.param_groups[0]['lr'] = self.lr_schedule[global_step]
+        self.scaler.unscale_(self.optimizer)
+        total_norm = clip_grad_norm_(self.trainable_params, self.args.clip, 'inf')
+        self.scaler.step(self.optimizer)
+        self.scaler.update()
+        self.optimizer.zero_grad()
+        self.logger.update(mse=loss, total_norm=total_norm)
+
+    def validate(self, epoch, val_results, val_last, visualize):
+        writer = self.writer
+        val_mse = val_results['mse']
+        ari = val_results['ari']
+        ari_slot = val_results['ari_slot']
+        mbo_c = val_results['mbo_c']
+        mbo_i = val_results['mbo_i']
+        miou = val_results['miou']
+        mbo_c_slot = val_results['mbo_c_slot']
+        mbo_i_slot = val_results['mbo_i_slot']
+        miou_slot = val_results['miou_slot']
+        val_loss = val_mse
+        writer.add_scalar('VAL/mse', val_mse, epoch+1)
+        writer.add_scalar('VAL/ari (slots)', ari_slot, epoch+1)
+        writer.add_scalar('VAL/ari (decoder)', ari, epoch+1)
+        writer.add_scalar('VAL/mbo_c', mbo_c, epoch+1)
+        writer.add_scalar('VAL/mbo_i', mbo_i, epoch+1)
+        writer.add_scalar('VAL/miou', miou, epoch+1)
+        writer.add_scalar('VAL/mbo_c (slots)', mbo_c_slot, epoch+1)
+        writer.add_scalar('VAL/mbo_i (slots)', mbo_i_slot, epoch+1)
+        writer.add_scalar('VAL/miou (slots)', miou_slot, epoch+1)
+        for name, value in val_results.items():
+            if '/' in name:
+                writer.add_scalar('VAL_GROUPS/{}'.format(name), value, epoch+1)
+        log_val_metrics(self.log_dir, epoch+1, val_results)
+
+        print(self.log_dir)
+        print('====> Epoch: {:3} \t Loss = {:F} \t MSE = {:F} \t ARI = {:F} \t ARI_slots = {:F} \t mBO_c = {:F} \t mBO_i = {:F} \t miou = {:F} \t mBO_c_slots = {:F} \t mBO_i_slots = {:F} \t miou_slots = {:F}'.format(
+            epoch+1, val_loss, val_mse, ari, ari_slot, mbo_c, mbo_i, miou, mbo_c_slot, mbo_i_slot, miou_slot))
+        if 'mbo_i/worst_group' in val_results:
+            print('====> Worst group: {}'.format(' \t '.join('{} = {:F}'.format(name, val_results[name + '/worst_group']) for name in METRIC_NAMES)))
+
+        best = self.best
+        improved = self.early_stopping.update(val_results)
+        if self.args.early_stopping:
+            is_best = improved
+        else:
+            is_best = (val_loss < best['best_val_loss']) or (best['best_val_ari'] > ari) or (best['best_mbo_c'] > mbo_c)
+        if is_best:
+            best.update({
+                'best_val_loss': val_loss,
+                'best_val_ari': ari,
+                'best_val_ari_slot': ari_slot,
+                'best_mbo_c': mbo_c,
+                'best_mbo_i': mbo_i,
+                'best_miou': miou,
+                'best_mbo_c_slot': mbo_c_slot,
+                'best_mbo_i_slot': mbo_i_slot,
+                'best_miou_slot': miou_slot,
+                'best_epoch': epoch + 1,
+            })
+            save_checkpoint(self.model.state_dict(), os.path.join(self.log_dir, 'best_model.pt'))
+
+        if visualize:
+            grid = visualize_batch(val_last, self.args.num_slots, self.args.val_mask_size, scale_factor=0.15)
+            writer.add_image('VAL_recon/epoch={:03}'.format(epoch + 1), grid)
+
+        writer.add_scalar('VAL/best_loss', best['best_val_loss'], epoch+1)
+        save_checkpoint(self.get_checkpoint(epoch + 1, 0), self.checkpoint_path)
+        print('====> Best Loss = {:F} @ Epoch {}'.format(best['best_val_loss'], best['best_epoch']))
+        if self.stopped:
+            print('====> sn{}: no improvement of {} in the last {} validations, stopping'.format(
+                self.args.num_slots, self.args.early_stop_metric, self.args.patience))
+
+
+def train(args):
+    init_distributed_mode(args)
+    assert args.world_size == 1, 'the multi-head training runs in a single process'
+    assert args.fast_val_size == 0, 'the multi-head training always runs the full validation'
+    device = torch.device(args.device)
+    torch.manual_seed(args.seed)
+    assert args.batch_size % args.accum_steps == 0, "batch_size must be divisible by accum_steps"
+    num_slots_list = [int(num_slots) for num_slots in args.num_slots_list.split(',')]
+
+    if args.resume_dir is None and args.auto_resume:
+        last_checkpoint_path = find_last_checkpoint(args.log_path, os.path.join('sn{}'.format(num_slots_list[0]), 'checkpoint.pt.tar'))
+        if last_checkpoint_path is not None:
+            args.resume_dir = os.path.dirname(os.path.dirname(last_checkpoint_path))
+    # Continue writing in the same run directory.
+    log_dir = args.resume_dir if args.resume_dir is not None else os.path.join(args.log_path, datetime.today().isoformat())
+    print('log_dir: ', log_dir)
+
+    if args.dataset == 'voc':
+        train_dataset = PascalVOC(root=args.data_path, split='trainaug', image_size=args.image_size, mask_size = args.image_size)
+        val_dataset = PascalVOC(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
+    elif args.dataset == 'coco':
+        train_dataset = COCO2017(root=args.data_path, split='train', image_size=args.image_size, mask_size = args.image_size)
+        val_dataset = COCO2017(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
+    elif args.dataset == 'movi':
+        train_dataset = MOVi(root=os.path.join(args.data_path, 'train'), split='train', image_size=args.image_size, mask_size = args.image_size, frames_per_clip=9, predefined_json_paths = args.predefined_movi_json_paths)
+        val_dataset = MOVi(root=os.path.join(args.data_path, 'validation'), split='validation', image_size=args.val_image_size, mask_size = args.val_mask_size)
+    elif args.dataset == 'waterbird':
+        train_dataset = Waterbird(root=args.data_path, split='train', image_size=args.image_size, mask_size = args.image_size)
+        val_dataset = Waterbird(root=args.data_path, split='val', image_size=args.val_image_size, mask_size = args.val_mask_size)
+
+    train_sampler = ResumableRandomSampler(train_dataset, seed=args.seed)
+
+    loader_kwargs = {
+        'num_workers': args.num_workers,
+        'pin_memory': True,
+    }
+
+    train_loader = DataLoader(train_dataset, sampler=train_sampler, shuffle=False, drop_last = True, batch_size=args.batch_size, **loader_kwargs)
+    val_loader = DataLoader(val_dataset, shuffle=False, drop_last = False, batch_size=args.eval_batch_size, **loader_kwargs)
+
+    # Group-wise metrics and worst group on the datasets with groups of images (the (y, place) groups of Waterbird).
+    val_groups = group_names(val_dataset) if hasattr(val_dataset, 'get_group') else None
+
+    train_epoch_size = len(train_loader)
+    log_interval = max(train_epoch_size // 5, 1)
+
+    if args.which_encoder == 'dino_vitb16':
+        encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vitb16')
+    elif args.which_encoder == 'dino_vits8':
+        encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vits8')
+    elif args.which_encoder == 'dino_vitb8':
+        encoder = torch.hub.load('facebookresearch/dino:main', 'dino_vitb8')
+    elif args.which_encoder == 'dinov2_vitb14':
+        encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14')
+    elif args.which_encoder == 'dinov2_vits14':
+        encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14')
+    elif args.which_encoder == 'dinov2_vitb14_reg':
+        encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vitb14_reg')
+    elif args.which_encoder == 'dinov2_vits14_reg':
+        encoder = torch.hub.load('facebookresearch/dinov2', 'dinov2_vits14_reg')
+    elif args.which_encoder == 'mae_vitb16':
+        encoder = models_vit.__dict__["vit_base_patch16"](num_classes=0, global_pool=False, drop_path_rate=0)
+        assert args.pretrained_encoder_weights is not None
+        load_pretrained_encoder(encoder, args.pretrained_encoder_weights, prefix=None)
+    else:
+        raise
+
+    encoder = encoder.eval()
+
+    if args.use_second_encoder:
+        encoder_second = copy.deepcopy(encoder).eval()
+    else:
+        encoder_second = None
+
+    if args.num_cross_heads is None:
+        args.num_cross_heads = args.num_heads
+
+    # Every head is a full SPOT model (so that its checkpoints work with eval_spot.py and train_spot.py),
+    # but they all use the same encoder instances.
+    heads = []
+    for num_slots in num_slots_list:
+        head_args = copy.copy(args)
+        head_args.num_slots = num_slots
+        head_log_dir = os.path.join(log_dir, 'sn{}'.format(num_slots))
+        resume_path = os.path.join(head_log_dir, 'checkpoint.pt.tar') if args.resume_dir is not None else None
+        # The heads are trained in lockstep, a head without a checkpoint cannot join a resumed run.
+        assert resume_path is None or os.path.isfile(resume_path), \
+            'no checkpoint of the sn{} head at {}, --num_slots_list must be the one of the resumed run'.format(num_slots, resume_path)
+        heads.append(Head(head_args, (encoder, encoder_second), head_log_dir, device,
+                          niter_per_ep=train_epoch_size,
+                          warmup_epochs=int(args.lr_warmup_steps/(len(train_dataset)/args.batch_size)),
+                          resume_path=resume_path))
+
+    all_heads = heads
+    # The heads stopped by --early_stopping are not trained nor validated any more, they keep their last checkpoint.
+    heads = [head for head in all_heads if not head.stopped]
+    if len(heads) == 0:
+        print('====> All the heads already stopped')
+        for head in all_heads:
+            head.writer.close()
+        return
+    start_epoch, start_batch = heads[0].start_epoch, heads[0].start_batch
+    assert all((head.start_epoch, head.start_batch) == (start_epoch, start_batch) for head in heads), \
+        'the checkpoints of the heads are saved together, they must be at the same step'
+    if args.resume_dir is not None:
+        set_rng_state(heads[0].rng_state)
+
+    if args.precision != 'fp32' and args.amp_check_batches > 0:
+        for head in heads:
+            check_precision(head.model, val_loader, args.val_mask_size, args.precision, args.amp_check_batches, args.amp_check_tol,
+                            seed=args.seed, metric_workers=args.metric_workers)
+
+    visualize_per_epoch = int(args.epochs*args.eval_viz_percent)
+    preemption = PreemptionHandler()
+
+    end_epoch = args.epochs if args.stop_at_epoch is None else min(args.stop_at_epoch, args.epochs)
+    # The epoch of --stop_at_epoch is always validated, the sweep reads its metrics.
+    val_epochs = validation_epochs(args.epochs, args.val_interval_max) | {end_epoch}
+    for epoch in range(start_epoch, end_epoch):
+
+        heads = [head for head in heads if not head.stopped]
+        if len(heads) == 0:
+            break
+        models = [head.model for head in heads]
+
+        for head in heads:
+            head.model.train()
+            head.logger.reset()
+            head.optimizer.zero_grad()
+        train_sampler.set_epoch(epoch, start_index=start_batch*args.batch_size)
+
+        for batch, image in enumerate(train_loader, start=start_batch):
+
+            image = image.to(device)
+
+            global_step = epoch * train_epoch_size + batch
+
+            # The encoder tokens of each micro-batch are computed once and used by all the heads.
+            mses = [0. for _ in heads]
+            for image_micro in image.chunk(args.accum_steps):
+                weight = image_micro.shape[0] / image.shape[0]
+                with torch.no_grad(), get_autocast(args.precision, device.type):
+                    tokens = models[0].encode(image_micro)
+                for i, head in enumerate(heads):
+                    with get_autocast(args.precision, device.type):
+                        mse_micro = head.model.forward_from_tokens(*tokens, outputs=())
+                    head.scaler.scale(weight * mse_micro).backward()
+                    mses[i] = mses[i] + weight * mse_micro.detach()
+
+            for head, mse in zip(heads, mses):
+                head.step(global_step, mse)
+                if (batch + 1) % log_interval == 0:
+                    lr_value = head.optimizer.param_groups[0]['lr']
+                    head.writer.add_scalar('TRAIN/lr_main', lr_value, global_step)
+                    head.logger.flush(global_step, 'sn{} Train Epoch: {:3} [{:5}/{:5}] \t lr = {:5}'.format(
+                                      head.args.num_slots, epoch+1, batch+1, train_epoch_size, lr_value))
+
+            if preemption.requested or (args.checkpoint_every_steps > 0 and (global_step + 1) % args.checkpoint_every_steps == 0):
+                for head in heads:
+                    save_checkpoint(head.get_checkpoint(epoch, batch + 1), head.checkpoint_path)
+                if preemption.requested:
+                    print('====> Saved checkpoints at epoch {} step {}, exiting'.format(epoch + 1, batch + 1))
+                    for head in heads:
+                        head.writer.close()
+                    return
+
+        start_batch = 0
+
+        # Once the metric of a head stops improving, every epoch is validated until it improves again or the head stops.
+        if (epoch + 1) not in val_epochs and not any(args.early_stopping and head.early_stopping.num_bad > 0 for head in heads):
+            for head in heads:
+                save_checkpoint(head.get_checkpoint(epoch + 1, 0), head.checkpoint_path)
+            if preemption.requested:
+                print('====> Saved checkpoints at epoch {}, exiting'.format(epoch + 1))
+                break
+            continue
+
+        with torch.no_grad():
+            outputs = evaluate_models(models, val_loader, args.val_mask_size, args.precision,
+                                      should_stop=lambda: preemption.requested, metric_workers=args.metric_workers, groups=val_groups)
+
+            if outputs[0][0] is None:
+                # The training part of the epoch is done, redo only the validation when resuming.
+                for head in heads:
+                    save_checkpoint(head.get_checkpoint(epoch, train_epoch_size), head.checkpoint_path)
+                    head.writer.close()
+                print('====> Saved checkpoints at epoch {} before validation, exiting'.format(epoch + 1))
+                return
+
+            visualize = epoch%visualize_per_epoch==0 or epoch==args.epochs-1
+            for head, (val_results, val_last) in zip(heads, outputs):
+                head.validate(epoch, val_results, val_last, visualize)
+
+        if preemption.requested:
+            print('====> Saved checkpoints at epoch {}, exiting'.format(epoch + 1))
+            break
+
+    for head in all_heads:
+        head.writer.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('SPOT multi-head', parents=[get_args_parser()])
+    args = parser.parse_args()
+    train(args)
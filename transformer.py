@@ -2,8 +2,22 @@
 Copied from SLATE (https://github.com/singhgautam/slate/blob/master/transformer.py) and slightly modified 
 '''
 
+import functools
 from utils_spot import *
 
+# Fused attention kernels (flash / memory-efficient) are available from PyTorch 2.0 on.
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+
+@functools.lru_cache(maxsize=16)
+def causal_mask(target_len, source_len, device):
+    """
+    return: target_len x source_len bool mask, True for the positions after the query position.
+            Masks are generated on first use and cached per length (they must not be modified in place).
+    """
+    return torch.ones((target_len, source_len), dtype=torch.bool, device=device).triu(diagonal=1)
+
+
 class MultiHeadAttention(nn.Module):
     
     def __init__(self, d_model, num_heads, dropout=0., gain=1.):
@@ -20,15 +34,20 @@ class MultiHeadAttention(nn.Module):
         self.proj_k = linear(d_model, d_model, bias=False)
         self.proj_v = linear(d_model, d_model, bias=False)
         self.proj_o = linear(d_model, d_model, bias=False, gain=gain)
+        
+        self.fused = HAS_SDPA
     
     
-    def forward(self, q, k, v, attn_mask=None):
+    def forward(self, q, k, v, attn_mask=None, is_causal=False, need_weights=False):
         """
         q: batch_size x target_len x d_model
         k: batch_size x source_len x d_model
         v: batch_size x source_len x d_model
-        attn_mask: target_len x source_len
-        return: batch_size x target_len x d_model
+        attn_mask: target_len x source_len, True for the masked positions
+        is_causal: additionally mask the positions after the query position
+        need_weights: also return the attention weights (before dropout), which are
+                      not materialized by the fused kernel
+        return: batch_size x target_len x d_model (, batch_size x num_heads x target_len x source_len)
         """
         B, T, _ = q.shape
         _, S, _ = k.shape
@@ -37,18 +56,35 @@ class MultiHeadAttention(nn.Module):
         k = self.proj_k(k).view(B, S, self.num_heads, -1).transpose(1, 2)
         v = self.proj_v(v).view(B, S, self.num_heads, -1).transpose(1, 2)
         
-        q = q * (q.shape[-1] ** (-0.5))
-        attn = torch.matmul(q, k.transpose(-1, -2))
-        
-        if attn_mask is not None:
-            attn = attn.masked_fill(attn_mask, float('-inf'))
-        
-        attn = F.softmax(attn, dim=-1)
-        attn = self.attn_dropout(attn)
+        if self.fused and not need_weights:
+            if is_causal and attn_mask is not None:
+                attn_mask = attn_mask | causal_mask(T, S, q.device)
+                is_causal = False
+            output = F.scaled_dot_product_attention(
+                q, k, v,
+                attn_mask=None if attn_mask is None else ~attn_mask, # True means "attend" for the fused kernel
+                dropout_p=self.attn_dropout.p if self.training else 0.,
+                is_causal=is_causal)
+            attn = None
+        else:
+            if is_causal:
+                attn_mask = causal_mask(T, S, q.device) if attn_mask is None else attn_mask | causal_mask(T, S, q.device)
+            
+            q = q * (q.shape[-1] ** (-0.5))
+            attn = torch.matmul(q, k.transpose(-1, -2))
+            
+            if attn_mask is not None:
+                attn = attn.masked_fill(attn_mask, float('-inf'))
+            
+            attn = F.softmax(attn, dim=-1)
+            output = torch.matmul(self.attn_dropout(attn), v)
         
-        output = torch.matmul(attn, v).transpose(1, 2).reshape(B, T, -1)
+        output = output.transpose(1, 2).reshape(B, T, -1)
         output = self.proj_o(output)
         output = self.output_dropout(output)
+        
+        if need_weights:
+            return output, attn
         return output
 
 
@@ -136,7 +172,7 @@ class TransformerEncoder(nn.Module):
 
 class TransformerDecoderBlock(nn.Module):
     
-    def __init__(self, max_len, d_model, num_heads, dropout=0., gain=1., is_first=False, num_cross_heads=None):
+    def __init__(self, d_model, num_heads, dropout=0., gain=1., is_first=False, num_cross_heads=None):
         super().__init__()
         
         self.is_first = is_first
@@ -144,9 +180,6 @@ class TransformerDecoderBlock(nn.Module):
         self.self_attn_layer_norm = nn.LayerNorm(d_model)
         self.self_attn = MultiHeadAttention(d_model, num_heads, dropout, gain)
         
-        mask = torch.triu(torch.ones((max_len, max_len), dtype=torch.bool), diagonal=1)
-        self.self_attn_mask = nn.Parameter(mask, requires_grad=False)
-        
         self.encoder_decoder_attn_layer_norm = nn.LayerNorm(d_model)
         
         if num_cross_heads is None:
@@ -161,43 +194,55 @@ class TransformerDecoderBlock(nn.Module):
             nn.Dropout(dropout))
     
     
-    def forward(self, input, encoder_output, causal_mask=True):
+    def forward(self, input, encoder_output, causal_mask=True, return_attn=False):
         """
         input: batch_size x target_len x d_model
         encoder_output: batch_size x source_len x d_model
         return: batch_size x target_len x d_model
+                (, batch_size x num_cross_heads x target_len x source_len cross-attention if return_attn)
         """
-        T = input.shape[1]
-
-        self_attn_mask = self.self_attn_mask[:T, :T] if causal_mask else None
         if self.is_first:
             input = self.self_attn_layer_norm(input)
-            x = self.self_attn(input, input, input, self_attn_mask)
+            x = self.self_attn(input, input, input, is_causal=causal_mask)
             input = input + x
         else:
             x = self.self_attn_layer_norm(input)
-            x = self.self_attn(x, x, x, self_attn_mask)
+            x = self.self_attn(x, x, x, is_causal=causal_mask)
             input = input + x
         
         x = self.encoder_decoder_attn_layer_norm(input)
-        x = self.encoder_decoder_attn(x, encoder_output, encoder_output)
+        if return_attn:
+            x, attn = self.encoder_decoder_attn(x, encoder_output, encoder_output, need_weights=True)
+        else:
+            x = self.encoder_decoder_attn(x, encoder_output, encoder_output)
         input = input + x
         
         x = self.ffn_layer_norm(input)
         x = self.ffn(x)
+        
+        if return_attn:
+            return input + x, attn
         return input + x
+    
+    
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints store a fixed max_len x max_len causal mask, which is now generated on the fly.
+        state_dict.pop(prefix + 'self_attn_mask', None)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class TransformerDecoder(nn.Module):
     
-    def __init__(self, num_blocks, max_len, d_model, num_heads, dropout=0., num_cross_heads=None):
+    def __init__(self, num_blocks, d_model, num_heads, dropout=0., num_cross_heads=None, activation_checkpointing=False):
         super().__init__()
         
+        self.activation_checkpointing = activation_checkpointing
+        
         if num_blocks > 0:
             gain = (3 * num_blocks) ** (-0.5)
             self.blocks = nn.ModuleList(
-                [TransformerDecoderBlock(max_len, d_model, num_heads, dropout, gain, is_first=True)] +
-                [TransformerDecoderBlock(max_len, d_model, num_heads, dropout, gain, is_first=False, num_cross_heads=num_cross_heads)
+                [TransformerDecoderBlock(d_model, num_heads, dropout, gain, is_first=True)] +
+                [TransformerDecoderBlock(d_model, num_heads, dropout, gain, is_first=False, num_cross_heads=num_cross_heads)
                  for _ in range(num_blocks - 1)])
         else:
             self.blocks = nn.ModuleList()
@@ -205,14 +250,26 @@ class TransformerDecoder(nn.Module):
         self.layer_norm = nn.LayerNorm(d_model)
     
     
-    def forward(self, input, encoder_output, causal_mask=True):
+    def forward(self, input, encoder_output, causal_mask=True, return_attn=False):
         """
         input: batch_size x target_len x d_model
         encoder_output: batch_size x source_len x d_model
+        return_attn: also return the cross-attention weights of the last block, which is then the
+                     only block not using the fused attention kernel
+        With activation_checkpointing, the activations of each block are recomputed in the backward pass.
         return: batch_size x target_len x d_model
+                (, batch_size x num_cross_heads x target_len x source_len if return_attn)
         """
-        for block in self.blocks:
-            input = block(input, encoder_output, causal_mask)
+        attn = None
+        for i, block in enumerate(self.blocks):
+            if return_attn and i == len(self.blocks) - 1:
+                input, attn = checkpoint_forward(block, input, encoder_output, causal_mask, True,
+                                                 enabled=self.activation_checkpointing)
+            else:
+                input = checkpoint_forward(block, input, encoder_output, causal_mask,
+                                           enabled=self.activation_checkpointing)
         
+        if return_attn:
+            return self.layer_norm(input), attn
         return self.layer_norm(input)
 
@@ -2,8 +2,13 @@
 https://github.com/singhgautam/slate/blob/master/utils.py
 https://github.com/amazon-science/object-centric-learning-framework/blob/main/ocl/utils/masking.py
 '''
+import os
+import glob
+import json
 import math
+import contextlib
 import random
+import signal
 import warnings
 import argparse
 import numpy as np
@@ -17,6 +22,9 @@ from scipy.ndimage import generate_binary_structure
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torchvision import transforms
 from torchvision.utils import draw_segmentation_masks
 
@@ -284,7 +292,351 @@ def bool_flag(s):
         return True
     else:
         raise argparse.ArgumentTypeError("invalid value for a boolean flag")
-        
+
+
+PRECISIONS = ['fp32', 'bf16', 'fp16']
+
+def get_autocast(precision, device_type='cuda'):
+    """
+    Context manager for the forward passes: autocast to bf16 or fp16 (cuda only), nothing for fp32.
+    fp16 training additionally needs a GradScaler.
+    """
+    assert precision in PRECISIONS
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision == 'bf16' and device_type == 'cuda':
+        assert torch.cuda.is_bf16_supported(), "bf16 is not supported on this device, use fp16"
+    assert precision == 'bf16' or device_type == 'cuda', "fp16 autocast needs cuda, use bf16 on cpu"
+    return torch.autocast(device_type=device_type, dtype=torch.bfloat16 if precision == 'bf16' else torch.float16)
+
+
+ACTIVATION_CHECKPOINTING = ['encoder', 'decoder', 'slot_attn']
+
+def checkpoint_forward(function, *inputs, enabled=True):
+    """
+    Activation checkpointing: if enabled (and gradients are computed), the activations inside `function`
+    are not stored but recomputed during the backward pass, trading compute for memory.
+    """
+    if enabled and torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(function, *inputs, use_reentrant=False)
+    return function(*inputs)
+
+
+def is_dist_avail_and_initialized():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main_process():
+    return not is_dist_avail_and_initialized() or dist.get_rank() == 0
+
+
+def setup_for_distributed(is_master):
+    """
+    This function disables printing when not in master process
+    """
+    import builtins as __builtin__
+    builtin_print = __builtin__.print
+
+    def print(*args, **kwargs):
+        force = kwargs.pop('force', False)
+        if is_master or force:
+            builtin_print(*args, **kwargs)
+
+    __builtin__.print = print
+
+
+def init_distributed_mode(args):
+    """
+    Set args.rank, args.world_size and args.device from the environment variables of torchrun
+    (RANK, WORLD_SIZE, LOCAL_RANK) and initialize the process group if there are several processes.
+    Without them, this is a single process run on args.device (cuda if available by default).
+    """
+    args.rank = int(os.environ.get('RANK', 0))
+    args.world_size = int(os.environ.get('WORLD_SIZE', 1))
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+
+    if args.device is None:
+        args.device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    if args.device == 'cuda':
+        args.device = 'cuda:{}'.format(local_rank)
+        torch.cuda.set_device(args.device)
+
+    if args.world_size > 1:
+        print('| distributed init (rank {} / {}, {}, {})'.format(args.rank, args.world_size, args.dist_backend, args.device), flush=True)
+        dist.init_process_group(backend=args.dist_backend, init_method='env://',
+                                world_size=args.world_size, rank=args.rank)
+        dist.barrier()
+    setup_for_distributed(args.rank == 0)
+
+
+def ddp_sync_context(model, sync):
+    # With gradient accumulation, DDP only needs to all-reduce the gradients of the last micro-batch.
+    if sync or not isinstance(model, DistributedDataParallel):
+        return contextlib.nullcontext()
+    return model.no_sync()
+
+
+class NullWriter(object):
+    # Stands in for the SummaryWriter on the processes other than the main one.
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class ResumableRandomSampler(torch.utils.data.Sampler):
+    """
+    Random sampler whose order depends only on (seed, epoch), so that an interrupted
+    epoch can be resumed from the exact sample it stopped at. With several processes, each
+    one takes every num_replicas-th sample of the same order (the remainder is dropped), and
+    start_index counts the samples of the process.
+    """
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.data_source = data_source
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = len(data_source) // num_replicas
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_epoch(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(len(self.data_source), generator=g).tolist()
+        indices = indices[self.rank:self.num_samples * self.num_replicas:self.num_replicas]
+        return iter(indices[self.start_index:])
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+
+class ShardSampler(torch.utils.data.Sampler):
+    """
+    Sequential sampler over the samples rank, rank + num_replicas, ... for evaluation. Unlike
+    DistributedSampler it does not pad the shards, so that every sample is counted exactly once.
+    """
+    def __init__(self, data_source, num_replicas=1, rank=0):
+        self.indices = list(range(rank, len(data_source), num_replicas))
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+def get_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(checkpoint, path):
+    # Only the main process writes. Write to a temporary file first, so that a job
+    # killed while saving never leaves a truncated checkpoint behind.
+    if not is_main_process():
+        return
+    tmp_path = path + '.tmp'
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class EarlyStopping(object):
+    """
+    Track a validation metric (minimized for mse, maximized for the others) and count the
+    validations without an improvement of more than min_delta since the best one.
+    """
+    def __init__(self, metric='mse', patience=4, min_delta=0.):
+        self.metric = metric
+        self.patience = patience
+        self.min_delta = min_delta
+        self.sign = -1. if metric == 'mse' else 1.
+        self.best = -math.inf
+        self.num_bad = 0
+
+    def update(self, val_results):
+        # Returns whether the metric improved.
+        value = self.sign * val_results[self.metric]
+        if value > self.best + self.min_delta:
+            self.best = value
+            self.num_bad = 0
+            return True
+        self.num_bad += 1
+        return False
+
+    @property
+    def should_stop(self):
+        return self.num_bad >= self.patience
+
+    def state_dict(self):
+        return {'best': self.best, 'num_bad': self.num_bad}
+
+    def load_state_dict(self, state_dict):
+        self.best = state_dict['best']
+        self.num_bad = state_dict['num_bad']
+
+
+def validation_epochs(epochs, max_interval=1):
+    """
+    Epochs (counted from 1) after which the validation runs: every max_interval epochs at the beginning of the
+    training, with the interval shrinking linearly to every epoch at the end. The last epoch is always validated.
+    """
+    val_epochs = set()
+    epoch = 0
+    while epoch < epochs:
+        epoch = min(epoch + max(1, round(max_interval * (1 - epoch / epochs))), epochs)
+        val_epochs.add(epoch)
+    return val_epochs
+
+
+def log_val_metrics(log_dir, epoch, val_results, name='val_metrics.jsonl'):
+    # One json line per validation, read by sweep_spot.py. A resumed epoch may appear twice, the last line wins.
+    if not is_main_process():
+        return
+    with open(os.path.join(log_dir, name), 'a') as f:
+        f.write(json.dumps(dict(epoch=epoch, **val_results)) + '\n')
+
+
+def read_val_metrics(log_dir, name='val_metrics.jsonl'):
+    path = os.path.join(log_dir, name)
+    if not os.path.isfile(path):
+        return {}
+    metrics = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                metrics[record['epoch']] = record
+    return metrics
+
+
+def save_eval_snapshot(model, args, log_dir, epoch):
+    """
+    Writes the weights of `epoch` to log_dir/eval_snapshots for eval_service.py, with the training arguments, the
+    random state the validation of the training loop would start from, and without the frozen encoder weights
+    (the service loads the pretrained encoders once).
+    """
+    if not is_main_process():
+        return
+    frozen = {'{}.{}'.format(prefix, name)
+              for prefix, encoder in (('encoder', model.encoder), ('second_encoder', model.second_encoder)) if encoder is not None
+              for name, param in encoder.named_parameters() if not param.requires_grad}
+    snapshot = {
+        'epoch': epoch,
+        'args': vars(args),
+        'second_encoder': model.second_encoder is not None,
+        'rng_state': get_rng_state(),
+        'model': {k: v for k, v in model.state_dict().items() if k not in frozen},
+    }
+    os.makedirs(os.path.join(log_dir, 'eval_snapshots'), exist_ok=True)
+    save_checkpoint(snapshot, os.path.join(log_dir, 'eval_snapshots', 'epoch_{:04d}.pt'.format(epoch)))
+
+
+def find_last_checkpoint(log_path, name='checkpoint.pt.tar'):
+    checkpoints = glob.glob(os.path.join(log_path, '*', name))
+    if len(checkpoints) == 0:
+        return None
+    return max(checkpoints, key=os.path.getmtime)
+
+
+class TrainLogger(object):
+    """
+    Accumulate scalar training statistics on their device, so that the training loop never
+    waits on a host sync, and flush their per-interval mean and max to TensorBoard and stdout.
+    """
+    def __init__(self, writer, prefix='TRAIN'):
+        self.writer = writer
+        self.prefix = prefix
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.maxs = {}
+        self.count = 0
+
+    @torch.no_grad()
+    def update(self, **scalars):
+        for name, value in scalars.items():
+            value = value.detach().float()
+            if name in self.sums:
+                self.sums[name] += value
+                self.maxs[name] = torch.maximum(self.maxs[name], value)
+            else:
+                self.sums[name] = value.clone()
+                self.maxs[name] = value.clone()
+        self.count += 1
+
+    def flush(self, global_step, header=''):
+        if self.count == 0:
+            return {}
+        names = list(self.sums.keys())
+        sums = torch.stack([self.sums[name] for name in names])
+        maxs = torch.stack([self.maxs[name] for name in names])
+        count = self.count
+        if is_dist_avail_and_initialized():
+            # Statistics over all the processes.
+            dist.all_reduce(sums)
+            dist.all_reduce(maxs, op=dist.ReduceOp.MAX)
+            count *= dist.get_world_size()
+        # A single device-to-host copy for all the statistics of the interval.
+        stats = torch.cat([sums, maxs]).cpu().tolist()
+        means = {name: stats[i] / count for i, name in enumerate(names)}
+        maxs = {name: stats[len(names) + i] for i, name in enumerate(names)}
+
+        for name in names:
+            self.writer.add_scalar('{}/{}'.format(self.prefix, name), means[name], global_step)
+            self.writer.add_scalar('{}/{}_max'.format(self.prefix, name), maxs[name], global_step)
+        print(' \t '.join([header] + ['{}: {:F} (max {:F})'.format(name, means[name], maxs[name]) for name in names]))
+
+        self.reset()
+        return means
+
+
+class PreemptionHandler(object):
+    """
+    Turn SIGTERM/SIGUSR1 (sent by SLURM on preemption or before the time limit) into
+    a flag that the training loop polls, so that it can checkpoint at a step boundary.
+    """
+    def __init__(self, signals=(signal.SIGTERM, signal.SIGUSR1)):
+        self.requested = False
+        for sig in signals:
+            signal.signal(sig, self.handler)
+
+    def handler(self, signum, frame):
+        print('Received signal {}, checkpointing after the current step'.format(signum))
+        self.requested = True
+
+    def synchronize(self, device, step=None, interval=1):
+        """
+        Whether to stop, the same in all the processes: with several processes, a signal received by any of
+        them stops all of them at the same step. The flag is only exchanged (a collective and a host sync)
+        when step + 1 is a multiple of interval, the other steps return False in every process.
+        """
+        if not is_dist_avail_and_initialized():
+            return self.requested
+        if step is not None and (step + 1) % interval != 0:
+            return False
+        requested = torch.tensor(int(self.requested), device=device)
+        dist.all_reduce(requested, op=dist.ReduceOp.MAX)
+        self.requested = bool(requested.item())
+        return self.requested
+
 #Copied from https://github.com/amazon-science/object-centric-learning-framework/blob/main/ocl/utils/masking.py
 """Utilities related to masking."""
 
@@ -459,6 +811,21 @@ def interpolate_pos_embed(model, checkpoint_model):
             checkpoint_model['pos_embed'] = new_pos_embed
 
 
+def resize_pos_embed(pos_embed, num_tokens):
+    # Bicubic interpolation of a square grid of position embeddings [1, N, D] (without extra
+    # tokens) to num_tokens positions, as interpolate_pos_embed does for the encoder.
+    if pos_embed.shape[-2] == num_tokens:
+        return pos_embed
+    embedding_size = pos_embed.shape[-1]
+    orig_size = int(pos_embed.shape[-2] ** 0.5)
+    new_size = int(num_tokens ** 0.5)
+    assert new_size ** 2 == num_tokens, "the number of tokens must correspond to a square grid"
+    pos_tokens = pos_embed.reshape(-1, orig_size, orig_size, embedding_size).permute(0, 3, 1, 2)
+    pos_tokens = torch.nn.functional.interpolate(
+        pos_tokens, size=(new_size, new_size), mode='bicubic', align_corners=False)
+    return pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
+
+
 def load_pretrained_encoder(model, pretrained_weights, prefix=None):
     if pretrained_weights:
         checkpoint = torch.load(pretrained_weights, map_location='cpu')